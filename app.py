@@ -1,160 +1,548 @@
-import eventlet
-eventlet.monkey_patch()
+import runtime
+runtime.monkey_patch()  # eventlet mode; must run before anything else imports socket or threading
 
 import os
+import json
+import atexit
+import gzip
+import time
+import hashlib
+import functools
+import logging
 import secrets
 import random
 import string
-from flask import Flask, send_from_directory, request
-from flask_socketio import SocketIO, emit, join_room
+from collections import OrderedDict
+from flask import Flask, Response, send_from_directory, send_file, redirect, request
+from models import Player, Room, Song
+from store import create_room_store
+from patches import json_diff
+import engine
+import metrics
+import logs
+import upstream
+import transport
+from catalog import SongCatalog
+from assets import StaticAssets
+from scheduler import Scheduler
+from previews import PreviewCache, preview_id
+
+_threading = runtime.original('threading')  # Real OS threads for blocking file writes
 
-app = Flask(__name__, static_folder='public', static_url_path='')
+log_handler = logs.setup_logging(os.environ)
+log = logging.getLogger('tunetimeline')
+# Per-packet Socket.IO/Engine.IO logging costs real loop time under load; opt in for debugging.
+# Passing our own loggers also keeps both libraries from adding a synchronous stderr handler.
+SOCKETIO_PACKET_LOGS = os.environ.get('SOCKETIO_PACKET_LOGS', 'false').lower() == 'true'
+socketio_logger = logging.getLogger('socketio.server')
+engineio_logger = logging.getLogger('engineio.server')
+for packet_logger in (socketio_logger, engineio_logger):
+    packet_logger.setLevel(logging.INFO if SOCKETIO_PACKET_LOGS else logging.WARNING)
+
+# No built-in static route: send_asset() serves public/ (its catch-all would shadow the hashed names)
+app = Flask(__name__, static_folder=None)
+PUBLIC_DIR = os.path.join(app.root_path, 'public')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
+# Behind a proxy that honours X-Sendfile, it sends files (audio previews) itself, zero-copy
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', 'false').lower() == 'true'
 # Enhanced Socket.IO configuration for mobile stability
-socketio = SocketIO(
+# SERVER_MODE=asyncio serves the same handlers from python-socketio's AsyncServer under uvicorn
+sockets = transport.create(
     app, 
     cors_allowed_origins="*", 
-    async_mode='eventlet', 
-    logger=True, 
-    engineio_logger=True,
+    logger=socketio_logger,
+    engineio_logger=engineio_logger,
     ping_timeout=60,
     ping_interval=25,
-    manage_session=False # Often better for mobile devices
+    manage_session=False, # Often better for mobile devices
+    # Redis/Kombu URL shared by all workers so broadcasts reach sockets on any of them
+    message_queue=os.environ.get('SOCKETIO_MESSAGE_QUEUE'),
+    json=metrics.PacketJSON(json)  # Counts outbound events and bytes as packets are encoded
 )
 
-import requests
 import re
-import json
+
+try:
+    import msgpack
+except ImportError:  # Without it every client simply stays on JSON
+    msgpack = None
 
 # Game State Storage
-rooms = {}
+# ROOM_STORE_URL: unset for in-process rooms, redis://... to share rooms between workers.
+# ROOM_JOURNAL_DIR: journal in-process rooms to disk so a restart doesn't end every game.
+ROOM_STORE_URL = os.environ.get('ROOM_STORE_URL')
+if runtime.ASYNCIO and ROOM_STORE_URL and ROOM_STORE_URL.startswith('redis'):
+    raise ValueError("The Redis room store uses a blocking client; run it with SERVER_MODE=eventlet")
+rooms = create_room_store(ROOM_STORE_URL, os.environ.get('ROOM_JOURNAL_DIR'))
+# Sockets stay on the worker that accepted them, so these are per-process
 admins = set() # Store SIDs of authenticated admins
+sid_index = {} # sid -> room_code, so membership changes never scan all rooms
+deadlines = Scheduler()  # Every per-room timer (reveals, timeouts, batched flushes), run by one greenlet
+
+ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'MASTER')
+
+def instrumented(event):
+    """Record a Socket.IO handler's latency and errors for /metrics. game-action is split by action."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(*args):
+            action = ''
+            if event == 'game-action' and args and isinstance(args[0], dict):
+                action = args[0].get('action')
+                action = action if action in engine.ACTIONS else 'other'  # Keep label values bounded
+            with metrics.timed(metrics.handler_seconds, (event, action), metrics.handler_errors):
+                return handler(*args)
+        return wrapper
+    return decorate
+
+class TTLCache:
+    """Size-bounded LRU cache with a TTL, stale-while-revalidate and request coalescing.
+
+    Entries younger than `ttl` are served directly. Entries up to `stale_ttl`
+    seconds past that are still served, while a single background refresh
+    replaces them. Concurrent misses for the same key share one load.
+    """
+
+    def __init__(self, maxsize=256, ttl=300, stale_ttl=3600, on_load=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.on_load = on_load  # called after a freshly loaded value is stored
+        self._data = OrderedDict()  # key -> (value, stored_at)
+        self._inflight = {}  # key -> Event shared by everyone waiting on that key
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get_or_load(self, key, loader, cacheable=None):
+        entry = self._data.get(key)
+        if entry is not None:
+            value, stored_at = entry
+            age = time.monotonic() - stored_at
+            if age < self.ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self._data.move_to_end(key)
+                self.stale_hits += 1
+                if key not in self._inflight:
+                    self._inflight[key] = runtime.Event()
+                    runtime.spawn(self._refresh, key, loader, cacheable)
+                return value
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return pending.wait()
+
+        self.misses += 1
+        self._inflight[key] = runtime.Event()
+        return self._load(key, loader, cacheable)
+
+    def peek(self, key):
+        """The stored value however old, without counting a hit; None if absent."""
+        entry = self._data.get(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key, value, age=0):
+        self._data[key] = (value, time.monotonic() - age)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, key, loader, cacheable):
+        event = self._inflight[key]
+        try:
+            value = loader()
+        except Exception as e:
+            del self._inflight[key]
+            event.send_exception(e)
+            raise
+        if cacheable is None or cacheable(value):
+            self.set(key, value)
+            if self.on_load:
+                self.on_load()
+        del self._inflight[key]
+        event.send(value)
+        return value
+
+    def _refresh(self, key, loader, cacheable):
+        try:
+            self._load(key, loader, cacheable)
+        except Exception as e:
+            log.warning("Cache refresh failed for %s: %s", key, e)
+
+    def items(self):
+        """Yield (key, value, age in seconds) for every entry, oldest first."""
+        now = time.monotonic()
+        for key, (value, stored_at) in self._data.items():
+            yield key, value, now - stored_at
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'staleHits': self.stale_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'inflight': len(self._inflight)
+        }
+
+itunes_cache = TTLCache(
+    maxsize=int(os.environ.get('ITUNES_CACHE_SIZE', 512)),
+    ttl=int(os.environ.get('ITUNES_CACHE_TTL', 600)),
+    stale_ttl=int(os.environ.get('ITUNES_CACHE_STALE_TTL', 3600))
+)
+
+def normalize_itunes_query(term, limit):
+    # Case and whitespace don't change iTunes results, so they shouldn't split the cache
+    term = ' '.join(term.lower().split())
+    try:
+        limit = min(max(int(limit), 1), 200)
+    except (TypeError, ValueError):
+        limit = 20
+    return term, limit
+
+# Upstream endpoints; overridable so benchmarks can point at bench/fake_upstream.py
+ITUNES_SEARCH_URL = os.environ.get('ITUNES_SEARCH_URL', 'https://itunes.apple.com/search')
+SPOTIFY_EMBED_URL = os.environ.get('SPOTIFY_EMBED_URL', 'https://open.spotify.com/embed/playlist/')
+
+# Shared keep-alive pools with per-host concurrency caps and circuit breakers
+UPSTREAM_FAILURE_THRESHOLD = int(os.environ.get('UPSTREAM_FAILURE_THRESHOLD', 5))
+UPSTREAM_COOLDOWN = int(os.environ.get('UPSTREAM_COOLDOWN', 30))
+itunes_upstream = upstream.Upstream(
+    'itunes', max_in_flight=int(os.environ.get('ITUNES_MAX_IN_FLIGHT', 8)), read_timeout=5, deadline=8,
+    failure_threshold=UPSTREAM_FAILURE_THRESHOLD, cooldown=UPSTREAM_COOLDOWN
+)
+spotify_upstream = upstream.Upstream(
+    'spotify', max_in_flight=int(os.environ.get('SPOTIFY_MAX_IN_FLIGHT', 4)), read_timeout=10, deadline=15,
+    failure_threshold=UPSTREAM_FAILURE_THRESHOLD, cooldown=UPSTREAM_COOLDOWN
+)
+ITUNES_UNAVAILABLE = (json.dumps({'resultCount': 0, 'results': [], 'error': 'iTunes is tijdelijk niet bereikbaar.'}), 503)
 
-ADMIN_PASSWORD = 'MASTER'
+# Every playable search result also lands in the local catalog behind /api/songs/random
+song_catalog = SongCatalog(os.environ.get('SONG_CATALOG_DB', 'song_catalog.db'))
+
+def fetch_itunes_search(term, limit):
+    r = itunes_upstream.get(ITUNES_SEARCH_URL, params={'term': term, 'media': 'music', 'limit': limit})
+    if r.status_code == 200:
+        try:
+            song_catalog.add_itunes(r.json().get('results', ()))
+        except (ValueError, AttributeError) as e:
+            log.warning("Unexpected iTunes response: %s", e)
+    return r.text, r.status_code
+
+def search_itunes(term, limit):
+    """Cached iTunes search. Returns the raw (body, status) pair.
+
+    While iTunes is unavailable, any cached answer is served regardless of
+    age, and an empty 503 result otherwise.
+    """
+    term, limit = normalize_itunes_query(term, limit)
+    try:
+        return itunes_cache.get_or_load(
+            (term, limit),
+            lambda: fetch_itunes_search(term, limit),
+            cacheable=lambda result: result[1] == 200
+        )
+    except upstream.Unavailable as e:
+        log.warning("%s", e)
+        return itunes_cache.peek((term, limit)) or ITUNES_UNAVAILABLE
 
 @app.route('/api/proxy/itunes')
 def proxy_itunes():
     """Proxy iTunes search requests to bypass client-side CORS/CSP blocks."""
-    term = request.args.get('term', '')
-    limit = request.args.get('limit', '20')
-    url = f"https://itunes.apple.com/search?term={term}&media=music&limit={limit}"
     try:
-        r = requests.get(url, timeout=10)
-        return (r.text, r.status_code, [('Content-Type', 'application/json')])
+        body, status = search_itunes(request.args.get('term', ''), request.args.get('limit', '20'))
+        return (body, status, [('Content-Type', 'application/json')])
     except Exception as e:
         return {"error": str(e)}, 500
 
-def generate_room_code():
-    return ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-
-def auto_insert_song(timeline, song):
-    # Inserts song and returns the new timeline sorted by year
-    timeline.append(song)
-    timeline.sort(key=lambda x: x['year'])
-    return timeline
-
-def get_correct_pos(timeline, song_year):
-    # Finds the correct index (0-based) for a song in a sorted timeline
-    for i, existing in enumerate(timeline):
-        if existing['year'] > song_year:
-            return i
-    return len(timeline)
-
-def perform_reveal(room_code):
-    """Helper function to perform the year reveal logic."""
-    if room_code not in rooms:
-        return
-    
-    room = rooms[room_code]
-    song = room.get('current_song')
-    placement = room.get('current_placement')
-    challenge = room.get('current_challenge')
-    
-    # Validate
-    if not song or not placement:
-        return
-    
-    actual_year = song['year']
-    p_team = placement['teamId']
-    p_pos = placement['pos']
-    
-    # Calculate where the song SHOULD have gone
-    p_timeline = room['teams'][p_team]['timeline']
-    correct_pos_on_p = get_correct_pos(p_timeline, actual_year)
-    
-    results = {
-        'actualYear': actual_year,
-        'placerCorrect': (p_pos == correct_pos_on_p),
-        'challengerCorrect': False,
-        'placement': placement,
-        'challenge': challenge,
-        'stolen': False
+@app.route('/api/songs/random')
+def random_song():
+    """A random catalog song, balanced across decades. ?decade=1980 narrows it, ?exclude=id,id skips songs."""
+    try:
+        decade = request.args.get('decade')
+        decade = int(decade) // 10 * 10 if decade else None
+        exclude = {int(i) for i in request.args.get('exclude', '').split(',') if i}
+    except ValueError:
+        return {'error': 'decade en exclude moeten getallen zijn.'}, 400
+    song = song_catalog.random(decade, exclude)
+    if song is None:
+        return {'error': 'Geen nummers in de catalogus.'}, 404
+    return song
+
+# Audio previews are fetched once per clip and served to the whole room from disk.
+# PREVIEW_CACHE_MB=0 turns it off; clients then stream straight from Apple again.
+PREVIEW_CACHE_MB = int(os.environ.get('PREVIEW_CACHE_MB', 512))
+PREVIEW_HOSTS = os.environ.get('PREVIEW_HOSTS', 'itunes.apple.com,mzstatic.com').split(',')
+preview_upstream = upstream.Upstream(
+    'preview', max_in_flight=int(os.environ.get('PREVIEW_MAX_IN_FLIGHT', 8)), read_timeout=10, deadline=20,
+    failure_threshold=UPSTREAM_FAILURE_THRESHOLD, cooldown=UPSTREAM_COOLDOWN
+)
+
+def fetch_preview(url):
+    r = preview_upstream.get(url)
+    if r.status_code != 200:
+        raise upstream.Unavailable(f"preview: HTTP {r.status_code}")
+    return r.content
+
+previews = PreviewCache(
+    os.environ.get('PREVIEW_CACHE_DIR', 'preview_cache'), PREVIEW_CACHE_MB * 2**20, fetch_preview, PREVIEW_HOSTS
+) if PREVIEW_CACHE_MB > 0 else None
+
+def room_preview_url(room_code, key):
+    """The song URL behind a preview id, looked up in the room that played or will play it."""
+    room = rooms.get(room_code) if room_code else None
+    if room is None:
+        return None
+    for song in (room.current_song, *room.song_deck):
+        if song and song.url and preview_id(song.url) == key:
+            return song.url
+    return None
+
+@app.route('/api/preview/<key>')
+def serve_preview(key):
+    """A cached audio preview. send_file answers Range requests with 206 and If-None-Match with 304.
+
+    Ids are registered on the worker that sent new-song. Another worker (a
+    shared Redis store, or a restart) resolves them through ?roomCode=.
+    """
+    if previews and previews.url(key) is None:
+        url = room_preview_url(request.args.get('roomCode'), key)
+        if url:
+            previews.register(url)
+    try:
+        located = previews.get(key) if previews else None
+    except Exception as e:
+        # Let the client stream from Apple rather than fail the song
+        log.warning("Preview unavailable: %s", e)
+        return redirect(previews.url(key), 302)
+    if located is None:
+        return {'error': 'Preview not found'}, 404
+    path, mimetype = located
+    return send_file(path, mimetype=mimetype, conditional=True, max_age=86400)
+
+def with_preview(room, data):
+    """new-song payload plus the cached preview path, and its download already started.
+
+    The path carries the room code, so sharded nginx routes it to the room's worker.
+    """
+    url = data['songData']['url']
+    key = previews.register(url) if previews else None
+    if key is None:
+        return data
+    previews.warm(url)
+    return dict(data, preview=f"/api/preview/{key}?roomCode={room.code}")
+
+def warm_next_preview(room):
+    if previews and room.song_deck:
+        previews.warm(room.song_deck[0].url)
+
+@app.route('/api/stats')
+def stats():
+    return {
+        'itunesCache': itunes_cache.stats(),
+        'playlistCache': playlist_cache.stats(),
+        'catalog': song_catalog.stats(),
+        'previews': previews.stats() if previews else None,
+        'deadlines': deadlines.stats(),
+        'upstreams': {'itunes': itunes_upstream.stats(), 'spotify': spotify_upstream.stats(),
+                      'preview': preview_upstream.stats()},
+        'rooms': room_stats()
     }
 
-    # Check challenger (if any)
-    if challenge:
-        c_team = challenge['teamId']
-        c_pos = challenge['pos']
-        room['teams'][c_team]['tokens'] -= 1  # Always spend token
-        
-        if c_pos == correct_pos_on_p:
-            results['challengerCorrect'] = True
-            results['stolen'] = True
-            room['teams'][c_team]['timeline'] = auto_insert_song(room['teams'][c_team]['timeline'], song)
-            room['teams'][c_team]['score'] += 1
-        elif results['placerCorrect']:
-            room['teams'][p_team]['timeline'] = auto_insert_song(room['teams'][p_team]['timeline'], song)
-            room['teams'][p_team]['score'] += 1
-    else:
-        if results['placerCorrect']:
-            room['teams'][p_team]['timeline'] = auto_insert_song(room['teams'][p_team]['timeline'], song)
-            room['teams'][p_team]['score'] += 1
-
-    # Rotate Turn
-    room['active_team'] = 'team2' if room['active_team'] == 'team1' else 'team1'
-    room['turn_state'] = 'playing'
-    room['current_placement'] = None
-    room['current_challenge'] = None
-    
-    # Check for winner
-    winner = None
-    if room['teams']['team1']['score'] >= room['target_score']: 
-        winner = room['teams']['team1']['name']
-    elif room['teams']['team2']['score'] >= room['target_score']: 
-        winner = room['teams']['team2']['name']
-
-    socketio.emit('year-revealed', {
-        'results': results,
-        'teams': room['teams'],
-        'nextTeam': room['active_team'],
-        'winner': winner
-    }, to=room_code)
+# Server-side song deck: playlist tracks resolved to playable songs ahead of time
+SONG_DECK_SIZE = int(os.environ.get('SONG_DECK_SIZE', 5))
+song_resolver_pool = runtime.Pool(int(os.environ.get('SONG_RESOLVER_CONCURRENCY', 8)))
+
+def song_from_itunes(track):
+    return Song(track['trackName'], track['artistName'], int(track['releaseDate'][:4]), track['previewUrl'])
+
+def resolve_track(track):
+    """Look up a playlist track on iTunes and return a playable song, or None."""
+    try:
+        body, status = search_itunes(f"{track['artist']} {track['name']}", 10)
+        if status != 200:
+            return None
+        for result in json.loads(body).get('results', []):
+            if result.get('previewUrl') and result.get('releaseDate'):
+                return song_from_itunes(result)
+    except Exception as e:
+        log.warning("Could not resolve %r: %s", track, e)  # %r, as a malformed track must not raise here too
+    return None
+
+def refill_song_deck(room):
+    """Top up the room's deck in the background until it holds SONG_DECK_SIZE songs.
+
+    Lookups run without the room lock; each resolved song is added in its own
+    short transaction.
+    """
+    if room.deck_refilling or not room.playlist_tracks:
+        return
+    room.deck_refilling = True
+    room_code = room.code
+    digest = room.playlist_hash
+    tracks = room.playlist_tracks
+    missing = SONG_DECK_SIZE - len(room.song_deck)
+
+    def fill():
+        nonlocal missing
+        try:
+            attempts = 0
+            while missing > 0 and attempts < SONG_DECK_SIZE * 4:
+                candidates = random.sample(tracks, min(missing, len(tracks)))
+                attempts += len(candidates)
+                for song in song_resolver_pool.imap(resolve_track, candidates):
+                    with rooms.transaction(room_code) as room:
+                        # Stop if the room closed or its playlist was replaced meanwhile
+                        if room is None or room.playlist_hash != digest:
+                            return
+                        deck = room.song_deck
+                        if song and len(deck) < SONG_DECK_SIZE and not room.is_played(song.artist, song.title) \
+                                and not any(s.url == song.url for s in deck):
+                            deck.append(song)
+                            if len(deck) == 1:
+                                warm_next_preview(room)
+                        missing = SONG_DECK_SIZE - len(deck)
+        finally:
+            with rooms.transaction(room_code) as room:
+                if room is not None and room.playlist_hash == digest:
+                    room.deck_refilling = False
+
+    runtime.spawn(fill)
+
+def set_playlist(room, tracks):
+    room.playlist_tracks = tracks
+    room.playlist_hash = publish_playlist(tracks)
+    room.song_deck.clear()
+    room.deck_refilling = False
+    refill_song_deck(room)
+
+# Room-affinity sharding: each worker process owns the rooms whose code starts with
+# its shard character, so a router can pin /socket.io?roomCode=... to that worker
+# (see deploy/nginx-shards.conf). With SHARD_COUNT=1 codes are fully random.
+ROOM_CODE_ALPHABET = string.ascii_uppercase + string.digits
+SHARD_ID = int(os.environ.get('SHARD_ID', 0))
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1))
+if not 0 <= SHARD_ID < SHARD_COUNT <= len(ROOM_CODE_ALPHABET):
+    raise ValueError(f"SHARD_ID must be below SHARD_COUNT (max {len(ROOM_CODE_ALPHABET)} shards)")
+draining = False  # Set by /api/shard/drain; a draining worker accepts no new rooms
+
+def room_shard(room_code):
+    """Shard that owns a room code, or None for codes no shard could have issued."""
+    if SHARD_COUNT == 1:
+        return 0
+    index = ROOM_CODE_ALPHABET.find(room_code[:1]) if room_code else -1
+    return index if 0 <= index < SHARD_COUNT else None
+
+def generate_room_code():
+    prefix = ROOM_CODE_ALPHABET[SHARD_ID] if SHARD_COUNT > 1 else ''
+    while True:
+        code = prefix + ''.join(secrets.choice(ROOM_CODE_ALPHABET) for _ in range(5 - len(prefix)))
+        if code not in rooms:
+            return code
+
+# Fingerprinted, precompressed copies of public/, built once (rebuilt on change in debug mode)
+static_assets = StaticAssets(PUBLIC_DIR, watch=os.environ.get('FLASK_DEBUG', 'false').lower() == 'true')
+
+def send_asset(path):
+    asset, encoding, cache_control = static_assets.lookup(path, request.headers.get('Accept-Encoding'))
+    if asset is None:
+        return send_from_directory(PUBLIC_DIR, path)
+    headers = {'ETag': asset.etag_for(encoding), 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if asset.matches(request.headers.get('If-None-Match')):
+        return Response(status=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(asset.variants[encoding], content_type=asset.content_type, headers=headers)
 
 @app.route('/')
 def index():
-    return send_from_directory(app.static_folder, 'index.html')
+    return send_asset('index.html')
 
 @app.route('/<path:path>')
 def serve_static(path):
-    return send_from_directory(app.static_folder, path)
+    return send_asset(path)
 
-@socketio.on('connect')
+@sockets.on('connect')
 def handle_connect():
-    print(f'User connected: {socketio}')
+    sid = sockets.sid()
+    if msgpack and sockets.query('wire') == 'msgpack':
+        msgpack_sids.add(sid)
+    log.debug("User connected", extra={'event': 'connect', 'sid': sid})
+
+# Content-addressed playlists served over HTTP, so room state only has to carry the hash
+PLAYLIST_BLOB_LIMIT = int(os.environ.get('PLAYLIST_BLOB_LIMIT', 64))
+playlist_blobs = OrderedDict()  # hash -> (tracks, json bytes, gzipped json bytes)
+
+def publish_playlist(tracks):
+    """Store tracks under their content hash and return the hash (None for an empty list)."""
+    if not tracks:
+        return None
+    # Rooms share cached tuples, so most calls are an identity hit and skip the hashing
+    for digest, blob in playlist_blobs.items():
+        if blob[0] is tracks:
+            playlist_blobs.move_to_end(digest)
+            return digest
+
+    raw = json.dumps(list(tracks), separators=(',', ':')).encode()
+    digest = hashlib.sha256(raw).hexdigest()[:32]
+    playlist_blobs[digest] = (tracks, raw, gzip.compress(raw))
+    playlist_blobs.move_to_end(digest)
+
+    if len(playlist_blobs) > PLAYLIST_BLOB_LIMIT:
+        in_use = rooms.playlist_hashes()
+        for old in [d for d in playlist_blobs if d not in in_use][:len(playlist_blobs) - PLAYLIST_BLOB_LIMIT]:
+            del playlist_blobs[old]
+    return digest
+
+@app.route('/api/playlists/<digest>')
+def serve_playlist(digest):
+    blob = playlist_blobs.get(digest)
+    if blob is None:
+        # Published by another worker, or evicted here; the room store still has the tracks
+        tracks = rooms.load_playlist(digest)
+        blob = playlist_blobs.get(publish_playlist(tracks)) if tracks else None
+    if blob is None:
+        return {"error": "Playlist not found"}, 404
+
+    use_gzip = 'gzip' in request.accept_encodings
+    etag = f"{digest}-gz" if use_gzip else digest
+    headers = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': 'public, max-age=31536000, immutable',
+        'Vary': 'Accept-Encoding'
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(blob[2], headers=headers, mimetype='application/json')
+    return Response(blob[1], headers=headers, mimetype='application/json')
 
 DEFAULT_PLAYLIST_URL = "https://open.spotify.com/playlist/321iL49aeqqqtKfrQLO91I?si=bedb6d63e0034784"
+PLAYLIST_CACHE_FILE = os.environ.get('PLAYLIST_CACHE_FILE', 'playlist_cache.json')
+
+def parse_playlist_id(url):
+    # Extract ID from a trusted Spotify domain
+    if not url.startswith("https://open.spotify.com/"):
+        raise Exception("Alleen Spotify links van open.spotify.com zijn toegestaan.")
+
+    match = re.search(r'playlist/([a-zA-Z0-9]+)', url)
+    if not match: raise Exception("Ongeldige Spotify URL. Kopieer de link vanuit Spotify.")
+    return match.group(1)
 
 def fetch_spotify_playlist(url):
     try:
-        # Extract ID from a trusted Spotify domain
-        if not url.startswith("https://open.spotify.com/"):
-            raise Exception("Alleen Spotify links van open.spotify.com zijn toegestaan.")
-        
-        match = re.search(r'playlist/([a-zA-Z0-9]+)', url)
-        if not match: raise Exception("Ongeldige Spotify URL. Kopieer de link vanuit Spotify.")
-        
-        playlist_id = match.group(1)
-        print(f"Fetching Spotify playlist: {playlist_id}...")
+        playlist_id = parse_playlist_id(url)
+        log.info("Fetching Spotify playlist", extra={'playlist': playlist_id})
         
         # Use a full browser User-Agent to avoid being blocked or getting 404s
         headers = {
@@ -165,7 +553,7 @@ def fetch_spotify_playlist(url):
             'Pragma': 'no-cache',
         }
         
-        response = requests.get(f"https://open.spotify.com/embed/playlist/{playlist_id}", timeout=15, headers=headers)
+        response = spotify_upstream.get(f"{SPOTIFY_EMBED_URL}{playlist_id}", headers=headers)
         
         if response.status_code != 200:
             raise Exception(f"Spotify gaf een foutmelding: {response.status_code}. Probeer het later opnieuw.")
@@ -236,428 +624,645 @@ def fetch_spotify_playlist(url):
             return tracks
         else:
             return []
+    except upstream.Unavailable:
+        raise  # get_playlist falls back to what it has cached
     except Exception as e:
-        print(f"Spotify Error: {e}")
+        log.warning("Spotify error: %s", e)
         return []
 
-@socketio.on('create-room')
+# Fetches within this many seconds of each other are saved to disk in one write
+PLAYLIST_CACHE_SAVE_DELAY = float(os.environ.get('PLAYLIST_CACHE_SAVE_DELAY', 5))
+playlist_cache_dirty = False
+playlist_cache_write_lock = _threading.Lock()
+
+def schedule_playlist_cache_save():
+    """on_load hook: save the cache once fetches settle down, so a restart comes up warm."""
+    global playlist_cache_dirty
+    if not playlist_cache_dirty:
+        playlist_cache_dirty = True
+        runtime.spawn_after(PLAYLIST_CACHE_SAVE_DELAY, save_playlist_cache)
+
+def playlist_cache_entries():
+    return [
+        {'id': playlist_id, 'tracks': list(tracks), 'storedAt': time.time() - age}
+        for playlist_id, tracks, age in playlist_cache.items()
+    ]
+
+def save_playlist_cache():
+    """Snapshot the cache on the event loop; an OS thread encodes and writes it."""
+    global playlist_cache_dirty
+    playlist_cache_dirty = False
+    _threading.Thread(target=write_playlist_cache, args=(playlist_cache_entries(),),
+                      name='playlist-cache', daemon=True).start()
+
+def write_playlist_cache(data):
+    with playlist_cache_write_lock:  # A slow disk must not interleave two writes of the tmp file
+        try:
+            tmp_path = PLAYLIST_CACHE_FILE + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, PLAYLIST_CACHE_FILE)
+        except OSError as e:
+            log.warning("Could not save playlist cache: %s", e)
+
+@atexit.register
+def save_pending_playlist_cache():
+    if playlist_cache_dirty:
+        write_playlist_cache(playlist_cache_entries())
+
+def load_playlist_cache():
+    try:
+        with open(PLAYLIST_CACHE_FILE) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+    if not isinstance(data, list):
+        log.warning("Ignoring %s: not a list of playlists", PLAYLIST_CACHE_FILE)
+        return
+    loaded = malformed = 0
+    for entry in data:
+        # A hand-edited or older file must never stop the server from starting; bad entries are misses
+        try:
+            age = max(time.time() - float(entry['storedAt']), 0)
+            playlist_id = entry['id']
+            tracks = engine.playlist_tracks(entry['tracks'])
+            if not isinstance(playlist_id, str) or tracks is None:
+                raise ValueError("not a playlist")
+        except (KeyError, TypeError, ValueError, OverflowError):
+            malformed += 1
+            continue
+        if age < playlist_cache.ttl + playlist_cache.stale_ttl:
+            playlist_cache.set(playlist_id, tracks, age=age)
+            loaded += 1
+    if malformed:
+        log.warning("Skipped %d malformed entries in %s", malformed, PLAYLIST_CACHE_FILE)
+    log.info("Loaded %d cached playlists from %s", loaded, PLAYLIST_CACHE_FILE)
+
+# Parsed playlists keyed by Spotify playlist ID. Values are tuples that rooms share by reference.
+playlist_cache = TTLCache(
+    maxsize=int(os.environ.get('PLAYLIST_CACHE_SIZE', 32)),
+    ttl=int(os.environ.get('PLAYLIST_CACHE_TTL', 6 * 3600)),
+    stale_ttl=int(os.environ.get('PLAYLIST_CACHE_STALE_TTL', 7 * 24 * 3600)),
+    on_load=schedule_playlist_cache_save
+)
+
+def get_playlist(url):
+    """Tracks for a Spotify playlist URL as a shared, immutable tuple (empty on failure)."""
+    try:
+        playlist_id = parse_playlist_id(url)
+    except Exception as e:
+        log.warning("Spotify error: %s", e)
+        return ()
+    try:
+        return playlist_cache.get_or_load(
+            playlist_id,
+            lambda: tuple(fetch_spotify_playlist(f"https://open.spotify.com/playlist/{playlist_id}")),
+            cacheable=bool
+        )
+    except upstream.Unavailable as e:
+        log.warning("%s", e)
+        return playlist_cache.peek(playlist_id) or ()
+
+def leave_other_room(sid, room_code):
+    """A socket belongs to one room at a time; leaving the previous one keeps the index exact.
+
+    Call this before locking room_code, as it takes the previous room's lock.
+    """
+    previous = sid_index.get(sid)
+    if previous and previous != room_code:
+        sockets.leave_room(sid, previous)
+        remove_player(sid)
+
+def add_player(room, sid, user_name):
+    room.add_player(Player(sid, user_name, secrets.token_urlsafe(16)))
+    sid_index[sid] = room.code
+    send_seat(room, sid)
+
+def send_seat(room, sid):
+    """Tell only this socket the secret that lets it take its seat back with rejoin-room."""
+    sockets.reply('seat', {'roomCode': room.code, 'sid': sid, 'seatSecret': room.players[sid].secret})
+
+def remove_player(sid):
+    """Drop a sid from its room; deletes the room when it empties or hands over host."""
+    room_code = sid_index.pop(sid, None)
+    if not room_code:
+        return
+    with rooms.transaction(room_code) as room:
+        if room is not None:
+            drop_player(room, sid)
+
+def drop_player(room, sid):
+    """Remove a sid from a locked room and tell the others."""
+    player = room.remove_player(sid)
+    room.ready_players.discard(sid)
+    if player and player.team:
+        room.teams[player.team].remove_player(sid)
+
+    # Delete room if empty
+    if not room.players:
+        del rooms[room.code]
+        cancel_deadlines(room.code)
+        if draining and not len(rooms):
+            log.warning("Shard %d drained, safe to stop", SHARD_ID)
+        return
+
+    # If host left, assign a new host
+    if room.host == sid:
+        new_host_sid = next(iter(room.players))
+        room.host = new_host_sid
+        log.info("Host left, new host %s", room.players[new_host_sid].name, extra={'event': 'host-changed', 'room': room.code})
+
+    request_sync(room)
+
+@sockets.on('rejoin-room')
+@instrumented('rejoin-room')
+def handle_rejoin_room(data):
+    """A client reconnected (network blip, server restart) and wants its old seat back.
+
+    The seat only moves with its secret, and only away from a socket that is
+    gone: unclaimed since a restart, disconnected, or (after a blip the
+    server hasn't noticed yet) replaced by this one.
+    """
+    sid = sockets.sid()
+    room_code = data.get('roomCode')
+    old_sid = data.get('sid')
+    user_name = data.get('userName')
+    secret = data.get('seatSecret')
+
+    if room_shard(room_code) not in (SHARD_ID, None):
+        sockets.reply('wrong-shard', {'roomCode': room_code})
+        return
+    leave_other_room(sid, room_code)
+    stale_sid = None
+    with rooms.transaction(room_code) as room:
+        if room is None:
+            sockets.reply('error-msg', 'Room not found')
+            return
+        if sid in room.players:
+            sockets.reply('error-msg', 'Je zit al in deze kamer.')
+            return
+        player = room.players.get(old_sid)
+        if player is None or player.name != user_name or not player.secret or not isinstance(secret, str) \
+                or not secrets.compare_digest(player.secret, secret):
+            # The seat is gone (the old socket's disconnect already ran) or isn't theirs: join as a new player
+            add_player(room, sid, user_name)
+        else:
+            if old_sid not in unclaimed_seats.get(room_code, ()) and sockets.connected(old_sid):
+                stale_sid = old_sid
+            room.replace_sid(old_sid, sid)
+            player.secret = secrets.token_urlsafe(16)
+            sid_index.pop(old_sid, None)  # The old socket's late disconnect must not remove the seat
+            sid_index[sid] = room_code
+            unclaimed_seats.get(room_code, set()).discard(old_sid)
+            send_seat(room, sid)
+        sockets.enter_room(sid, room_code)
+        sync_room_state(room, full_to=sid)
+        log.info("%s rejoined", user_name, extra={'event': 'rejoin-room', 'room': room_code})
+    if stale_sid:
+        # Outside the lock: its disconnect handler runs right away (and finds no seat left)
+        sockets.disconnect(stale_sid)
+
+@app.route('/api/shard')
+def shard_status():
+    """Lets the deploy tooling see when a draining worker has no games left."""
+    return {
+        'shardId': SHARD_ID,
+        'shardCount': SHARD_COUNT,
+        'draining': draining,
+        'rooms': len(rooms),
+        'players': len(sid_index)
+    }
+
+@app.route('/api/shard/drain', methods=['POST'])
+def drain_shard():
+    """Stop accepting new rooms; running games continue until their players leave."""
+    global draining
+    if request.headers.get('X-Admin-Password') != ADMIN_PASSWORD:
+        return {"error": "Forbidden"}, 403
+    draining = True
+    log.warning("Shard %d draining with %d rooms left", SHARD_ID, len(rooms))
+    return shard_status()
+
+@sockets.on('create-room')
+@instrumented('create-room')
 def handle_create_room(user_name):
+    sid = sockets.sid()
+    if draining:
+        sockets.reply('error-msg', 'Deze server wordt onderhouden. Probeer het zo opnieuw.')
+        return
+    # Global cap: make room by closing the least recently active games
+    if len(rooms) >= MAX_ROOMS:
+        for old_code in rooms.lru_codes(len(rooms) - MAX_ROOMS + 1):
+            evict_room(old_code, 'Deze party is gesloten om plaats te maken voor nieuwe spellen.')
+            reaper_stats['lruEvicted'] += 1
     room_code = generate_room_code()
-    rooms[room_code] = {
-        'host': request.sid,
-        'players': {}, # Use sid as key
-        'teams': {
-            'team1': {'name': 'Team 1', 'players': [], 'score': 0, 'tokens': 2, 'timeline': [], 'oracle': None, 'votes': {}},
-            'team2': {'name': 'Team 2', 'players': [], 'score': 0, 'tokens': 2, 'timeline': [], 'oracle': None, 'votes': {}}
-        },
-        'game_state': 'lobby',
-        'current_song': None,
-        'active_team': 'team1',
-        'target_score': 10,
-        'token_claimed': False,
-        'history': [],
-        'playlist_tracks': [],
-        'ready_players': set()
-    }
-    
+    leave_other_room(sid, room_code)
+    room = Room(room_code, sid)
+
+    # Add host to players (unassigned initially)
+    add_player(room, sid, user_name)
+    rooms[room_code] = room
+
     # Auto-load default playlist
     def load_default():
-        tracks = fetch_spotify_playlist(DEFAULT_PLAYLIST_URL)
-        if room_code in rooms:
-            rooms[room_code]['playlist_tracks'] = tracks
-            print(f"Auto-loaded {len(tracks)} tracks for room {room_code}")
-            sync_room_state(room_code)
+        tracks = get_playlist(DEFAULT_PLAYLIST_URL)
+        with rooms.transaction(room_code) as room:
+            if room is not None:
+                set_playlist(room, tracks)
+                log.info("Auto-loaded %d tracks", len(tracks), extra={'room': room_code})
+                request_sync(room)
             
-    eventlet.spawn(load_default)
-
-    # Add host to players (unassigned initially)
-    rooms[room_code]['players'][request.sid] = {'name': user_name, 'team': None}
+    runtime.spawn(load_default)
     
-    join_room(room_code)
-    emit('room-created', {'roomCode': room_code, 'userName': user_name})
-    print(f'Room {room_code} created by {user_name}')
+    sockets.enter_room(sid, room_code)
+    sockets.reply('room-created', {'roomCode': room_code, 'userName': user_name})
+    log.info("Room created by %s", user_name, extra={'event': 'create-room', 'room': room_code})
 
-@socketio.on('join-room')
+@sockets.on('join-room')
+@instrumented('join-room')
 def handle_join_room(data):
+    sid = sockets.sid()
     room_code = data.get('roomCode')
     user_name = data.get('userName')
     
-    if room_code in rooms:
-        rooms[room_code]['players'][request.sid] = {'name': user_name, 'team': None}
-        join_room(room_code)
-        sync_room_state(room_code)
-        print(f'{user_name} joined room {room_code}')
-    else:
-        emit('error-msg', 'Room not found')
+    if room_shard(room_code) not in (SHARD_ID, None):
+        # The router sent this socket elsewhere; the client reconnects with ?roomCode= and retries
+        sockets.reply('wrong-shard', {'roomCode': room_code})
+        return
+    leave_other_room(sid, room_code)
+    with rooms.transaction(room_code) as room:
+        if room is None:
+            sockets.reply('error-msg', 'Room not found')
+            return
+        add_player(room, sid, user_name)
+        sockets.enter_room(sid, room_code)
+        sync_room_state(room, full_to=sid)
+        log.info("%s joined", user_name, extra={'event': 'join-room', 'room': room_code})
 
-@socketio.on('join-team')
+@sockets.on('join-team')
+@instrumented('join-team')
 def handle_join_team(data):
+    sid = sockets.sid()
     room_code = data.get('roomCode')
     team_id = data.get('team') # 'team1' or 'team2'
     
-    if room_code in rooms and request.sid in rooms[room_code]['players']:
-        player = rooms[room_code]['players'][request.sid]
-        old_team = player.get('team')
-        
-        # Remove from old team if exists
-        if old_team and old_team in rooms[room_code]['teams']:
-            rooms[room_code]['teams'][old_team]['players'] = [
-                p for p in rooms[room_code]['teams'][old_team]['players'] if p['sid'] != request.sid
-            ]
-            
-        # Add to new team
-        player['team'] = team_id
-        rooms[room_code]['teams'][team_id]['players'].append({'sid': request.sid, 'name': player['name']})
-        
-        sync_room_state(room_code)
+    with rooms.transaction(room_code) as room:
+        if room and sid in room.players and team_id in room.teams:
+            room.assign_team(sid, team_id)
+            request_sync(room)
 
-@socketio.on('set-team-name')
+@sockets.on('set-team-name')
+@instrumented('set-team-name')
 def handle_set_team_name(data):
+    sid = sockets.sid()
     room_code = data.get('roomCode')
     team_id = data.get('team')
     new_name = data.get('name')
     
-    if room_code in rooms and rooms[room_code]['host'] == request.sid:
-        rooms[room_code]['teams'][team_id]['name'] = new_name
-        sync_room_state(room_code)
-
-def sync_room_state(room_code):
-    room = rooms[room_code]
-    # Simplify player list for emit
-    players_data = {sid: p['name'] for sid, p in room['players'].items()}
-    emit('room-update', {
-        'roomCode': room_code,
-        'players': players_data,
-        'teams': room['teams'],
-        'gameState': room['game_state'],
-        'turnState': room.get('turn_state', 'playing'),
-        'activeTeam': room.get('active_team', 'team1'),
-        'currentPlacement': room.get('current_placement'),
-        'currentChallenge': room.get('current_challenge'),
-        'currentChallenge': room.get('current_challenge'),
-        'targetScore': room.get('target_score', 10),
-        'playlistTracks': room.get('playlist_tracks', []),
-        'history': room.get('history', []),
-        'host': room.get('host')
-    }, to=room_code)
-
-@socketio.on('admin-login')
+    with rooms.transaction(room_code) as room:
+        if room and room.host == sid and team_id in room.teams:
+            room.teams[team_id].name = new_name
+            request_sync(room)
+
+# Bursts of state changes (lobby clicks, start-game) are merged into one room-update per window
+ROOM_SYNC_WINDOW = float(os.environ.get('ROOM_SYNC_WINDOW_MS', 30)) / 1000  # 0 = next loop tick
+pending_syncs = set()  # room codes with a scheduled flush
+
+def request_sync(room):
+    """Broadcast the room's state once the window closes, together with whatever else changes by then."""
+    metrics.sync_requests.inc()
+    if room.code not in pending_syncs:
+        pending_syncs.add(room.code)
+        deadlines.set(room.code, 'sync', ROOM_SYNC_WINDOW, flush_sync, room.code)
+
+def flush_sync(room_code):
+    if room_code not in pending_syncs:
+        return  # Someone synced directly in the meantime
+    with rooms.transaction(room_code) as room:
+        pending_syncs.discard(room_code)
+        if room is not None:
+            sync_room_state(room)
+
+def sync_room_state(room, full_to=None):
+    """Broadcast the room's changes since the last sync as a versioned patch, right now.
+
+    Clients apply a patch only on top of `baseVersion`; anyone who has a
+    different version asks for a snapshot with `request-room-state`.
+    `full_to` is a sid that gets a full snapshot instead (e.g. a new joiner).
+    Use request_sync() unless the order relative to other emits matters.
+    """
+    room_code = room.code
+    pending_syncs.discard(room_code)
+    # Wire forms are rebuilt rather than mutated, so the last one stays a valid base for the next diff
+    state = room.to_wire()
+    last_state = room.wire_state
+    room.wire_state = state
+
+    # Addressed by room code, so this also works from background greenlets (playlist loading)
+    if last_state is None:
+        room.version += 1
+        wire_emit('room-update', {'version': room.version, 'state': state}, room_code)
+        return
+
+    patch = json_diff(last_state, state) if state is not last_state else []
+    if patch:
+        room.version += 1
+        wire_emit('room-update', {
+            'roomCode': room_code,
+            'baseVersion': room.version - 1,
+            'version': room.version,
+            'patch': patch
+        }, room_code, skip_sid=full_to)
+    if full_to:
+        send_room_snapshot(room, full_to)
+
+# Clients that connect with ?wire=msgpack get the bulky events as one MessagePack binary attachment
+BINARY_EVENTS = frozenset({'room-update', 'year-revealed'})
+msgpack_sids = set()
+# With a message queue the room may have JSON members on other workers, so the JSON emit always goes out
+SHARED_BROADCASTS = bool(os.environ.get('SOCKETIO_MESSAGE_QUEUE'))
+
+def wire_emit(event, data, to, skip_sid=None):
+    """Emit to a room or sid, packing BINARY_EVENTS for the MessagePack clients among them."""
+    if event not in BINARY_EVENTS or not msgpack_sids:
+        sockets.emit(event, data, to=to, skip_sid=skip_sid)
+        return
+    members = [sid for sid in sockets.participants(to) if sid != skip_sid]
+    binary = [sid for sid in members if sid in msgpack_sids]
+    if not binary:
+        sockets.emit(event, data, to=to, skip_sid=skip_sid)
+        return
+    if SHARED_BROADCASTS or len(binary) < len(members):
+        sockets.emit(event, data, to=to, skip_sid=binary + [skip_sid])
+    blob = msgpack.packb(data)
+    metrics.emit_bytes.inc((event,), len(blob))  # The JSON hook only sees the attachment placeholder
+    sockets.emit(event, blob, to=binary)
+
+def send_room_snapshot(room, sid):
+    wire_emit('room-update', {'version': room.version, 'state': room.wire_state}, sid)
+
+@sockets.on('request-room-state')
+@instrumented('request-room-state')
+def handle_request_room_state(data):
+    # Client missed a version (or never had one) and needs a full snapshot
+    sid = sockets.sid()
+    room_code = data.get('roomCode')
+    with rooms.transaction(room_code) as room:
+        if room and sid in room.players:
+            if room.wire_state is None:
+                sync_room_state(room)
+            else:
+                send_room_snapshot(room, sid)
+
+@sockets.on('admin-login')
+@instrumented('admin-login')
 def handle_admin_login(password):
+    sid = sockets.sid()
     if password == ADMIN_PASSWORD:
-        admins.add(request.sid)
-        emit('admin-authenticated', True)
-        print(f"Admin authenticated: {request.sid}")
+        admins.add(sid)
+        sockets.reply('admin-authenticated', True)
+        log.info("Admin authenticated", extra={'event': 'admin-login', 'sid': sid})
     else:
-        emit('admin-authenticated', False)
-        emit('error-msg', 'Incorrect admin code!')
+        sockets.reply('admin-authenticated', False)
+        sockets.reply('error-msg', 'Incorrect admin code!')
 
-@socketio.on('game-action')
+@sockets.on('game-action')
+@instrumented('game-action')
 def handle_game_action(data):
+    sid = sockets.sid()
     room_code = data.get('roomCode')
     action = data.get('action')
     action_data = data.get('data')
-    
-    if room_code not in rooms:
-        emit('error-msg', 'Room not found.', to=request.sid)
+
+    # Spotify can take seconds; fetch before locking so the room stays responsive
+    if action == 'fetch-playlist' and sid in admins:
+        url = engine.playlist_url(action_data)
+        action_data = get_playlist(url) if url else ()
+
+    with rooms.transaction(room_code) as room:
+        if room is None:
+            sockets.reply('error-msg', 'Room not found.')
+            return
+        run_game_action(room, action, action_data)
+
+def run_game_action(room, action, action_data):
+    """Apply one game-action to a locked room."""
+    sid = sockets.sid()
+    is_admin = sid in admins
+    if action in ('fetch-playlist', 'set-playlist-tracks'):
+        # Playlists touch the shared blob store and deck resolver, so they live here rather than in the engine
+        error = engine.permission_error(room, sid, action, is_admin)
+        if error:
+            sockets.reply('error-msg', error)
+        elif action == 'fetch-playlist':
+            tracks = action_data  # Already fetched by handle_game_action
+            if tracks:
+                set_playlist(room, tracks)
+                log.info("Loaded %d tracks", len(tracks), extra={'room': room.code})
+                sockets.reply('playlist-loaded', {'count': len(tracks), 'hash': room.playlist_hash})
+                request_sync(room)
+            else:
+                sockets.reply('error-msg', "Kon geen nummers vinden in de Spotify playlist of playlist is niet publiek.")
+        else:
+            tracks = engine.playlist_tracks(action_data)
+            if tracks is None:
+                sockets.reply('error-msg', 'Ongeldige playlist.')
+                return
+            set_playlist(room, tracks)
+            # We don't necessarily need to sync this to everyone, just store it in the room
+            log.info("Playlist updated", extra={'room': room.code})
         return
+    dispatch(room, engine.apply_action(room, sid, action, action_data, is_admin))
+
+def dispatch(room, outcome):
+    """Send an engine Outcome's events and run its side effects."""
+    for event, data, to in outcome.events:
+        if event == engine.SYNC:
+            request_sync(room)
+        else:
+            if room.code in pending_syncs:
+                sync_room_state(room)  # One-shot events must still arrive after the state that preceded them
+            if event == 'new-song':
+                data = with_preview(room, data)
+                warm_next_preview(room)
+            wire_emit(event, data, room.code if to is engine.ROOM else to)
+    for effect, argument in outcome.effects:
+        if effect == 'refill-deck':
+            refill_song_deck(room)
+        elif effect == 'deadline':
+            kind, seconds = argument
+            if seconds:
+                deadlines.set(room.code, kind, seconds, expire_deadline, room.code, kind)
+            else:
+                deadlines.cancel(room.code, kind)
+        elif effect == 'vote-changed':
+            queue_vote_update(room, *argument)
+
+# Idle-room timeouts in seconds, 0 = off (see engine.DEADLINES)
+engine.READY_TIMEOUT = float(os.environ.get('READY_TIMEOUT', engine.READY_TIMEOUT))
+engine.VOTE_WINDOW = float(os.environ.get('VOTE_WINDOW', engine.VOTE_WINDOW))
+engine.TURN_TIMEOUT = float(os.environ.get('TURN_TIMEOUT', engine.TURN_TIMEOUT))
 
-    room = rooms[room_code]
-    is_host = (room['host'] == request.sid)
-    is_admin = (request.sid in admins)
+def expire_deadline(room_code, kind):
+    with rooms.transaction(room_code) as room:
+        # take() fails if the deadline was cancelled or moved while we waited for the lock
+        if room is not None and deadlines.take(room_code, kind):
+            dispatch(room, engine.expire(room, kind))
 
-    # Validate high-privilege actions
-    host_only_actions = ['start-game', 'init-starter-cards', 'play-song', 'reveal-year', 'set-target-score', 'set-oracle', 'randomize-teams', 'reset-game']
-    admin_only_actions = ['fetch-playlist']
+def cancel_deadlines(room_code):
+    """Forget a deleted room's timers, including its pending flushes."""
+    deadlines.cancel_room(room_code)
+    pending_syncs.discard(room_code)
+    for team_id in ('team1', 'team2'):
+        pending_votes.pop((room_code, team_id), None)
 
-    if action in host_only_actions and not is_host and not is_admin:
-        emit('error-msg', 'Only the host or an admin can perform this action.', to=request.sid)
+# Dragging cards produces a stream of votes; teammates get the changed counts a few times a second
+VOTE_UPDATE_INTERVAL = float(os.environ.get('VOTE_UPDATE_INTERVAL_MS', 150)) / 1000
+pending_votes = {}  # (room code, team id) -> positions whose count changed since the last vote-update
+
+def queue_vote_update(room, team_id, positions):
+    key = (room.code, team_id)
+    changed = pending_votes.get(key)
+    if changed is None:
+        changed = pending_votes[key] = set()
+        deadlines.set(room.code, ('vote-update', team_id), VOTE_UPDATE_INTERVAL, flush_vote_update, key)
+    changed.update(positions)
+
+def flush_vote_update(key):
+    room_code, team_id = key
+    changed = pending_votes.pop(key, ())
+    room = rooms.get(room_code)
+    if room is None:
         return
-    
-    if action in admin_only_actions and not is_admin:
-        emit('error-msg', 'Admin privileges required.', to=request.sid)
+    team = room.teams[team_id]
+    if not team.votes or not team.players:
+        return  # Placement already confirmed; the new round starts from zero
+    counts = team.tally.counts
+    # Absolute counts, so a dropped or late update never leaves a client off by one
+    sockets.emit('vote-update', {
+        'teamId': team_id,
+        'counts': [[pos, counts.get(pos, 0)] for pos in sorted(changed)],
+        'voteCount': len(team.votes)
+    }, to=list(team.players))
+
+@sockets.on('disconnect')
+@instrumented('disconnect')
+def handle_disconnect(reason=None):
+    sid = sockets.sid()
+    remove_player(sid)
+
+    if sid in admins:
+        admins.remove(sid)
+    msgpack_sids.discard(sid)
+
+# Seats in recovered rooms wait this long for their player to reconnect with rejoin-room
+RECOVERY_GRACE = int(os.environ.get('RECOVERY_GRACE', 90))
+unclaimed_seats = {}  # room_code -> sids from before the restart that haven't rejoined
+
+def recover_rooms():
+    started = time.monotonic()
+    recovered = rooms.recover()
+    if not recovered:
         return
-    
-    if action == 'start-game':
-        # Trigger ready phase for everyone to unlock audio
-        room['game_state'] = 'ready'
-        room['ready_players'] = set()
-        
-        # Reset game states early so UI reflects new game
-        room['active_team'] = 'team1'
-        room['turn_state'] = 'playing'
-        for t in room['teams'].values():
-            t['timeline'] = []
-            t['score'] = 0
-            t['tokens'] = 2
-            t['votes'] = {}
-        
-        sync_room_state(room_code)
-        emit('start-ready-phase', to=room_code)
+    for room in recovered:
+        unclaimed_seats[room.code] = set(room.players)
+    log.info("Recovered %d rooms in %.3fs", len(recovered), time.monotonic() - started)
 
-    elif action == 'player-ready':
-        room['ready_players'].add(request.sid)
-        ready_count = len(room['ready_players'])
-        total_players = len(room['players'])
-        
-        print(f"Player {request.sid} ready in {room_code}. Total: {ready_count}/{total_players}")
-        
-        if ready_count >= total_players:
-            # Everyone is ready! Start the actual game.
-            room['game_state'] = 'playing'
-            sync_room_state(room_code)
-            emit('game-started', to=room_code)
-        else:
-            # Update others on progress (optional but nice)
-            emit('ready-progress', {'readyCount': ready_count, 'totalPlayers': total_players}, to=room_code)
-
-    elif action == 'init-starter-cards':
-        room['teams']['team1']['timeline'] = [action_data['team1Song']]
-        room['teams']['team2']['timeline'] = [action_data['team2Song']]
-        # Add starter songs to history
-        if 'history' not in room: room['history'] = []
-        room['history'].extend([action_data['team1Song'], action_data['team2Song']])
-        sync_room_state(room_code)
-
-    elif action == 'play-song':
-        room['current_song'] = action_data
-        room['turn_state'] = 'playing'
-        room['current_placement'] = None
-        room['current_challenge'] = None
-        room['token_claimed'] = False # Reset for new song
-        
-        # Add to history
-        if 'history' not in room: room['history'] = []
-        room['history'].append(action_data)
-        
-        sync_room_state(room_code)
-        emit('new-song', {
-            'songData': action_data,
-            'activeTeam': room['active_team'],
-            'turnState': room['turn_state']
-        }, to=room_code)
-
-    elif action == 'submit-vote':
-        # Team member votes on a position
-        team_id = action_data.get('teamId')
-        pos = action_data.get('pos')
-        
-        room['teams'][team_id]['votes'][request.sid] = pos
-        emit('vote-update', {'teamId': team_id, 'votes': room['teams'][team_id]['votes']}, to=room_code)
-
-    elif action == 'reset-game':
-        room['game_state'] = 'lobby'
-        room['turn_state'] = 'playing'
-        room['active_team'] = 'team1'
-        room['current_song'] = None
-        room['current_placement'] = None
-        room['current_challenge'] = None
-        room['token_claimed'] = False
-        room['history'] = []
-        
-        # Reset teams but keep players
-        for t in room['teams'].values():
-            t['timeline'] = []
-            t['score'] = 0
-            t['tokens'] = 2
-            t['votes'] = {}
-        
-        sync_room_state(room_code)
-        emit('game-reset', to=room_code)
+    def release_unclaimed():
+        for room_code, sids in list(unclaimed_seats.items()):
+            with rooms.transaction(room_code) as room:
+                for sid in sids:
+                    # drop_player deletes the room along with its last seat
+                    if room is None or room_code not in rooms:
+                        break
+                    if sid in room.players:
+                        drop_player(room, sid)
+        unclaimed_seats.clear()
 
-    
-    elif action == 'confirm-placement':
-        # Team confirms their placement after voting
-        team_id = action_data.get('teamId')
-        team = room['teams'][team_id]
-        votes = team['votes']
-        
-        if not votes:
-            emit('error-msg', 'Er zijn nog geen stemmen!', to=request.sid)
-            return
-        
-        # Count votes per position
-        vote_counts = {}
-        for voter_sid, pos in votes.items():
-            vote_counts[pos] = vote_counts.get(pos, 0) + 1
-        
-        # Find max votes
-        max_votes = max(vote_counts.values())
-        top_positions = [pos for pos, count in vote_counts.items() if count == max_votes]
-        
-        # If tie, check Oracle
-        if len(top_positions) > 1 and team['oracle']:
-            oracle_vote = votes.get(team['oracle'])
-            if oracle_vote in top_positions:
-                # Oracle's vote wins the tie
-                winning_pos = oracle_vote
-            else:
-                # Oracle didn't vote for one of the ties, pick first
-                winning_pos = top_positions[0]
-        else:
-            winning_pos = top_positions[0]
-        
-        # Clear votes for next round
-        team['votes'] = {}
-        
-        # Now submit the actual placement
-        room['current_placement'] = {'teamId': team_id, 'pos': winning_pos}
-        room['turn_state'] = 'challenging'
-        emit('placement-submitted', {
-            'teamId': team_id,
-            'pos': winning_pos,
-            'turnState': room['turn_state']
-        }, to=room_code)
-
-    elif action == 'submit-placement':
-        # Direct placement (for single player teams or legacy)
-        room['current_placement'] = action_data # { teamId, pos }
-        room['turn_state'] = 'challenging'
-        emit('placement-submitted', {
-            'teamId': action_data.get('teamId'),
-            'pos': action_data.get('pos'),
-            'turnState': room['turn_state']
-        }, to=room_code)
-
-    elif action == 'submit-challenge':
-        # Opposing team challenges a placement
-        room['current_challenge'] = action_data # { teamId, pos }
-        emit('challenge-submitted', action_data, to=room_code)
-        
-        # Auto-reveal after challenge is submitted
-        # Use eventlet.spawn_after for a slight delay so clients receive the challenge-submitted first
-        def auto_reveal():
-            perform_reveal(room_code)
-        eventlet.spawn_after(1.5, auto_reveal)
-
-    elif action == 'skip-challenge':
-        # Opposing team skips the challenge - auto reveal
-        emit('challenge-skipped', action_data, to=room_code)
-        perform_reveal(room_code)
-
-    elif action == 'reveal-year':
-        # Host triggers reveal (manual backup)
-        perform_reveal(room_code)
-
-    elif action == 'set-target-score':
-        if room['host'] == request.sid:
-            room['target_score'] = int(action_data)
-            sync_room_state(room_code)
-
-    elif action == 'claim-token':
-        team_id = action_data.get('teamId')
-        
-        # Check if already claimed for this song
-        if room.get('token_claimed'):
-             emit('error-msg', 'Token al geclaimd voor dit nummer!', to=request.sid)
-             return
-
-        if room['teams'][team_id]['tokens'] < 5:
-            room['teams'][team_id]['tokens'] += 1
-            room['token_claimed'] = True
-            
-            # Announce to everyone that token was claimed
-            emit('token-claimed-announcement', {
-                'teamId': team_id,
-                'claimedBy': room['players'][request.sid]['name']
-            }, to=room_code)
-            
-            sync_room_state(room_code)
-        else:
-            emit('error-msg', 'Maximaal 5 tokens bereikt!', to=request.sid)
-
-    elif action == 'fetch-playlist':
-        url = action_data
-        tracks = fetch_spotify_playlist(url)
-        if tracks:
-            room['playlist_tracks'] = tracks
-            print(f"Loaded {len(tracks)} tracks for room {room_code}")
-            emit('playlist-loaded', {'count': len(tracks), 'tracks': tracks}, to=request.sid)
-            sync_room_state(room_code)
-        else:
-            emit('error-msg', "Kon geen nummers vinden in de Spotify playlist of playlist is niet publiek.", to=request.sid)
+    runtime.spawn_after(RECOVERY_GRACE, release_unclaimed)
 
-    elif action == 'set-playlist-tracks':
-        room['playlist_tracks'] = action_data
-        # We don't necessarily need to sync this to everyone, just store it in the room
-        print(f"Playlist updated for {room_code}")
+# Room lifecycle limits, so memory levels off on long-running containers
+ROOM_IDLE_TTL = int(os.environ.get('ROOM_IDLE_TTL', 3 * 3600))  # Seconds without any room write
+MAX_ROOMS = int(os.environ.get('MAX_ROOMS', 1000))
+REAPER_INTERVAL = int(os.environ.get('REAPER_INTERVAL', 60))
+Room.HISTORY_LIMIT = int(os.environ.get('HISTORY_LIMIT', 200))
+reaper_stats = {'idleEvicted': 0, 'lruEvicted': 0, 'bytes': 0, 'measuredAt': None}
 
-    elif action == 'set-oracle':
-        # Set the Oracle (Al-wetende) for a team
-        team_id = action_data.get('teamId')
-        oracle_sid = action_data.get('oracleSid')  # Can be None to remove
-        
-        if team_id not in room['teams']:
+def evict_room(room_code, message):
+    """Close a room whose sockets may be long gone: tell anyone left, then forget it."""
+    with rooms.transaction(room_code) as room:
+        if room is None:
             return
-        
-        team = room['teams'][team_id]
-        
-        # Validate: Oracle can only be set if team has even number of players
-        if oracle_sid:
-            if len(team['players']) % 2 != 0:
-                emit('error-msg', 'Al-wetende kan alleen worden ingesteld bij een even aantal spelers!', to=request.sid)
-                return
-            # Validate oracle is in team
-            if not any(p['sid'] == oracle_sid for p in team['players']):
-                emit('error-msg', 'Deze speler zit niet in het team!', to=request.sid)
-                return
-        
-        team['oracle'] = oracle_sid
-        sync_room_state(room_code)
+        sockets.emit('error-msg', message, to=room_code)
+        for sid in room.players:
+            if sid_index.get(sid) == room_code:
+                del sid_index[sid]
+        sockets.close_room(room_code)
+        unclaimed_seats.pop(room_code, None)
+        del rooms[room_code]
+        cancel_deadlines(room_code)
+    log.info("Evicted room", extra={'event': 'evict-room', 'room': room_code})
 
-    elif action == 'randomize-teams':
-        if room['host'] == request.sid:
-            # 1. Gather all players (sids)
-            all_sids = list(room['players'].keys())
-            
-            # 2. Shuffle
-            random.shuffle(all_sids)
-            
-            # 3. Clear existing team lists but keep stats
-            room['teams']['team1']['players'] = []
-            room['teams']['team2']['players'] = []
-            room['teams']['team1']['oracle'] = None
-            room['teams']['team2']['oracle'] = None
-            
-            # 4. Distribute
-            for i, sid in enumerate(all_sids):
-                player_name = room['players'][sid]['name']
-                
-                # Update player object
-                target_team = 'team1' if i % 2 == 0 else 'team2'
-                room['players'][sid]['team'] = target_team
-                
-                # Add to team list
-                room['teams'][target_team]['players'].append({'sid': sid, 'name': player_name})
-            
-            # 5. Sync
-            sync_room_state(room_code)
-
-@socketio.on('disconnect')
-def handle_disconnect():
-    for room_code, room in list(rooms.items()):
-        if request.sid in room['players']:
-            del room['players'][request.sid]
-            # Remove from teams
-            for team in room['teams'].values():
-                team['players'] = [p for p in team['players'] if p['sid'] != request.sid]
-            
-            # Delete room if empty
-            if not room['players']:
-                del rooms[room_code]
-            else:
-                # If host left, assign a new host
-                if room['host'] == request.sid:
-                    new_host_sid = next(iter(room['players']))
-                    room['host'] = new_host_sid
-                    print(f"Host left room {room_code}. New host: {room['players'][new_host_sid]['name']}")
-                
-                sync_room_state(room_code)
-            break
-            
-    if request.sid in admins:
-        admins.remove(request.sid)
+def room_stats():
+    return {
+        'count': len(rooms),
+        'max': MAX_ROOMS,
+        'idleTtl': ROOM_IDLE_TTL,
+        'bytes': reaper_stats['bytes'],  # As of the last reaper pass
+        'measuredAt': reaper_stats['measuredAt'],
+        'playlistBlobBytes': sum(len(blob[1]) + len(blob[2]) for blob in playlist_blobs.values()),
+        'idleEvicted': reaper_stats['idleEvicted'],
+        'lruEvicted': reaper_stats['lruEvicted']
+    }
+
+def reap_rooms():
+    """Background loop: close idle rooms and re-measure what the rest hold."""
+    while True:
+        runtime.sleep(REAPER_INTERVAL)
+        try:
+            for room_code in rooms.idle_codes(ROOM_IDLE_TTL):
+                evict_room(room_code, 'Deze party is gesloten wegens inactiviteit.')
+                reaper_stats['idleEvicted'] += 1
+            total = 0
+            for room in rooms.values():
+                total += room.footprint()
+                runtime.sleep(0)  # Measuring walks every object; let handlers run in between
+            reaper_stats['bytes'] = total
+            reaper_stats['measuredAt'] = time.time()
+        except Exception:
+            log.exception("Room reaper failed")
+
+# Prometheus scrape target. Live-state gauges are read here, so they cost nothing between scrapes.
+metrics.Gauge('tunetimeline_rooms', 'Rooms in the store', lambda: len(rooms))
+metrics.Gauge('tunetimeline_players', 'Players seated on this worker', lambda: len(sid_index))
+metrics.Gauge('tunetimeline_sockets', 'Connected Engine.IO sockets on this worker', sockets.socket_count)
+metrics.Gauge('tunetimeline_greenlets', 'Live greenlets (refreshed at most once a minute)', metrics.greenlet_count)
+metrics.Gauge('tunetimeline_upstream_circuit_open', 'Whether the upstream circuit breaker is open', lambda: {
+    (name,): int(client.circuit_open)
+    for name, client in (('itunes', itunes_upstream), ('spotify', spotify_upstream), ('preview', preview_upstream))
+}, ('upstream',))
+metrics.Gauge('tunetimeline_deadlines_pending', 'Room deadlines waiting to fire', lambda: deadlines.stats()['pending'])
+metrics.Gauge('tunetimeline_log_records_dropped', 'Log records dropped because the writer fell behind', lambda: log_handler.dropped)
+if runtime.ASYNCIO:
+    import asyncio
+    metrics.Gauge('tunetimeline_asyncio_tasks', 'Tasks on the asyncio loop', lambda: len(asyncio.all_tasks()))
+else:
+    import eventlet.hubs
+    metrics.Gauge('tunetimeline_hub_timers', 'Timers scheduled on the eventlet hub', lambda: eventlet.hubs.get_hub().get_timers_count())
+    metrics.Gauge('tunetimeline_hub_listeners', 'File descriptors the eventlet hub is waiting on',
+                  lambda: len(eventlet.hubs.get_hub().get_readers()) + len(eventlet.hubs.get_hub().get_writers()))
+
+@app.route('/metrics')
+def serve_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+load_playlist_cache()
+recover_rooms()
+runtime.spawn(deadlines.run)
+runtime.spawn(reap_rooms)
+runtime.spawn(metrics.watch_loop_lag, runtime.sleep)
 
 if __name__ == '__main__':
     # Use environment variable to toggle debug mode, default to False for safety
     is_debug = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
-    socketio.run(app, debug=is_debug, port=3000, host='0.0.0.0')
+    sockets.run('0.0.0.0', int(os.environ.get('PORT', 3000)), debug=is_debug)
@@ -0,0 +1,14 @@
+"""ASGI entry point: the server on asyncio instead of eventlet.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+Equivalent to SERVER_MODE=asyncio python app.py. Run a single worker:
+rooms live in process memory, as with eventlet.
+"""
+import os
+
+os.environ['SERVER_MODE'] = 'asyncio'  # Before app imports runtime
+
+import app  # noqa: E402
+
+application = app.sockets.asgi_app()
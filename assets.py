@@ -0,0 +1,145 @@
+"""Static assets built once at startup and served from memory.
+
+build() reads every file in public/ and gives each one a content-hashed
+alias (app.js -> app.3f9c1e2a7b4d.js). It rewrites index.html to point
+at those aliases and keeps identity, gzip and (with the brotli package)
+br variants of every text asset. Serving is then a dict lookup: the best
+encoding the client accepts, an ETag, and a 304 if it already has it.
+
+Hashed names never change content, so they are cached for a year as
+immutable. Every other path (index.html, the plain names) must be
+revalidated, which costs a 304 and no body once the client has it.
+"""
+import os
+import re
+import gzip
+import hashlib
+import logging
+import mimetypes
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+log = logging.getLogger('tunetimeline.assets')
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+# Local href/src references in index.html; absolute URLs (the Socket.IO CDN) don't match
+_REFERENCE = re.compile(r'''((?:href|src)=["'])(?![a-z]+:|//|/)([^"'?#]+)(?:\?[^"'#]*)?(["'])''')
+
+
+class Asset:
+    __slots__ = ('content_type', 'etag', 'variants')
+
+    def __init__(self, content_type, body):
+        self.content_type = content_type
+        self.etag = hashlib.sha256(body).hexdigest()[:16]  # Quoted, with the encoding appended, per response
+        self.variants = {'identity': body}  # encoding -> bytes
+        if content_type.startswith(COMPRESSIBLE) and len(body) > 256:
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(body, quality=11)
+            self.variants['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+
+    def etag_for(self, encoding):
+        return f'"{self.etag}"' if encoding == 'identity' else f'"{self.etag}-{encoding}"'
+
+    def matches(self, if_none_match):
+        """True if an If-None-Match header names any encoding of this content."""
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*':
+                return True
+            tag = tag.removeprefix('W/').strip('"')
+            if tag == self.etag or tag.rpartition('-')[0] == self.etag:
+                return True
+        return False
+
+
+def hashed_name(name, body):
+    root, ext = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(body).hexdigest()[:12]}{ext}"
+
+
+def accepted_encodings(header):
+    """Encodings named in an Accept-Encoding header with a non-zero q."""
+    accepted = set()
+    for part in (header or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticAssets:
+
+    def __init__(self, directory, index='index.html', watch=False):
+        self.directory = directory
+        self.index = index
+        self.watch = watch  # Rebuild when a file changes (development)
+        self.assets = {}  # url path -> Asset
+        self.aliases = {}  # plain name -> hashed name
+        self.immutable = frozenset()  # the hashed names
+        self._mtimes = {}
+        self.build()
+
+    def _scan(self):
+        return {
+            os.path.relpath(os.path.join(root, name), self.directory).replace(os.sep, '/'): os.path.getmtime(os.path.join(root, name))
+            for root, _, names in os.walk(self.directory) for name in names
+        }
+
+    def build(self):
+        mtimes = self._scan()
+        sources = {}
+        for name in mtimes:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                sources[name] = f.read()
+        assets, aliases = {}, {}
+        for name, body in sources.items():
+            if name == self.index:
+                continue
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            if content_type.startswith('text/'):
+                content_type += '; charset=utf-8'
+            aliases[name] = hashed_name(name, body)
+            assets[name] = assets[aliases[name]] = Asset(content_type, body)
+        if self.index in sources:
+            def rewrite(match):
+                return match.group(1) + aliases.get(match.group(2), match.group(2)) + match.group(3)
+            html = _REFERENCE.sub(rewrite, sources[self.index].decode()).encode()
+            assets[self.index] = Asset('text/html; charset=utf-8', html)
+        self.assets, self.aliases, self._mtimes = assets, aliases, mtimes
+        self.immutable = frozenset(aliases.values())
+        smallest = sum(min(len(body) for body in assets[name].variants.values()) for name in sources)
+        log.info("Built %d static assets: %d KB, %d KB compressed", len(sources),
+                 sum(map(len, sources.values())) // 1024, smallest // 1024)
+
+    def lookup(self, path, accept_encoding):
+        """(Asset, encoding, Cache-Control) for a URL path and Accept-Encoding header; Asset is None if unknown."""
+        if self.watch and self._scan() != self._mtimes:
+            self.build()
+        asset = self.assets.get(path)
+        if asset is None:
+            return None, None, None
+        cache_control = IMMUTABLE if path in self.immutable else REVALIDATE
+        accepted = accepted_encodings(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            if encoding in asset.variants and encoding in accepted:
+                return asset, encoding, cache_control
+        return asset, 'identity', cache_control
+
+    def stats(self):
+        """Bytes per encoding for index.html and each hashed asset."""
+        return {name: {encoding: len(body) for encoding, body in self.assets[name].variants.items()}
+                for name in [self.index, *self.aliases.values()] if name in self.assets}
@@ -0,0 +1,79 @@
+"""Song catalog benchmark: sampling speed and year spread against a random iTunes search.
+
+Usage: python bench/catalog_bench.py [--songs 50000] [--samples 20000]
+
+Fills a throwaway SQLite catalog with synthetic iTunes results whose years
+are skewed towards recent releases (as real search results are). Then it
+reports:
+
+    add      ingest rate of add_itunes() (memory only; SQLite writes are off-loop)
+    random   mean and p99 time per random() call, with and without an exclude list
+    reload   time to load the catalog back from SQLite, as at startup
+    spread   share of samples per decade, catalog vs picking a random result
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from catalog import SongCatalog  # noqa: E402
+
+
+def synthetic_results(count, rng):
+    # Recent years dominate, like a genre search on iTunes
+    for i in range(count):
+        year = int(2025 - rng.expovariate(1 / 12)) if rng.random() < 0.97 else rng.randint(1950, 2025)
+        yield {
+            'trackId': i + 1,
+            'trackName': f"Song {i}",
+            'artistName': f"Artist {i % 5000}",
+            'releaseDate': f"{max(year, 1950)}-06-01T00:00:00Z",
+            'previewUrl': f"https://audio.example/{i}.m4a"
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=50000)
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'catalog.db')
+        catalog = SongCatalog(path, flush_interval=0, rng=rng)
+        results = list(synthetic_results(args.songs, rng))
+        started = time.perf_counter()
+        catalog.add_itunes(results)
+        elapsed = time.perf_counter() - started
+        print(f"add      {len(catalog)} songs in {elapsed * 1000:.1f} ms ({len(catalog) / elapsed:,.0f}/s)")
+
+        for label, exclude in (('random', set()), ('random -100', set(rng.sample(range(1, args.songs), 100)))):
+            samples = []
+            for _ in range(args.samples):
+                started = time.perf_counter()
+                catalog.random(exclude=exclude)
+                samples.append(time.perf_counter() - started)
+            samples.sort()
+            print(f"{label:<12} mean {sum(samples) / len(samples) * 1e6:.2f} us   p99 {samples[int(len(samples) * 0.99)] * 1e6:.2f} us")
+
+        catalog.flush()
+        started = time.perf_counter()
+        reloaded = SongCatalog(path)
+        print(f"reload   {len(reloaded)} songs in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+        picked = Counter(catalog.random()['year'] // 10 * 10 for _ in range(args.samples))
+        searched = Counter(int(rng.choice(results)['releaseDate'][:4]) // 10 * 10 for _ in range(args.samples))
+        print(f"{'decade':>6} {'catalog':>8} {'search':>8}")
+        for decade in sorted(set(picked) | set(searched)):
+            print(f"{decade:>6} {picked[decade] / args.samples:>8.1%} {searched[decade] / args.samples:>8.1%}")
+
+
+if __name__ == '__main__':
+    main()
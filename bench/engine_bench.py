@@ -0,0 +1,148 @@
+"""Game-engine microbenchmark: deterministic simulated turns, no server, no sockets.
+
+Usage: python bench/engine_bench.py [--turns 1000000] [--players 4] [--seed 1] [--sync] [--profile]
+
+Every turn runs play-song, one submit-vote per active-team player,
+confirm-placement, sometimes a claim-token, and then either
+submit-challenge (followed by the reveal the server would schedule) or
+skip-challenge. Votes are often split evenly, so the oracle tie-break
+runs. Challengers sometimes pick the correct slot, so steals happen. A
+finished game is reset and a new one started. --sync also builds the wire state and JSON-patch delta for every
+room-update, the way sync_room_state() does, to include that cost.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import cProfile
+import pstats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import engine  # noqa: E402
+from models import Player, Room  # noqa: E402
+from patches import json_diff  # noqa: E402
+
+
+class Simulation:
+    def __init__(self, players, seed, sync):
+        self.rng = random.Random(seed)
+        self.sync = sync
+        self.room = Room('BENCH', 'p0')
+        self.timings = {}  # action -> [calls, total ns]
+        self.counts = {'turns': 0, 'games': 0, 'challenges': 0, 'steals': 0, 'oracleTies': 0}
+        self.song_no = 0
+        for i in range(players):
+            self.room.add_player(Player(f"p{i}", f"Speler {i}"))
+            self.room.assign_team(f"p{i}", 'team1' if i % 2 == 0 else 'team2')
+        self.members = {team_id: list(team.players) for team_id, team in self.room.teams.items()}
+        for team_id, sids in self.members.items():
+            if len(sids) % 2 == 0:
+                self.act('p0', 'set-oracle', {'teamId': team_id, 'oracleSid': sids[0]})
+        self.new_game()
+
+    def song(self):
+        self.song_no += 1
+        return {'title': f"Song {self.song_no}", 'artist': f"Artist {self.song_no % 211}",
+                'year': self.rng.randint(1950, 2024), 'url': f"https://audio.example/{self.song_no}.m4a"}
+
+    def act(self, sid, action, data=None):
+        started = time.perf_counter_ns()
+        outcome = engine.apply_action(self.room, sid, action, data, rng=self.rng)
+        self.finish(action, started, outcome)
+        return outcome
+
+    def finish(self, action, started, outcome):
+        if self.sync:
+            for event, _, _ in outcome.events:
+                if event == engine.SYNC:
+                    state = self.room.to_wire()
+                    if self.room.wire_state is not None:
+                        json_diff(self.room.wire_state, state)
+                    self.room.wire_state = state
+        timing = self.timings.setdefault(action, [0, 0])
+        timing[0] += 1
+        timing[1] += time.perf_counter_ns() - started
+
+    def new_game(self):
+        self.counts['games'] += 1
+        self.act('p0', 'reset-game')
+        self.act('p0', 'start-game')
+        for sid in self.room.players:
+            self.act(sid, 'player-ready')
+        self.act('p0', 'init-starter-cards', {'team1Song': self.song(), 'team2Song': self.song()})
+
+    def turn(self):
+        room, rng = self.room, self.rng
+        active = room.active_team
+        other = room.other_team(active)
+        self.act('p0', 'play-song', self.song())
+
+        slots = len(room.teams[active].timeline) + 1
+        voters = self.members[active]
+        if len(voters) > 1 and rng.random() < 0.5:
+            # Even split between two slots: the oracle (first voter) breaks the tie
+            picks = rng.sample(range(slots), 2) if slots > 1 else [0, 0]
+            votes = [picks[i % 2] for i in range(len(voters))]
+            self.counts['oracleTies'] += len(voters) % 2 == 0
+        else:
+            votes = [rng.randrange(slots) for _ in voters]
+        for sid, pos in zip(voters, votes):
+            self.act(sid, 'submit-vote', {'teamId': active, 'pos': pos})
+        self.act(voters[0], 'confirm-placement', {'teamId': active})
+
+        challenger = self.members[other][0]
+        if rng.random() < 0.3:
+            self.act(challenger, 'claim-token', {'teamId': other})
+        if room.teams[other].tokens > 0 and rng.random() < 0.4:
+            self.counts['challenges'] += 1
+            correct = room.teams[active].timeline.correct_pos(room.current_song.year)
+            pos = correct if rng.random() < 0.5 else rng.randrange(slots)
+            self.act(challenger, 'submit-challenge', {'teamId': other, 'pos': pos})
+            started = time.perf_counter_ns()
+            outcome = engine.expire(room, 'reveal')  # The server runs this when the reveal deadline is due
+            self.finish('reveal', started, outcome)
+        else:
+            outcome = self.act(challenger, 'skip-challenge', {'teamId': other})
+        results = outcome.events[-1][1]
+        self.counts['steals'] += results['results']['stolen']
+        self.counts['turns'] += 1
+        if results['winner']:
+            self.new_game()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--turns', type=int, default=1_000_000)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--sync', action='store_true', help='also build wire state and deltas per room-update')
+    parser.add_argument('--profile', action='store_true', help='print the top functions by cumulative time')
+    args = parser.parse_args()
+    if args.players < 2:
+        parser.error('--players must be at least 2 (one per team)')
+
+    sim = Simulation(args.players, args.seed, args.sync)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    started = time.perf_counter()
+    for _ in range(args.turns):
+        sim.turn()
+    elapsed = time.perf_counter() - started
+    if profiler:
+        profiler.disable()
+
+    actions = sum(calls for calls, _ in sim.timings.values())
+    print(f"{args.turns} turns in {elapsed:.2f}s: {args.turns / elapsed:,.0f} turns/s, {actions / elapsed:,.0f} actions/s")
+    print(', '.join(f"{key} {value}" for key, value in sim.counts.items()))
+    print(f"{'action':<20} {'calls':>10} {'mean us':>9}")
+    for action, (calls, total) in sorted(sim.timings.items(), key=lambda item: -item[1][1]):
+        print(f"{action:<20} {calls:>10} {total / calls / 1000:>9.2f}")
+    if profiler:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+
+if __name__ == '__main__':
+    main()
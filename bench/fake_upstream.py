@@ -0,0 +1,138 @@
+"""Offline stand-in for the iTunes search API and Spotify playlist embeds.
+
+Serves deterministic data, so load tests need no network and produce the
+same songs on every run:
+
+    GET /search?term=...&limit=...   iTunes-shaped search results
+    GET /embed/playlist/<id>         embed page with a __NEXT_DATA__ trackList
+    GET /preview/<name>.m4a          PREVIEW_SIZE bytes of stand-in audio, paced
+                                     to `bandwidth` bytes/s shared by all clips
+
+Point the app at it with
+    ITUNES_SEARCH_URL=http://127.0.0.1:<port>/search
+    SPOTIFY_EMBED_URL=http://127.0.0.1:<port>/embed/playlist/
+
+Run standalone with `python bench/fake_upstream.py --port 8099`, or use
+start() to run it on a background thread.
+"""
+import json
+import time
+import zlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PLAYLIST_SIZE = 300
+PREVIEW_SIZE = 512 * 1024  # About a 30 second AAC clip
+PREVIEW_CHUNK = 16 * 1024
+
+
+def search_results(term, limit):
+    seed = zlib.crc32(term.encode())
+    return [{
+        'trackId': seed % 100000 * 1000 + i,
+        'trackName': f"{term} #{i}",
+        'artistName': f"Artist {seed % 997}",
+        'releaseDate': f"{1950 + (seed + i * 7) % 75}-01-01T00:00:00Z",
+        'previewUrl': f"https://audio.example/{seed}/{i}.m4a"
+    } for i in range(limit)]
+
+
+def playlist_page(playlist_id, size=PLAYLIST_SIZE):
+    track_list = [{'title': f"Track {i}", 'subtitle': f"Band {i % 150}"} for i in range(size)]
+    data = {'props': {'pageProps': {'state': {'data': {'entity': {'name': playlist_id, 'trackList': track_list}}}}}}
+    return f'<html><body><script id="__NEXT_DATA__" type="application/json">{json.dumps(data)}</script></body></html>'
+
+
+class Link:
+    """One shared uplink: every chunk written through it waits for its share of `bandwidth`."""
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth  # bytes/s, None for unlimited
+        self.sent = 0
+        self._lock = threading.Lock()
+        self._free_at = 0.0
+
+    def send(self, wfile, chunk):
+        if self.bandwidth:
+            with self._lock:
+                done = self._free_at = max(time.monotonic(), self._free_at) + len(chunk) / self.bandwidth
+            time.sleep(max(0.0, done - time.monotonic()))
+        wfile.write(chunk)
+        with self._lock:
+            self.sent += len(chunk)
+
+
+class Handler(BaseHTTPRequestHandler):
+    delay = 0.0  # Seconds added to every response, to mimic a slow upstream
+    link = Link(None)  # Carries the preview clips
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real upstreams
+    disable_nagle_algorithm = True  # Headers and body are separate writes
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if self.delay:
+            time.sleep(self.delay)
+        if url.path == '/search':
+            query = parse_qs(url.query)
+            term = query.get('term', [''])[0]
+            limit = min(int(query.get('limit', ['10'])[0]), 200)
+            results = search_results(term, limit)
+            self._send(200, 'application/json', json.dumps({'resultCount': len(results), 'results': results}))
+        elif url.path.startswith('/embed/playlist/'):
+            self._send(200, 'text/html', playlist_page(url.path.rsplit('/', 1)[-1]))
+        elif url.path.startswith('/preview/'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mp4')
+            self.send_header('Content-Length', str(PREVIEW_SIZE))
+            self.end_headers()
+            chunk = bytes(PREVIEW_CHUNK)
+            for _ in range(PREVIEW_SIZE // PREVIEW_CHUNK):
+                self.link.send(self.wfile, chunk)
+        else:
+            self._send(404, 'text/plain', 'not found')
+
+    def _send(self, status, content_type, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port=0, delay=0.0, bandwidth=None):
+    """Serve on a daemon thread; returns the server (server.server_port has the port).
+
+    server.RequestHandlerClass.link.sent counts the preview bytes sent.
+    """
+    handler = type('DelayedHandler', (Handler,), {'delay': delay, 'link': Link(bandwidth)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def env_for(server):
+    """Environment variables that point app.py at this server."""
+    base = f"http://127.0.0.1:{server.server_port}"
+    return {'ITUNES_SEARCH_URL': f"{base}/search", 'SPOTIFY_EMBED_URL': f"{base}/embed/playlist/"}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake iTunes/Spotify upstream for offline load tests')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--delay-ms', type=float, default=0)
+    args = parser.parse_args()
+    server = start(args.port, args.delay_ms / 1000)
+    for key, value in env_for(server).items():
+        print(f"{key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
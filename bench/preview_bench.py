@@ -0,0 +1,150 @@
+"""Preview cache benchmark: a room of N players starting the same clip.
+
+Usage: python bench/preview_bench.py [--players 1,5,10,20] [--bandwidth-kbps 2000] [--mode eventlet]
+
+Starts bench/fake_upstream.py with its preview clips behind one shared
+link of --bandwidth-kbps, standing in for the way out to Apple, and a
+fresh app.py. Every player then requests the same 512 KiB clip at once,
+the way phones do on new-song, in three ways:
+
+    direct     each player streams the clip from the upstream (as before)
+    new-song   each player requests /api/preview/<id> the moment new-song
+               arrives; the server started the download when it sent it
+    warmed     the clip was fetched ahead of time, as the next song in the
+               deck is
+
+Reports the time until each player has the first 64 KiB (enough to start
+playing; p50 and max over the room), the time until all have the whole
+clip, and the bytes pulled through the upstream link. Players reach the
+server over loopback, as they would an on-site server on the venue LAN.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import threading
+
+import requests
+import socketio
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fake_upstream  # noqa: E402
+import socket_load  # noqa: E402
+
+START_BYTES = 64 * 1024
+CACHE_DIR = os.path.join(socket_load.ROOT, 'bench_preview_cache')
+
+
+def fetch_all(urls):
+    """Fetch every url concurrently; returns (seconds to START_BYTES per fetch, seconds until all finished)."""
+    started = time.perf_counter()
+    first = [None] * len(urls)
+    barrier = threading.Barrier(len(urls))
+
+    def fetch(i, url):
+        barrier.wait()
+        with requests.get(url, stream=True, headers={'Range': 'bytes=0-'}, timeout=60) as r:
+            r.raise_for_status()
+            received = 0
+            for chunk in r.iter_content(16 * 1024):
+                received += len(chunk)
+                if first[i] is None and received >= START_BYTES:
+                    first[i] = time.perf_counter() - started
+
+    threads = [threading.Thread(target=fetch, args=(i, url)) for i, url in enumerate(urls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(first), time.perf_counter() - started
+
+
+class Host:
+    """One socket in its own room, dealing songs so the server hands out preview paths."""
+
+    def __init__(self, url):
+        self.client = socketio.Client(reconnection=False)
+        self.room = threading.Event()
+        self.song = threading.Event()
+        self.code = self.preview = None
+        self.client.on('room-created', self._created)
+        self.client.on('new-song', self._new_song)
+        self.client.connect(url, transports=['websocket'])
+        self.client.emit('create-room', 'Bench')
+        if not self.room.wait(10):
+            raise SystemExit('create-room got no answer')
+
+    def _created(self, data):
+        self.code = data['roomCode']
+        self.room.set()
+
+    def _new_song(self, data):
+        self.preview = data.get('preview')
+        self.song.set()
+
+    def play(self, clip_url):
+        self.song.clear()
+        self.client.emit('game-action', {'roomCode': self.code, 'action': 'play-song',
+                                         'data': {'title': clip_url, 'artist': 'Bench', 'year': 2000, 'url': clip_url}})
+        if not self.song.wait(10) or not self.preview:
+            raise SystemExit('new-song came without a preview; is PREVIEW_HOSTS set?')
+        return self.preview
+
+
+def wait_cached(base):
+    while True:
+        stats = requests.get(f"{base}/api/stats", timeout=5).json()['previews']
+        if not stats['inflight']:
+            return
+        time.sleep(0.02)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', default='1,5,10,20')
+    parser.add_argument('--bandwidth-kbps', type=float, default=2000, help='shared upstream link, KB/s')
+    parser.add_argument('--mode', choices=('eventlet', 'asyncio'), default='eventlet')
+    parser.add_argument('--server-log', default='bench_server.log')
+    args = parser.parse_args()
+
+    upstream = fake_upstream.start(bandwidth=args.bandwidth_kbps * 1024)
+    link = upstream.RequestHandlerClass.link
+    origin = f"http://127.0.0.1:{upstream.server_port}"
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    os.environ.update(PREVIEW_HOSTS='127.0.0.1', PREVIEW_CACHE_DIR=CACHE_DIR)
+    port = socket_load.free_port()
+    server = socket_load.start_server(port, upstream, os.path.abspath(args.server_log), args.mode)
+    base = f"http://127.0.0.1:{port}"
+    clip = 0
+    try:
+        host = Host(base)
+        print(f"{fake_upstream.PREVIEW_SIZE // 1024} KiB clip, upstream link {args.bandwidth_kbps:.0f} KB/s")
+        print(f"{'players':>7} {'way':<9} {'start p50':>10} {'start max':>10} {'all done':>9} {'upstream KiB':>13}")
+        for players in (int(n) for n in args.players.split(',')):
+            for way in ('direct', 'new-song', 'warmed'):
+                clip += 1
+                clip_url = f"{origin}/preview/{clip}.m4a"
+                sent = link.sent
+                if way == 'direct':
+                    urls = [clip_url] * players
+                else:
+                    path = host.play(clip_url)
+                    if way == 'warmed':
+                        wait_cached(base)
+                    urls = [base + path] * players
+                first, done = fetch_all(urls)
+                print(f"{players:>7} {way:<9} {first[len(first) // 2] * 1000:8.0f}ms {first[-1] * 1000:8.0f}ms"
+                      f" {done * 1000:7.0f}ms {(link.sent - sent) // 1024:>13,}")
+        host.client.disconnect()
+    finally:
+        server.terminate()
+        server.wait(10)
+        upstream.shutdown()
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Room journal benchmark: on-loop record() cost and startup recovery time.
+
+Usage: python bench/recovery_bench.py [--rooms 10,100,1000] [--events 20,200,1000]
+
+Each room gets four players and a stream of typical mutations (votes,
+songs, scores), all written through RoomJournal. Recovery is timed on a
+fresh journal over the same directory, including rebuilding Room objects.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from journal import RoomJournal  # noqa: E402
+from models import Player, Room, Song  # noqa: E402
+
+
+def make_room(code):
+    room = Room(code, f"{code}-p0")
+    for i in range(4):
+        player = Player(f"{code}-p{i}", f"Speler {i}")
+        room.add_player(player)
+        player.team = 'team1' if i % 2 == 0 else 'team2'
+        room.teams[player.team].add_player(player)
+    room.game_state = 'playing'
+    return room
+
+
+def mutate(room, step):
+    team = room.teams[room.active_team]
+    kind = step % 4
+    if kind == 0:
+        song = Song(f"Song {step}", f"Artist {step % 97}", random.randint(1950, 2024), f"https://x/{step}.m4a")
+        room.current_song = song
+        room.add_history(song)
+    elif kind == 1:
+        team.set_vote(next(iter(team.players)), random.randint(0, len(team.timeline)))
+    elif kind == 2:
+        room.current_placement = {'teamId': room.active_team, 'pos': 0}
+        room.turn_state = 'challenging'
+    else:
+        if room.current_song:
+            team.timeline.insert(room.current_song)
+            team.score += 1
+        team.clear_votes()
+        room.current_placement = None
+        room.turn_state = 'playing'
+        room.active_team = room.other_team(room.active_team)
+        room.version += 1
+
+
+def run(num_rooms, events, snapshot_every):
+    directory = tempfile.mkdtemp(prefix='tt-journal-')
+    try:
+        journal = RoomJournal(directory, snapshot_every=snapshot_every, flush_interval=0)
+        rooms = [make_room(f"R{i:04d}") for i in range(num_rooms)]
+        for room in rooms:
+            journal.record(room)
+
+        record_time = 0.0
+        for step in range(events):
+            for room in rooms:
+                mutate(room, step)
+                started = time.perf_counter()
+                journal.record(room)
+                record_time += time.perf_counter() - started
+        journal.flush()
+        disk = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory) if '.' in f)
+
+        started = time.perf_counter()
+        recovered = RoomJournal(directory, snapshot_every=snapshot_every).recover()
+        restored = {code: Room.from_dict(data) for code, data in recovered.items()}
+        recovery = time.perf_counter() - started
+
+        for room in rooms:
+            assert restored[room.code].to_wire() == room.to_wire(), room.code
+        return record_time / (num_rooms * events) * 1e6, recovery, disk
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', default='10,100,1000')
+    parser.add_argument('--events', default='20,200,1000')
+    parser.add_argument('--snapshot-every', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'rooms':>6} {'events/room':>12} {'record us':>10} {'recovery s':>11} {'disk KiB':>9}")
+    for num_rooms in map(int, args.rooms.split(',')):
+        for events in map(int, args.events.split(',')):
+            random.seed(1)
+            per_event, recovery, disk = run(num_rooms, events, args.snapshot_every)
+            print(f"{num_rooms:>6} {events:>12} {per_event:>10.1f} {recovery:>11.3f} {disk / 1024:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Runtime benchmark: the same socket load against SERVER_MODE=eventlet and asyncio.
+
+Usage: python bench/runtime_bench.py [--rooms 20] [--players 4] [--rounds 6] [--upstream-delay-ms 0]
+
+Runs bench/socket_load.py twice with one workload: first on eventlet, then
+under uvicorn with the asyncio runtime. Prints the full asyncio report
+with deltas against eventlet, covering per-action latency, throughput,
+RSS, CPU and startup time. --upstream-delay-ms makes every iTunes/Spotify
+call slow, which shows how each runtime copes with many parked requests.
+"""
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import socket_load  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=6)
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for each response')
+    parser.add_argument('--upstream-delay-ms', type=float, default=0)
+    parser.add_argument('--server-log', default='bench_server.log')
+    args = parser.parse_args()
+
+    results = {}
+    for mode in ('eventlet', 'asyncio'):
+        args.mode = mode
+        results[mode] = socket_load.run(args)
+    socket_load.print_report(results['eventlet'])
+    print()
+    socket_load.print_report(results['asyncio'], results['eventlet'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Deadline benchmark: one eventlet.spawn_after per timer vs the Scheduler.
+
+Usage: python bench/scheduler_bench.py [--rooms 5000] [--delay 1.0]
+
+Every room gets a turn timeout, then moves it twice (what a turn does at
+each step) and sets an auto-reveal. Rooms fall due spread over `delay`
+to 2 x `delay` seconds, as real rooms never all time out in the same
+millisecond. With spawn_after, a moved timeout can't be replaced, so the
+old ones stay pending until they fire and return early. The Scheduler
+replaces them in place. Reports the cost per set, the greenlets and
+memory held while the timers are pending, and how late the callbacks run
+once they are due.
+
+With very many rooms the setup itself runs into the firing window, so
+both sides run late there; spawn_after the most.
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import os  # noqa: E402
+import gc  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+import argparse  # noqa: E402
+import tracemalloc  # noqa: E402
+
+import greenlet  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from scheduler import Scheduler  # noqa: E402
+
+KINDS = ('turn', 'turn', 'turn', 'reveal')  # Three steps of one turn timeout, then the reveal
+
+
+def greenlets():
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, greenlet.greenlet))
+
+
+def measure(label, schedule, rooms, delay):
+    lateness = []
+    live = {}  # (room, kind) -> scheduled at, so only the latest timer per kind counts
+
+    def fire(room, kind):
+        due = live.get((room, kind))
+        if due is not None and time.monotonic() >= due:
+            del live[(room, kind)]
+            lateness.append(time.monotonic() - due)
+
+    before = greenlets()
+    tracemalloc.start()
+    started = time.perf_counter()
+    for room in range(rooms):
+        seconds = delay * (1 + room / rooms)
+        for kind in KINDS:
+            live[(room, kind)] = time.monotonic() + seconds
+            schedule(room, kind, seconds, fire)
+    elapsed = time.perf_counter() - started
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    pending = greenlets() - before
+    eventlet.sleep(delay * 2.5)
+    lateness.sort()
+    p99 = lateness[int(len(lateness) * 0.99)] if lateness else float('nan')
+    print(f"{label:<12} {elapsed / (rooms * len(KINDS)) * 1e6:6.2f} us/set  {pending:>7,} greenlets"
+          f"  {held / 2**20:6.1f} MiB held  p99 late {p99 * 1000:6.1f} ms  ({len(lateness):,} fired)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=5000)
+    parser.add_argument('--delay', type=float, default=1.0)
+    args = parser.parse_args()
+
+    measure('spawn_after', lambda room, kind, delay, fn: eventlet.spawn_after(delay, fn, room, kind), args.rooms, args.delay)
+    scheduler = Scheduler()
+    eventlet.spawn(scheduler.run)
+    eventlet.sleep(0)
+    measure('scheduler', lambda room, kind, delay, fn: scheduler.set(room, kind, delay, fn, room, kind), args.rooms, args.delay)
+
+
+if __name__ == '__main__':
+    main()
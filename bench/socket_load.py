@@ -0,0 +1,360 @@
+"""Socket.IO load test: R rooms x P players playing full turns against app.py.
+
+Starts bench/fake_upstream.py and a fresh `python app.py` on a free port.
+Then every room runs the same scripted game concurrently:
+
+    create-room, join-room, join-team, start-game, player-ready,
+    init-starter-cards, then per round: play-song, submit-vote (each
+    active-team player), confirm-placement, and either submit-challenge
+    or skip-challenge on alternating rounds.
+
+Each action is timed from emit until the acting client receives the event
+it causes. That is the room-update for membership changes, and
+year-revealed for skip-challenge. submit-challenge is timed to
+challenge-submitted, because its reveal follows a deliberate 1.5s delay.
+The output has p50/p95/p99 per action, actions/s, the server's startup
+time (until it accepts connections), RSS and CPU time. --mode asyncio runs
+the server with SERVER_MODE=asyncio (see runtime.py).
+
+    python bench/socket_load.py --rooms 20 --players 4 --rounds 6 --out results.json
+    python bench/socket_load.py --compare results.json     # same workload, diff vs a saved run
+    python bench/socket_load.py --mode asyncio --compare results.json
+
+The workload depends only on the arguments, so runs on different commits
+compare like for like.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import platform
+import threading
+import subprocess
+
+import socketio
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fake_upstream  # noqa: E402
+
+ROOT = os.path.dirname(HERE)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}  # action -> [seconds]
+        self.errors = {}  # action -> count
+
+    def add(self, action, seconds):
+        with self.lock:
+            self.samples.setdefault(action, []).append(seconds)
+
+    def error(self, action):
+        with self.lock:
+            self.errors[action] = self.errors.get(action, 0) + 1
+
+    def summary(self):
+        result = {}
+        for action, values in sorted(self.samples.items()):
+            values = sorted(values)
+            result[action] = {
+                'count': len(values),
+                'p50': percentile(values, 50) * 1000,
+                'p95': percentile(values, 95) * 1000,
+                'p99': percentile(values, 99) * 1000,
+                'max': values[-1] * 1000,
+                'errors': self.errors.get(action, 0)
+            }
+        for action, count in self.errors.items():
+            result.setdefault(action, {'count': 0, 'errors': count})
+        return result
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))
+    return values[index]
+
+
+class Player:
+    """One python-socketio client that can time an emit until an expected event arrives."""
+
+    def __init__(self, url, name, stats, timeout):
+        self.name = name
+        self.stats = stats
+        self.timeout = timeout
+        self.waiters = {}  # event -> [threading.Event, received_at, args, match]
+        self.lock = threading.Lock()
+        self.client = socketio.Client(reconnection=False)
+        self.client.on('*', self._on_event)
+        self.client.connect(url, transports=['websocket'])
+        self.sid = self.client.get_sid()
+
+    def _on_event(self, event, *args):
+        received = time.perf_counter()
+        with self.lock:
+            waiter = self.waiters.get(event)
+            if waiter and waiter[3] and not waiter[3](*args):
+                return  # An earlier event of this kind that was still in flight
+            self.waiters.pop(event, None)
+        if waiter:
+            waiter[1], waiter[2] = received, args
+            waiter[0].set()
+
+    def call(self, action, event, payload, expect, match=None):
+        waiter = [threading.Event(), None, None, match]
+        with self.lock:
+            self.waiters[expect] = waiter
+        started = time.perf_counter()
+        self.client.emit(event, payload)
+        if not waiter[0].wait(self.timeout):
+            with self.lock:
+                self.waiters.pop(expect, None)
+            self.stats.error(action)
+            return None
+        self.stats.add(action, waiter[1] - started)
+        return waiter[2][0] if waiter[2] else True
+
+    def action(self, room_code, action, data=None, expect='room-update', match=None):
+        return self.call(action, 'game-action', {'roomCode': room_code, 'action': action, 'data': data}, expect, match)
+
+    def close(self):
+        try:
+            self.client.disconnect()
+        except Exception:
+            pass
+
+
+def song(rng, label):
+    return {'title': f"Load {label}", 'artist': f"Artist {rng.randrange(500)}",
+            'year': rng.randint(1950, 2024), 'url': f"https://audio.example/{label}.m4a"}
+
+
+def play_room(index, url, args, stats, barrier):
+    rng = random.Random(index)
+    players = []
+    try:
+        for i in range(args.players):
+            players.append(Player(url, f"R{index}P{i}", stats, args.timeout))
+        barrier.wait()
+        host = players[0]
+        created = host.call('create-room', 'create-room', host.name, 'room-created')
+        if not created:
+            return
+        code = created['roomCode']
+        for player in players[1:]:
+            player.call('join-room', 'join-room', {'roomCode': code, 'userName': player.name}, 'room-update')
+        teams = {'team1': [], 'team2': []}
+        for i, player in enumerate(players):
+            team_id = 'team1' if i % 2 == 0 else 'team2'
+            teams[team_id].append(player)
+            player.call('join-team', 'join-team', {'roomCode': code, 'team': team_id}, 'room-update')
+
+        host.action(code, 'start-game', expect='start-ready-phase')
+        for player in players[:-1]:
+            player.action(code, 'player-ready', expect='ready-progress')
+        players[-1].action(code, 'player-ready', expect='game-started')
+        host.action(code, 'init-starter-cards', {
+            'team1Song': song(rng, f"{index}-s1"), 'team2Song': song(rng, f"{index}-s2")
+        })
+
+        active = 'team1'
+        for round_no in range(args.rounds):
+            other = 'team2' if active == 'team1' else 'team1'
+            host.action(code, 'play-song', song(rng, f"{index}-{round_no}"), expect='new-song')
+            for voted, player in enumerate(teams[active], 1):
+                # Vote updates are batched, so wait for the one that includes this vote
+                # Every timeline holds at least its starter card, so slots 0 and 1 always exist
+                player.action(code, 'submit-vote', {'teamId': active, 'pos': rng.randint(0, 1)},
+                              expect='vote-update', match=lambda update, voted=voted: update['voteCount'] >= voted)
+            teams[active][0].action(code, 'confirm-placement', {'teamId': active}, expect='placement-submitted')
+            challenger = teams[other][0]
+            if round_no % 2:
+                challenger.action(code, 'submit-challenge', {'teamId': other, 'pos': 0}, expect='challenge-submitted')
+                # Let the server's delayed auto-reveal land before the next song
+                waiter = [threading.Event(), None, None, None]
+                with challenger.lock:
+                    challenger.waiters['year-revealed'] = waiter
+                waiter[0].wait(args.timeout)
+            else:
+                challenger.action(code, 'skip-challenge', {'teamId': other}, expect='year-revealed')
+            active = other
+    except Exception as e:
+        stats.error(f"client: {type(e).__name__}")
+    finally:
+        for player in players:
+            player.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def proc_stats(pid):
+    """(RSS bytes, CPU seconds) of a process, from /proc."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        return rss, cpu
+    except (OSError, StopIteration, IndexError):
+        return 0, 0.0
+
+
+def start_server(port, upstream, log_path, mode='eventlet'):
+    env = dict(os.environ, PORT=str(port), FLASK_DEBUG='false', SERVER_MODE=mode,
+               PLAYLIST_CACHE_FILE=os.path.join(os.path.dirname(log_path), 'bench_playlist_cache.json'),
+               SONG_CATALOG_DB=os.path.join(os.path.dirname(log_path), 'bench_song_catalog.db'),
+               **fake_upstream.env_for(upstream))
+    # preview_bench.py points this at its own directory
+    env.setdefault('PREVIEW_CACHE_DIR', os.path.join(os.path.dirname(log_path), 'bench_preview_cache'))
+    log = open(log_path, 'w')
+    server = subprocess.Popen([sys.executable, 'app.py'], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.02)  # Fine enough to time startup
+    server.kill()
+    raise SystemExit(f"app.py did not start, see {log_path}")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    upstream = fake_upstream.start(delay=args.upstream_delay_ms / 1000)
+    port = free_port()
+    log_path = os.path.abspath(args.server_log)
+    launched = time.perf_counter()
+    server = start_server(port, upstream, log_path, args.mode)
+    startup = time.perf_counter() - launched
+    url = f"http://127.0.0.1:{port}"
+    stats = Stats()
+    peak_rss = [0]
+    sampling = threading.Event()
+
+    def sample_rss():
+        while not sampling.wait(0.25):
+            peak_rss[0] = max(peak_rss[0], proc_stats(server.pid)[0])
+
+    try:
+        rss_before, cpu_before = proc_stats(server.pid)
+        threading.Thread(target=sample_rss, daemon=True).start()
+        barrier = threading.Barrier(args.rooms + 1)
+        threads = [threading.Thread(target=play_room, args=(i, url, args, stats, barrier)) for i in range(args.rooms)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()  # Everyone connected; time the games only
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        sampling.set()
+        rss_after, cpu_after = proc_stats(server.pid)
+    finally:
+        server.terminate()
+        server.wait(10)
+        upstream.shutdown()
+
+    actions = stats.summary()
+    total = sum(a['count'] for a in actions.values())
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'rooms': args.rooms,
+            'players': args.players,
+            'rounds': args.rounds,
+            'upstreamDelayMs': args.upstream_delay_ms,
+            'mode': args.mode
+        },
+        'startup': startup,
+        'elapsed': elapsed,
+        'actionsPerSecond': total / elapsed if elapsed else 0,
+        'errors': sum(a['errors'] for a in actions.values()),
+        'rssBefore': rss_before,
+        'rssAfter': rss_after,
+        'rssPeak': max(peak_rss[0], rss_after),
+        'serverCpu': cpu_after - cpu_before,
+        'actions': actions
+    }
+
+
+def print_report(result, baseline=None):
+    def delta(now, then):
+        if not then:
+            return ''
+        return f" ({(now - then) / then * 100:+.0f}%)"
+
+    meta = result['meta']
+    print(f"rev {meta['revision']} ({meta.get('mode', 'eventlet')}): {meta['rooms']} rooms x {meta['players']} players,"
+          f" {meta['rounds']} rounds")
+    print(f"{'action':<20} {'n':>6} {'p50 ms':>14} {'p95 ms':>14} {'p99 ms':>14} {'err':>5}")
+    for action, s in result['actions'].items():
+        base = (baseline or {}).get('actions', {}).get(action, {})
+        if not s['count']:
+            print(f"{action:<20} {0:>6} {'-':>14} {'-':>14} {'-':>14} {s['errors']:>5}")
+            continue
+        cells = [f"{s[p]:.1f}{delta(s[p], base.get(p))}" for p in ('p50', 'p95', 'p99')]
+        print(f"{action:<20} {s['count']:>6} {cells[0]:>14} {cells[1]:>14} {cells[2]:>14} {s['errors']:>5}")
+    base = baseline or {}
+    print(f"throughput {result['actionsPerSecond']:.0f} actions/s{delta(result['actionsPerSecond'], base.get('actionsPerSecond'))}"
+          f" in {result['elapsed']:.2f}s, {result['errors']} errors")
+    print(f"server RSS {result['rssBefore'] / 2**20:.1f} -> {result['rssAfter'] / 2**20:.1f} MiB"
+          f" (peak {result['rssPeak'] / 2**20:.1f}{delta(result['rssPeak'], base.get('rssPeak'))}),"
+          f" CPU {result['serverCpu']:.2f}s{delta(result['serverCpu'], base.get('serverCpu'))}")
+    if 'startup' in result:
+        print(f"startup {result['startup'] * 1000:.0f} ms{delta(result['startup'], base.get('startup'))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=6)
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for each response')
+    parser.add_argument('--upstream-delay-ms', type=float, default=0)
+    parser.add_argument('--server-log', default='bench_server.log')
+    parser.add_argument('--mode', choices=('eventlet', 'asyncio'), default='eventlet', help='SERVER_MODE for app.py')
+    parser.add_argument('--out', help='write the results as JSON')
+    parser.add_argument('--compare', help='JSON from an earlier --out run; its workload is reused')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for key in ('rooms', 'players', 'rounds'):
+            setattr(args, key, baseline['meta'][key])
+        args.upstream_delay_ms = baseline['meta'].get('upstreamDelayMs', 0)
+    if args.players < 2:
+        parser.error('--players must be at least 2 (one per team)')
+
+    result = run(args)
+    print_report(result, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
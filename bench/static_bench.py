@@ -0,0 +1,83 @@
+"""Static asset benchmark: send_from_directory vs the precompressed in-memory build.
+
+Usage: python bench/static_bench.py [--repeat 500]
+
+Requests index.html, app.js and styles.css through Flask's test client, in
+two ways: the old send_from_directory route, and app.send_asset(). It does
+this for a first visit (empty cache, Accept-Encoding: gzip, br) and a
+repeat visit, where the browser revalidates with If-None-Match. The old
+route sent every file uncompressed, and a repeat visit revalidated all
+three. The new route revalidates index.html only, because the hashed
+assets it links to are immutable and stay in the browser cache.
+
+Reports the mean handler time per page load and the bytes sent.
+"""
+import os
+import sys
+import time
+import argparse
+
+os.environ.setdefault('PLAYLIST_CACHE_FILE', os.devnull)
+os.environ.setdefault('SONG_CATALOG_DB', ':memory:')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+from flask import Flask, send_from_directory  # noqa: E402
+
+ACCEPT = {'Accept-Encoding': 'gzip, deflate, br'}
+OLD_ETAGS = {}
+
+
+def old_page(client, etags=None):
+    sent = 0
+    for path in ('/', '/app.js', '/styles.css'):
+        headers = dict(ACCEPT, **{'If-None-Match': etags[path]}) if etags is not None else ACCEPT
+        response = client.get(path, headers=headers)
+        sent += len(response.get_data())
+        if etags is None:
+            OLD_ETAGS[path] = response.headers['ETag']
+    return sent
+
+
+def new_first_visit(client, etags):
+    sent = 0
+    response = client.get('/', headers=ACCEPT)
+    sent += len(response.get_data())
+    etags['/'] = response.headers['ETag']
+    for path in app.static_assets.aliases.values():
+        sent += len(client.get('/' + path, headers=ACCEPT).get_data())
+    return sent
+
+
+def new_repeat_visit(client, etags):
+    return len(client.get('/', headers=dict(ACCEPT, **{'If-None-Match': etags['/']})).get_data())
+
+
+def measure(label, page, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        sent = page()
+    elapsed = (time.perf_counter() - started) / repeat
+    print(f"{label:<28} {elapsed * 1000:7.3f} ms/page   {sent:>7,} bytes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    # The pre-change routes, on a separate app so they don't shadow send_asset()
+    old = Flask('old', static_folder='public', static_url_path='', root_path=app.app.root_path)
+    old.add_url_rule('/', 'index', lambda: send_from_directory(old.static_folder, 'index.html'))
+    old_client = old.test_client()
+    new_client = app.app.test_client()
+    etags = {}
+
+    measure('old, first visit', lambda: old_page(old_client), args.repeat)
+    measure('old, repeat visit', lambda: old_page(old_client, OLD_ETAGS), args.repeat)
+    measure('precompressed, first visit', lambda: new_first_visit(new_client, etags), args.repeat)
+    measure('precompressed, repeat visit', lambda: new_repeat_visit(new_client, etags), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Wire-format benchmark: JSON vs MessagePack for the payloads the server broadcasts.
+
+Usage: python bench/wire_bench.py [--players 4,12,24] [--turns 10,60,200] [--repeat 2000] [--seed 1]
+
+Rooms are played with the engine simulation from engine_bench.py. After
+the given number of turns the benchmark takes the same payloads that
+sync_room_state() and dispatch() would emit:
+
+    snapshot      {'version', 'state'}: what joiners and resyncing clients get
+    delta         the room-update patch of each state change in the last turn
+    year-revealed the reveal event, which carries both teams in full
+
+For each one it reports the mean encode time and the size. JSON is encoded
+the way python-socketio encodes packets (compact separators). MessagePack
+is encoded the way app.wire_emit() does.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import msgpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import engine  # noqa: E402
+from engine_bench import Simulation  # noqa: E402
+from patches import json_diff  # noqa: E402
+
+
+def encode_json(payload):
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+def encode_msgpack(payload):
+    return msgpack.packb(payload)
+
+
+def payloads(players, turns, seed):
+    """Snapshot, last-turn deltas and the last year-revealed of a simulated room."""
+    sim = Simulation(players, seed, sync=False)
+    for _ in range(turns):
+        sim.turn()
+    room = sim.room
+    room.wire_state = room.to_wire()
+    deltas, revealed = [], None
+    # One more turn, capturing every broadcast the way the server builds it
+    original = sim.finish
+
+    def capture(action, started, outcome):
+        nonlocal revealed
+        for event, data, _ in outcome.events:
+            if event == engine.SYNC:
+                state = room.to_wire()
+                patch = json_diff(room.wire_state, state)
+                room.wire_state = state
+                if patch:
+                    room.version += 1
+                    deltas.append({'roomCode': room.code, 'baseVersion': room.version - 1, 'version': room.version, 'patch': patch})
+            elif event == 'year-revealed':
+                revealed = data
+        original(action, started, outcome)
+
+    sim.finish = capture
+    while revealed is None:
+        sim.turn()
+    return {'snapshot': [{'version': room.version, 'state': room.wire_state}], 'delta': deltas, 'year-revealed': [revealed]}
+
+
+def measure(encode, items, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            encode(item)
+    elapsed = time.perf_counter() - started
+    size = sum(len(encode(item)) for item in items)
+    return elapsed / (repeat * len(items)) * 1e6, size / len(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', default='4,12,24')
+    parser.add_argument('--turns', default='10,60,200')
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'players':>7} {'turns':>6} {'payload':<14} {'json us':>8} {'mp us':>8} {'json B':>8} {'mp B':>8} {'size':>6}")
+    for players in (int(n) for n in args.players.split(',')):
+        for turns in (int(n) for n in args.turns.split(',')):
+            for kind, items in payloads(players, turns, args.seed).items():
+                if not items:
+                    continue
+                json_us, json_bytes = measure(encode_json, items, args.repeat)
+                mp_us, mp_bytes = measure(encode_msgpack, items, args.repeat)
+                print(f"{players:>7} {turns:>6} {kind:<14} {json_us:>8.1f} {mp_us:>8.1f} {json_bytes:>8.0f} {mp_bytes:>8.0f}"
+                      f" {mp_bytes / json_bytes:>6.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Local catalog of every playable song the server has seen on iTunes.
+
+Rows live in SQLite. They are unique on normalized artist/title and indexed
+by year, so the catalog survives restarts and grows with every proxied
+search and every resolved playlist track. Sampling never queries the
+database: songs are also held in memory, bucketed by decade. random()
+picks a decade uniformly and then a song within it, which spreads years
+evenly even though searches mostly return recent releases. It needs no
+upstream, so it keeps working while iTunes is down.
+
+add_itunes() runs on the event loop and only touches memory. A real OS
+thread batches the inserts into SQLite, as the room journal does.
+"""
+import re
+import random
+import atexit
+import logging
+import sqlite3
+import datetime
+
+import runtime
+
+_threading = runtime.original('threading')
+_queue = runtime.original('queue')
+_time = runtime.original('time')
+
+log = logging.getLogger('tunetimeline.catalog')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,  -- iTunes trackId
+    norm_key TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    url TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS songs_year ON songs (year);
+"""
+
+_BRACKETS = re.compile(r'\([^)]*\)|\[[^\]]*\]')
+_VERSION_SUFFIX = re.compile(r'\s-\s.*(remaster|version|edit|mix|live|mono|stereo).*$')
+_NON_WORD = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(artist, title):
+    """Key that treats remasters, edits and feat. credits of one recording as the same song."""
+    title = _VERSION_SUFFIX.sub('', _BRACKETS.sub('', title.lower()))
+    artist = _BRACKETS.sub('', artist.lower()).split(' feat')[0]
+    return f"{_NON_WORD.sub(' ', artist).strip()}|{_NON_WORD.sub(' ', title).strip()}"
+
+
+class SongCatalog:
+
+    def __init__(self, path, flush_interval=1.0, rng=random):
+        self.path = path
+        self.flush_interval = flush_interval  # Seconds the writer waits to grow a batch
+        self.rng = rng
+        self.max_year = datetime.date.today().year + 1
+        self._keys = set()
+        self._ids = set()
+        self._buckets = {}  # decade -> [(id, title, artist, year, url)]
+        self._decades = []  # non-empty buckets, for uniform picks
+        self._rows = _queue.Queue()
+        self.added = 0
+        self.batches = 0
+        with sqlite3.connect(path) as db:
+            db.executescript(SCHEMA)
+            for row in db.execute('SELECT id, norm_key, title, artist, year, url FROM songs'):
+                self._remember(row[0], row[1], row[2:])
+        db.close()
+        log.info("Loaded %d catalog songs from %s", len(self), path)
+        self._writer = _threading.Thread(target=self._write_loop, name='song-catalog', daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _remember(self, song_id, key, song):
+        self._keys.add(key)
+        self._ids.add(song_id)
+        decade = song[2] // 10 * 10
+        bucket = self._buckets.get(decade)
+        if bucket is None:
+            bucket = self._buckets[decade] = []
+            self._decades.append(decade)
+        bucket.append((song_id,) + tuple(song))
+
+    def add_itunes(self, results):
+        """Remember the playable tracks among raw iTunes search results."""
+        for track in results:
+            try:
+                song_id = int(track['trackId'])
+                title, artist, url = track['trackName'], track['artistName'], track['previewUrl']
+                year = int(track['releaseDate'][:4])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if not (title and artist and url) or not 1900 <= year <= self.max_year or song_id in self._ids:
+                continue
+            key = normalize(artist, title)
+            if key in self._keys:
+                continue
+            self._remember(song_id, key, (title, artist, year, url))
+            self._rows.put((song_id, key, title, artist, year, url))
+            self.added += 1
+
+    def random(self, decade=None, exclude=()):
+        """Wire dict of a random song, decades weighted equally; None if nothing matches."""
+        if decade is not None:
+            decades = [decade] if decade in self._buckets else []
+        else:
+            decades = self._decades
+        if not decades:
+            return None
+        for _ in range(8):
+            song = self.rng.choice(self._buckets[self.rng.choice(decades)])
+            if song[0] not in exclude:
+                return self._wire(song)
+        # Mostly excluded (small catalog or long game): pick from what's left
+        left = [song for d in decades for song in self._buckets[d] if song[0] not in exclude]
+        return self._wire(self.rng.choice(left)) if left else None
+
+    @staticmethod
+    def _wire(song):
+        song_id, title, artist, year, url = song
+        return {'id': song_id, 'title': title, 'artist': artist, 'year': year, 'url': url}
+
+    def flush(self):
+        """Block until every added song is in SQLite."""
+        self._rows.join()
+
+    def _write_loop(self):
+        db = sqlite3.connect(self.path)
+        while True:
+            batch = [self._rows.get()]
+            if self.flush_interval:
+                _time.sleep(self.flush_interval)
+            while True:
+                try:
+                    batch.append(self._rows.get_nowait())
+                except _queue.Empty:
+                    break
+            try:
+                with db:
+                    db.executemany('INSERT OR IGNORE INTO songs (id, norm_key, title, artist, year, url)'
+                                   ' VALUES (?, ?, ?, ?, ?, ?)', batch)
+                self.batches += 1
+            except sqlite3.Error:
+                log.exception("Song catalog write failed")
+            finally:
+                for _ in batch:
+                    self._rows.task_done()
+
+    def stats(self):
+        return {
+            'songs': len(self),
+            'decades': {str(d): len(self._buckets[d]) for d in sorted(self._decades)},
+            'added': self.added,
+            'batches': self.batches,
+            'pending': self._rows.qsize()
+        }
@@ -0,0 +1,492 @@
+"""Transport-free game rules.
+
+apply_action() takes a room, the acting sid and a game-action, mutates the
+room and returns an Outcome: the events to send (in order) and the side
+effects the caller has to run, such as deck refills and deadlines.
+reveal() is the year reveal on its own, and expire() is what a deadline
+does when it runs out (see DEADLINES). Nothing here touches
+sockets, Flask or the network, so the rules can be benchmarked, fuzzed and
+simulated without a server (see bench/engine_bench.py and tests/). app.py
+is the Socket.IO adapter. Action data comes straight from clients, so
+every action validates it and ignores what it can't use.
+"""
+import random
+
+from models import Song
+
+ROOM = None  # Event target meaning "everyone in the room"
+SYNC = 'room-update'  # Placeholder event: broadcast the room's state delta at this point
+
+AUTO_REVEAL_DELAY = 1.5  # Seconds between a challenge and its reveal
+# Timeouts for idle rooms, in seconds; 0 turns one off. app.py reads them from the environment.
+READY_TIMEOUT = 30  # start-game until the game starts with whoever is ready
+VOTE_WINDOW = 45  # First vote of a turn until the team's leading position is confirmed
+TURN_TIMEOUT = 120  # A turn step (placing, challenging) until it is done for the idle team
+
+# Per-room deadline kinds the engine sets and cancels through Outcome.deadline()
+DEADLINES = ('ready', 'votes', 'turn', 'reveal')
+
+HOST_ONLY_ACTIONS = frozenset({
+    'start-game', 'init-starter-cards', 'play-song', 'next-song', 'reveal-year',
+    'set-target-score', 'set-oracle', 'randomize-teams', 'reset-game'
+})
+ADMIN_ONLY_ACTIONS = frozenset({'fetch-playlist', 'set-playlist-tracks'})
+# Every game-action the server understands, including the playlist ones app.py handles itself
+ACTIONS = HOST_ONLY_ACTIONS | ADMIN_ONLY_ACTIONS | frozenset({
+    'player-ready', 'submit-vote', 'confirm-placement', 'submit-placement', 'submit-challenge',
+    'skip-challenge', 'claim-token'
+})
+# Actions whose data is a {teamId, ...} object; any other payload is ignored
+TEAM_ACTIONS = frozenset({
+    'submit-vote', 'confirm-placement', 'submit-placement', 'submit-challenge', 'skip-challenge',
+    'claim-token', 'set-oracle'
+})
+
+
+class Outcome:
+    """What an action produced: ordered (event, data, to) triples plus side effects."""
+    __slots__ = ('events', 'effects')
+
+    def __init__(self):
+        self.events = []
+        # (name, argument): ('refill-deck', None), ('deadline', (kind, seconds)), ('vote-changed', (team_id, positions))
+        self.effects = []
+
+    def emit(self, event, data=None, to=ROOM):
+        self.events.append((event, data, to))
+
+    def sync(self):
+        self.events.append((SYNC, None, ROOM))
+
+    def effect(self, name, argument=None):
+        self.effects.append((name, argument))
+
+    def deadline(self, kind, seconds=None):
+        """Call expire(room, kind) in `seconds`, replacing the pending one; no seconds cancels it."""
+        self.effects.append(('deadline', (kind, seconds or None)))
+
+
+def permission_error(room, sid, action, is_admin=False):
+    """Error message if `sid` may not perform `action`, else None."""
+    if action in HOST_ONLY_ACTIONS and room.host != sid and not is_admin:
+        return 'Only the host or an admin can perform this action.'
+    if action in ADMIN_ONLY_ACTIONS and not is_admin:
+        return 'Admin privileges required.'
+    return None
+
+
+MAX_PLAYLIST_TRACKS = 5000  # Far more than a Spotify playlist page lists
+
+
+def playlist_tracks(action_data):
+    """set-playlist-tracks data as a tuple of {'name', 'artist'} dicts, or None if it isn't a playlist."""
+    if not isinstance(action_data, list) or not 0 < len(action_data) <= MAX_PLAYLIST_TRACKS:
+        return None
+    tracks = []
+    for track in action_data:
+        if not isinstance(track, dict) or not isinstance(track.get('name'), str) \
+                or not isinstance(track.get('artist'), str):
+            return None
+        tracks.append({'name': track['name'], 'artist': track['artist']})
+    return tuple(tracks)
+
+
+def playlist_url(action_data):
+    """fetch-playlist data: the playlist URL, or None if it isn't a string."""
+    return action_data if isinstance(action_data, str) else None
+
+
+def team_of(room, action_data):
+    """The Team named by action_data['teamId'], or None for anything that isn't one."""
+    team_id = action_data.get('teamId')
+    return room.teams.get(team_id) if isinstance(team_id, str) else None
+
+
+def valid_pos(team, pos):
+    """A slot in the team's timeline: 0 (before the first card) up to len (after the last)."""
+    return type(pos) is int and 0 <= pos <= len(team.timeline)
+
+
+def start_song(room, out, song):
+    room.current_song = song
+    room.turn_state = 'playing'
+    room.current_placement = None
+    room.current_challenge = None
+    room.token_claimed = False # Reset for new song
+
+    # Add to history
+    room.add_history(song)
+
+    out.deadline('votes')
+    out.deadline('turn', TURN_TIMEOUT)
+    out.sync()
+    out.emit('new-song', {
+        'songData': song.to_wire(),
+        'activeTeam': room.active_team,
+        'turnState': room.turn_state
+    })
+
+
+def place(room, out, team_id, pos):
+    """Lock in a team's placement; the other team may now challenge it."""
+    room.current_placement = {'teamId': team_id, 'pos': pos}
+    room.turn_state = 'challenging'
+    out.deadline('votes')
+    out.deadline('turn', TURN_TIMEOUT)
+    out.emit('placement-submitted', {
+        'teamId': team_id,
+        'pos': pos,
+        'turnState': room.turn_state
+    })
+
+
+def start_playing(room, out):
+    room.game_state = 'playing'
+    out.deadline('ready')
+    out.sync()
+    out.emit('game-started')
+
+
+def expire(room, kind):
+    """Run out the room's `kind` deadline (see DEADLINES); returns an Outcome.
+
+    Each kind checks that the room is still in the step it was set for, so
+    a late or repeated call changes nothing.
+    """
+    out = Outcome()
+    if kind == 'ready':
+        if room.game_state == 'ready':
+            start_playing(room, out)  # Whoever didn't press ready in time joins without unlocked audio
+    elif kind == 'reveal':
+        if room.turn_state == 'challenging':
+            reveal(room, out)
+    elif kind in ('votes', 'turn'):
+        if room.game_state != 'playing' or room.current_song is None:
+            return out
+        active = room.active_team
+        if room.turn_state == 'challenging':
+            if kind == 'turn':
+                # Nobody challenged in time
+                out.emit('challenge-skipped', {'teamId': room.other_team(active)})
+                reveal(room, out)
+        elif room.teams[active].votes:
+            team = room.teams[active]
+            winning_pos = team.winning_vote()
+            team.clear_votes()
+            place(room, out, active, winning_pos)
+        elif kind == 'turn':
+            # No votes at all: the team passes, and the card counts as placed wrong
+            room.current_placement = {'teamId': active, 'pos': None}
+            reveal(room, out)
+    return out
+
+
+def reveal(room, out=None):
+    """Score the current placement (and challenge) and rotate the turn."""
+    out = out if out is not None else Outcome()
+    song = room.current_song
+    placement = room.current_placement
+    challenge = room.current_challenge
+    
+    # Validate
+    if not song or not placement or placement.get('teamId') not in room.teams:
+        return out
+    
+    actual_year = song.year
+    p_team = room.teams[placement['teamId']]
+    p_pos = placement['pos']
+    
+    # Calculate where the song SHOULD have gone
+    correct_pos_on_p = p_team.timeline.correct_pos(actual_year)
+    
+    results = {
+        'actualYear': actual_year,
+        'placerCorrect': (p_pos == correct_pos_on_p),
+        'challengerCorrect': False,
+        'placement': placement,
+        'challenge': challenge,
+        'stolen': False
+    }
+
+    # Check challenger (if any)
+    if challenge and challenge.get('teamId') in room.teams:
+        c_team = room.teams[challenge['teamId']]
+        c_pos = challenge['pos']
+        c_team.tokens -= 1  # Always spend token
+        
+        if c_pos == correct_pos_on_p:
+            results['challengerCorrect'] = True
+            results['stolen'] = True
+            c_team.timeline.insert(song)
+            c_team.score += 1
+        elif results['placerCorrect']:
+            p_team.timeline.insert(song)
+            p_team.score += 1
+    else:
+        if results['placerCorrect']:
+            p_team.timeline.insert(song)
+            p_team.score += 1
+
+    # Rotate Turn
+    room.active_team = room.other_team(room.active_team)
+    room.turn_state = 'playing'
+    room.current_placement = None
+    room.current_challenge = None
+    for kind in ('votes', 'turn', 'reveal'):
+        out.deadline(kind)  # A manual reveal must not be followed by the auto-reveal
+    
+    # Check for winner
+    winner = None
+    if room.teams['team1'].score >= room.target_score: 
+        winner = room.teams['team1'].name
+    elif room.teams['team2'].score >= room.target_score: 
+        winner = room.teams['team2'].name
+
+    out.emit('year-revealed', {
+        'results': results,
+        'teams': room.teams_wire(),
+        'nextTeam': room.active_team,
+        'winner': winner
+    })
+    return out
+
+
+def apply_action(room, sid, action, action_data, is_admin=False, rng=random):
+    """Run one game-action by `sid` against `room`; returns an Outcome."""
+    out = Outcome()
+    error = permission_error(room, sid, action, is_admin)
+    if error:
+        out.emit('error-msg', error, to=sid)
+        return out
+    if action in TEAM_ACTIONS and not isinstance(action_data, dict):
+        return out
+
+    if action == 'start-game':
+        # Trigger ready phase for everyone to unlock audio
+        room.game_state = 'ready'
+        room.ready_players = set()
+        
+        # Reset game states early so UI reflects new game
+        room.active_team = 'team1'
+        room.turn_state = 'playing'
+        for t in room.teams.values():
+            t.reset()
+        for kind in DEADLINES:
+            out.deadline(kind)
+        out.deadline('ready', READY_TIMEOUT)
+        
+        out.sync()
+        out.emit('start-ready-phase')
+        out.effect('refill-deck')
+
+    elif action == 'player-ready':
+        room.ready_players.add(sid)
+        ready_count = len(room.ready_players)
+        total_players = len(room.players)
+        
+        if ready_count >= total_players:
+            # Everyone is ready! Start the actual game.
+            if room.game_state == 'ready':
+                start_playing(room, out)
+        else:
+            # Update others on progress (optional but nice)
+            out.emit('ready-progress', {'readyCount': ready_count, 'totalPlayers': total_players})
+
+    elif action == 'init-starter-cards':
+        try:
+            team1_song = Song.from_wire(action_data['team1Song'])
+            team2_song = Song.from_wire(action_data['team2Song'])
+        except (KeyError, TypeError, ValueError, OverflowError):
+            out.emit('error-msg', 'Ongeldige startkaarten.', to=sid)
+            return out
+        room.teams['team1'].set_timeline([team1_song])
+        room.teams['team2'].set_timeline([team2_song])
+        # Add starter songs to history
+        room.add_history(team1_song)
+        room.add_history(team2_song)
+        out.sync()
+
+    elif action == 'play-song':
+        try:
+            song = Song.from_wire(action_data)
+        except (KeyError, TypeError, ValueError, OverflowError):
+            out.emit('error-msg', 'Ongeldig nummer.', to=sid)
+            return out
+        start_song(room, out, song)
+
+    elif action == 'next-song':
+        # Deal the next prefetched song; the host falls back to client-side search if the deck is empty
+        deck = room.song_deck
+        while deck and room.is_played(deck[0].artist, deck[0].title):
+            deck.popleft()
+        if not deck:
+            out.effect('refill-deck')
+            out.emit('song-deck-empty', to=sid)
+            return out
+        start_song(room, out, deck.popleft())
+        out.effect('refill-deck')
+
+    elif action == 'submit-vote':
+        # Team member votes on a position
+        team = team_of(room, action_data)
+        pos = action_data.get('pos')
+        if team is None or not valid_pos(team, pos):
+            return out
+        team_id = team.id
+        if room.turn_state != 'playing' or room.active_team != team_id:
+            return out  # Arrived after the placement was confirmed; it must not count in the next round
+        if not team.votes:
+            out.deadline('votes', VOTE_WINDOW)
+        changed = team.set_vote(sid, pos)
+        if changed:
+            # The server batches these into throttled vote-update deltas
+            out.effect('vote-changed', (team_id, changed))
+
+    elif action == 'reset-game':
+        room.game_state = 'lobby'
+        room.turn_state = 'playing'
+        room.active_team = 'team1'
+        room.current_song = None
+        room.current_placement = None
+        room.current_challenge = None
+        room.token_claimed = False
+        room.clear_history()
+        
+        # Reset teams but keep players
+        for t in room.teams.values():
+            t.reset()
+        for kind in DEADLINES:
+            out.deadline(kind)
+        
+        out.sync()
+        out.emit('game-reset')
+
+    
+    elif action == 'confirm-placement':
+        # Team confirms their placement after voting
+        team = team_of(room, action_data)
+        if team is None:
+            return out
+        team_id = team.id
+        # Kept up to date per vote, so no recount here; ties go to the oracle
+        winning_pos = team.winning_vote()
+        if winning_pos is None:
+            out.emit('error-msg', 'Er zijn nog geen stemmen!', to=sid)
+            return out
+        
+        # Clear votes for next round
+        team.clear_votes()
+        
+        # Now submit the actual placement
+        place(room, out, team_id, winning_pos)
+
+    elif action == 'submit-placement':
+        # Direct placement (for single player teams or legacy)
+        team = team_of(room, action_data)
+        pos = action_data.get('pos')
+        if team is None or not valid_pos(team, pos):
+            return out
+        place(room, out, team.id, pos)
+
+    elif action == 'submit-challenge':
+        # Opposing team challenges a placement, on the placing team's timeline
+        team = team_of(room, action_data)
+        pos = action_data.get('pos')
+        if team is None or not valid_pos(room.teams[room.active_team], pos):
+            return out
+        if room.turn_state != 'challenging' or room.current_challenge is not None \
+                or team.id != room.other_team(room.active_team):
+            return out  # Only one challenge, by the other team, once the placement is in; else the turn timeout stays
+        room.current_challenge = {'teamId': team.id, 'pos': pos}
+        out.emit('challenge-submitted', room.current_challenge)
+        
+        # Auto-reveal after a slight delay so clients receive the challenge-submitted first
+        out.deadline('reveal', AUTO_REVEAL_DELAY)
+        out.deadline('turn')
+
+    elif action == 'skip-challenge':
+        # Opposing team skips the challenge - auto reveal
+        team = team_of(room, action_data)
+        out.emit('challenge-skipped', {'teamId': team.id if team else None})
+        reveal(room, out)
+
+    elif action == 'reveal-year':
+        # Host triggers reveal (manual backup)
+        reveal(room, out)
+
+    elif action == 'set-target-score':
+        if room.host == sid:
+            try:
+                room.target_score = int(action_data)
+            except (TypeError, ValueError, OverflowError):
+                return out
+            out.sync()
+
+    elif action == 'claim-token':
+        team = team_of(room, action_data)
+        if team is None or sid not in room.players:
+            return out
+        team_id = team.id
+        
+        # Check if already claimed for this song
+        if room.token_claimed:
+             out.emit('error-msg', 'Token al geclaimd voor dit nummer!', to=sid)
+             return out
+
+        if room.teams[team_id].tokens < 5:
+            room.teams[team_id].tokens += 1
+            room.token_claimed = True
+            
+            # Announce to everyone that token was claimed
+            out.emit('token-claimed-announcement', {
+                'teamId': team_id,
+                'claimedBy': room.players[sid].name
+            })
+            
+            out.sync()
+        else:
+            out.emit('error-msg', 'Maximaal 5 tokens bereikt!', to=sid)
+
+    elif action == 'set-oracle':
+        # Set the Oracle (Al-wetende) for a team
+        team = team_of(room, action_data)
+        oracle_sid = action_data.get('oracleSid')  # Can be None to remove
+        
+        if team is None or not (oracle_sid is None or isinstance(oracle_sid, str)):
+            return out
+        
+        # Validate: Oracle can only be set if team has even number of players
+        if oracle_sid:
+            if len(team.players) % 2 != 0:
+                out.emit('error-msg', 'Al-wetende kan alleen worden ingesteld bij een even aantal spelers!', to=sid)
+                return out
+            # Validate oracle is in team
+            if oracle_sid not in team.players:
+                out.emit('error-msg', 'Deze speler zit niet in het team!', to=sid)
+                return out
+        
+        team.oracle = oracle_sid
+        out.sync()
+
+    elif action == 'randomize-teams':
+        if room.host == sid:
+            # 1. Gather all players (sids)
+            all_sids = list(room.players.keys())
+            
+            # 2. Shuffle
+            rng.shuffle(all_sids)
+            
+            # 3. Clear existing team lists but keep stats
+            for player_sid in all_sids:
+                room.assign_team(player_sid, None)
+            room.teams['team1'].oracle = None
+            room.teams['team2'].oracle = None
+            
+            # 4. Distribute
+            for i, player_sid in enumerate(all_sids):
+                room.assign_team(player_sid, 'team1' if i % 2 == 0 else 'team2')
+            
+            # 5. Sync
+            out.sync()
+
+    return out
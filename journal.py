@@ -0,0 +1,192 @@
+"""Append-only room journal for crash recovery.
+
+Each room has two files in the journal directory:
+
+    <code>.snap  {"seq": n, "room": Room.to_dict()} written atomically
+    <code>.log   one [seq, json-patch] line per mutation after that snapshot
+
+record() runs on the event loop. It only diffs the room against the last
+recorded state and queues one encoded line. A real OS thread appends the
+queued lines in batches and fsyncs each touched file once per batch, so
+disk latency never reaches a game action. Every `snapshot_every` events
+the room is written out in full and its log is truncated.
+
+recover() loads each snapshot and replays the log lines that follow it. A
+torn last line from a crash mid-write is ignored.
+"""
+import os
+import json
+import atexit
+import logging
+
+import runtime
+
+from patches import apply_patch, json_diff
+
+_threading = runtime.original('threading')
+_queue = runtime.original('queue')
+_time = runtime.original('time')
+
+log = logging.getLogger('tunetimeline.journal')
+
+
+class RoomJournal:
+
+    def __init__(self, directory, snapshot_every=200, flush_interval=0.05):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.flush_interval = flush_interval  # Seconds the writer waits to grow a batch
+        self._last = {}  # code -> (seq, events since snapshot, last recorded dict)
+        self._playlists = set()  # hashes already on disk
+        self._ops = _queue.Queue()
+        self.events = 0
+        self.snapshots = 0
+        self.batches = 0
+        os.makedirs(os.path.join(directory, 'playlists'), exist_ok=True)
+        self._playlists.update(name[:-5] for name in os.listdir(os.path.join(directory, 'playlists')))
+        self._writer = _threading.Thread(target=self._write_loop, name='room-journal', daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    def _path(self, code, ext):
+        return os.path.join(self.directory, f"{code}.{ext}")
+
+    @staticmethod
+    def _state(room):
+        state = room.to_dict()
+        # Derived or process-local: the next sync rebuilds the wire state, and refills restart
+        state['wire_state'] = None
+        state['deck_refilling'] = False
+        return state
+
+    def record(self, room):
+        """Queue whatever changed in `room` since the last record() (nothing if unchanged)."""
+        state = self._state(room)
+        seq, pending, last = self._last.get(room.code, (0, 0, None))
+        if room.playlist_hash and room.playlist_hash not in self._playlists:
+            self._playlists.add(room.playlist_hash)
+            self._ops.put(('playlist', room.playlist_hash, json.dumps(list(room.playlist_tracks))))
+        if last is None or pending >= self.snapshot_every:
+            seq += 1
+            self._ops.put(('snapshot', room.code, json.dumps({'seq': seq, 'room': state})))
+            self._last[room.code] = (seq, 0, state)
+            self.snapshots += 1
+            return
+        patch = json_diff(last, state)
+        if not patch:
+            return
+        seq += 1
+        self._ops.put(('append', room.code, json.dumps([seq, patch], separators=(',', ':'))))
+        self._last[room.code] = (seq, pending + 1, state)
+        self.events += 1
+
+    def forget(self, code):
+        """The room is gone; drop its files."""
+        if self._last.pop(code, None) is not None:
+            self._ops.put(('delete', code, None))
+
+    def flush(self):
+        """Block until everything queued so far is on disk."""
+        self._ops.join()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._ops.get()]
+            if self.flush_interval:
+                _time.sleep(self.flush_interval)
+            while True:
+                try:
+                    batch.append(self._ops.get_nowait())
+                except _queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception:
+                log.exception("Room journal write failed")
+            finally:
+                for _ in batch:
+                    self._ops.task_done()
+
+    def _write_batch(self, batch):
+        appends = {}  # code -> lines, in queue order
+        for kind, key, payload in batch:
+            if kind == 'append':
+                appends.setdefault(key, []).append(payload)
+                continue
+            # Snapshots and deletes supersede earlier appends in this batch
+            self._write_appends(appends.pop(key, None), key)
+            if kind == 'snapshot':
+                self._write_atomic(self._path(key, 'snap'), payload)
+                with open(self._path(key, 'log'), 'w'):
+                    pass
+            elif kind == 'delete':
+                for ext in ('snap', 'log'):
+                    try:
+                        os.remove(self._path(key, ext))
+                    except FileNotFoundError:
+                        pass
+            elif kind == 'playlist':
+                self._write_atomic(os.path.join(self.directory, 'playlists', f"{key}.json"), payload)
+        for code, lines in appends.items():
+            self._write_appends(lines, code)
+        self.batches += 1
+
+    def _write_appends(self, lines, code):
+        if not lines:
+            return
+        with open(self._path(code, 'log'), 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _write_atomic(path, payload):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def load_playlist(self, digest):
+        try:
+            with open(os.path.join(self.directory, 'playlists', f"{digest}.json")) as f:
+                return tuple(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def recover(self):
+        """Rebuilt room dicts from disk, keyed by code. Also primes record() with them."""
+        recovered = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith('.snap'):
+                continue
+            code = name[:-5]
+            try:
+                with open(self._path(code, 'snap')) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning("Skipping unreadable snapshot: %s", e, extra={'room': code})
+                continue
+            seq, state, pending = snapshot['seq'], snapshot['room'], 0
+            try:
+                with open(self._path(code, 'log')) as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                lines = []
+            for line in lines:
+                try:
+                    event_seq, patch = json.loads(line)
+                except ValueError:
+                    break  # Torn write at the tail
+                if event_seq <= seq:
+                    continue  # Already in the snapshot (crash between snapshot and truncate)
+                if event_seq != seq + 1:
+                    log.warning("Gap in journal at %d, stopping replay", seq, extra={'room': code})
+                    break
+                state = apply_patch(state, patch)
+                seq = event_seq
+                pending += 1
+            recovered[code] = state
+            self._last[code] = (seq, pending, state)
+        return recovered
@@ -0,0 +1,144 @@
+"""Logging that stays off the event loop.
+
+setup_logging() attaches one handler to the root logger. That handler
+only checks the level and sampling and then enqueues the record. A real
+OS thread formats and writes it, so neither a slow stdout nor a JSON
+encode ever runs on the eventlet loop. If the writer falls behind, the
+queue is bounded and records are dropped (and counted) instead of piling
+up.
+
+Environment:
+    LOG_LEVEL        root level (default INFO)
+    LOG_FORMAT       'text' (default) or 'json' for one JSON object per line
+    LOG_SAMPLE       keep 1 in N records per event, e.g. 'connect:100,disconnect:100'
+    LOG_QUEUE_SIZE   records buffered for the writer thread (default 10000)
+
+Pass fields with extra={...}. Records with an 'event' field are sampled;
+every field is written as a JSON key or as key=value text.
+"""
+import sys
+import atexit
+import json
+import logging
+import datetime
+
+import runtime
+
+_threading = runtime.original('threading')
+_queue = runtime.original('queue')
+
+# Attributes every LogRecord has; anything else came in through extra=
+# (color_message is uvicorn's ANSI-coloured copy of the message, in asyncio mode)
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'color_message'}
+
+
+def _extra(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        entry.update(_extra(record))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _extra(record)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """Let through every Nth record of an event listed in `rates` (event -> N)."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.seen = {}
+
+    def filter(self, record):
+        every = self.rates.get(getattr(record, 'event', None))
+        if not every:
+            return True
+        seen = self.seen.get(record.event, 0)
+        self.seen[record.event] = seen + 1
+        if seen % every:
+            return False
+        record.sampled = every  # Readers can scale counts back up
+        return True
+
+
+class OffLoopHandler(logging.Handler):
+    """Enqueue records for a writer thread; formatting and I/O happen there."""
+
+    def __init__(self, target, maxsize=10000):
+        super().__init__()
+        self.target = target
+        self.dropped = 0
+        self._records = _queue.Queue(maxsize)
+        atexit.register(self.flush)
+        _threading.Thread(target=self._write_loop, name='log-writer', daemon=True).start()
+
+    def createLock(self):
+        self.lock = None  # emit() only touches a thread-safe queue, and the journal thread logs too
+
+    def emit(self, record):
+        # Arguments are rendered later on the writer thread, so snapshot anything mutable now
+        if record.args and not (isinstance(record.args, tuple) and all(isinstance(arg, (str, int, float)) for arg in record.args)):
+            record.msg, record.args = record.getMessage(), None
+        try:
+            self._records.put_nowait(record)
+        except _queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        while True:
+            record = self._records.get()
+            try:
+                self.target.handle(record)
+            except Exception:
+                pass  # Nowhere left to report a broken log stream
+            finally:
+                self._records.task_done()
+
+    def flush(self):
+        """Block until everything queued so far is written."""
+        self._records.join()
+
+
+def _sample_rates(spec):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        event, _, every = item.rpartition(':')
+        try:
+            rates[event] = max(1, int(every))
+        except ValueError:
+            raise ValueError(f"LOG_SAMPLE entries look like event:N, got {item!r}")
+    return rates
+
+
+def setup_logging(environ):
+    """Configure the root logger from the environment. Returns the off-loop handler."""
+    target = logging.StreamHandler(sys.stdout)
+    target.lock = _threading.RLock()  # Only the writer thread uses it; keep it off eventlet's green locks
+    target.setFormatter(JsonFormatter() if environ.get('LOG_FORMAT', 'text') == 'json' else TextFormatter())
+    handler = OffLoopHandler(target, int(environ.get('LOG_QUEUE_SIZE', 10000)))
+    handler.addFilter(SamplingFilter(_sample_rates(environ.get('LOG_SAMPLE', ''))))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(environ.get('LOG_LEVEL', 'INFO').upper())
+    return handler
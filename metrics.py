@@ -0,0 +1,179 @@
+"""Prometheus text-format metrics without a client library.
+
+Everything runs on the event loop's single OS thread, under eventlet or
+asyncio. Counters are plain ints in dicts, so they need no locks.
+Histograms have fixed buckets, so observe() is one bisect and three
+additions. Values computed from live state (room counts, hub size) are
+callbacks evaluated only at scrape time.
+"""
+import gc
+import time
+from bisect import bisect_left
+
+import greenlet
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}  # label tuple -> total
+        REGISTRY.append(self)
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Gauge:
+    """Value read from `fn` at scrape time; fn returns a number or {label tuple: number}."""
+
+    def __init__(self, name, help, fn, labelnames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = labelnames
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}  # label tuple -> [per-bucket counts (+Inf last), sum, count]
+        REGISTRY.append(self)
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = _labels(self.labelnames + ('le',), labels + (bound,))
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {count}"
+
+
+REGISTRY = []
+
+
+def render():
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+handler_seconds = Histogram('tunetimeline_handler_seconds', 'Socket.IO handler latency', ('event', 'action'))
+handler_errors = Counter('tunetimeline_handler_errors_total', 'Socket.IO handlers that raised', ('event', 'action'))
+emits = Counter('tunetimeline_emits_total', 'Encoded outbound Socket.IO events (once per emit, not per recipient)', ('event',))
+emit_bytes = Counter('tunetimeline_emit_bytes_total', 'Encoded outbound payload bytes', ('event',))
+emit_size = Histogram('tunetimeline_emit_payload_bytes', 'Encoded outbound payload size', ('event',), SIZE_BUCKETS)
+sync_requests = Counter('tunetimeline_sync_requests_total', 'State changes that asked for a room-update (several can share one emit)')
+upstream_seconds = Histogram('tunetimeline_upstream_seconds', 'Latency of iTunes/Spotify requests', ('upstream',))
+upstream_errors = Counter('tunetimeline_upstream_errors_total', 'Failed iTunes/Spotify requests', ('upstream',))
+loop_lag = Histogram('tunetimeline_loop_lag_seconds', 'Extra delay of a periodic sleep on the event loop')
+
+
+class PacketJSON:
+    """json module stand-in for Socket.IO packet encoding that also counts emits.
+
+    Event packets encode [event, *args], so the event name and the payload
+    size come for free from the string the server builds anyway.
+    """
+
+    def __init__(self, json):
+        self.json = json
+
+    def dumps(self, obj, *args, **kwargs):
+        encoded = self.json.dumps(obj, *args, **kwargs)
+        if type(obj) is list and obj and type(obj[0]) is str:
+            labels = (obj[0],)
+            emits.inc(labels)
+            emit_bytes.inc(labels, len(encoded))
+            emit_size.observe(len(encoded), labels)
+        return encoded
+
+    def loads(self, *args, **kwargs):
+        return self.json.loads(*args, **kwargs)
+
+
+class timed:
+    """Context manager that records elapsed seconds in a histogram (and failures in a counter)."""
+    __slots__ = ('histogram', 'labels', 'errors', 'started')
+
+    def __init__(self, histogram, labels=(), errors=None):
+        self.histogram = histogram
+        self.labels = labels
+        self.errors = errors
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+        if exc_type is not None and self.errors is not None:
+            self.errors.inc(self.labels)
+
+
+_greenlet_count = [0, 0.0]  # count, measured at (monotonic)
+
+
+def greenlet_count(max_age=60):
+    """Live greenlets. Needs a full gc scan, so the result is reused for max_age seconds."""
+    now = time.monotonic()
+    if now - _greenlet_count[1] > max_age:
+        _greenlet_count[0] = sum(1 for obj in gc.get_objects() if isinstance(obj, greenlet.greenlet))
+        _greenlet_count[1] = now
+    return _greenlet_count[0]
+
+
+def watch_loop_lag(sleep, interval=0.5):
+    """Run forever in a greenlet: how late does a sleep(interval) wake up?"""
+    while True:
+        started = time.perf_counter()
+        sleep(interval)
+        loop_lag.observe(max(0.0, time.perf_counter() - started - interval))
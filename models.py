@@ -0,0 +1,494 @@
+"""Typed room state for TuneTimeline.
+
+Every model memoizes its wire form (the plain dict sent to clients).
+Assigning a public attribute drops the cached form. In-place changes to a
+container (players, votes, timeline, history) must go through the model's
+methods or be followed by touch(). Invalidation bubbles up to the owning
+room, so a room-update only rebuilds the parts that actually changed.
+"""
+import sys
+import heapq
+from bisect import bisect_right
+from collections import deque
+
+
+class Model:
+    __slots__ = ('_wire', '_parent')
+
+    # Attributes that never appear on the wire, so assigning them keeps the cache
+    LOCAL_FIELDS = frozenset()
+
+    def __init__(self, parent=None):
+        object.__setattr__(self, '_wire', None)
+        object.__setattr__(self, '_parent', parent)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != '_' and name not in self.LOCAL_FIELDS:
+            self.touch()
+
+    def touch(self):
+        # A parent only holds a cached wire form while its children do, so stop at the first clean node
+        node = self
+        while node is not None and node._wire is not None:
+            object.__setattr__(node, '_wire', None)
+            node = node._parent
+
+    def to_wire(self):
+        if self._wire is None:
+            object.__setattr__(self, '_wire', self._build_wire())
+        return self._wire
+
+    def _build_wire(self):
+        raise NotImplementedError
+
+
+class Song(Model):
+    __slots__ = ('title', 'artist', 'year', 'url')
+
+    def __init__(self, title, artist, year, url):
+        super().__init__()
+        self.title = title
+        self.artist = artist
+        self.year = year
+        self.url = url
+
+    @classmethod
+    def from_wire(cls, data):
+        """Build a Song from client data; raises KeyError/TypeError/ValueError/OverflowError on bad input."""
+        return cls(str(data['title']), str(data['artist']), int(data['year']), str(data['url']))
+
+    def _build_wire(self):
+        return {'title': self.title, 'artist': self.artist, 'year': self.year, 'url': self.url}
+
+
+class Timeline(Model):
+    """A team's cards in year order, with a parallel year array for O(log n) lookups.
+
+    Tie-break for equal years: a card belongs *after* every card that
+    already has its year. correct_pos() is therefore bisect_right, and only
+    that slot counts as a correct placement; insert() puts the card in that
+    same slot, so repeated years keep their arrival order.
+    """
+    __slots__ = ('songs', 'years')
+
+    def __init__(self, songs=(), parent=None):
+        super().__init__(parent)
+        ordered = sorted(songs, key=_song_year)
+        self.songs = ordered
+        self.years = [song.year for song in ordered]
+
+    def __len__(self):
+        return len(self.songs)
+
+    def __iter__(self):
+        return iter(self.songs)
+
+    def __getitem__(self, index):
+        return self.songs[index]
+
+    def correct_pos(self, year):
+        """Index (0-based) where a card from `year` belongs."""
+        return bisect_right(self.years, year)
+
+    def is_correct(self, pos, year):
+        return pos == bisect_right(self.years, year)
+
+    def insert(self, song):
+        """Insert a card in its year slot and return the index it landed on."""
+        index = bisect_right(self.years, song.year)
+        self.years.insert(index, song.year)
+        self.songs.insert(index, song)
+        self.touch()
+        return index
+
+    def extend(self, songs):
+        """Bulk insert, same result as insert() per card but one O(n + k log k) merge.
+
+        Meant for endless/solo variants that add many cards to long timelines.
+        """
+        incoming = sorted(songs, key=_song_year)
+        if not incoming:
+            return
+        # heapq.merge is stable across inputs, so existing cards stay ahead of equal-year newcomers
+        self.songs = list(heapq.merge(self.songs, incoming, key=_song_year))
+        self.years = [song.year for song in self.songs]
+
+    def correct_positions(self, years):
+        """correct_pos() for many years at once, e.g. to score a batch of solo placements."""
+        return [bisect_right(self.years, year) for year in years]
+
+    def _build_wire(self):
+        return [song.to_wire() for song in self.songs]
+
+
+def _song_year(song):
+    return song.year
+
+
+class Player(Model):
+    __slots__ = ('sid', 'name', 'team', 'secret')
+
+    # The secret proves a rejoin-room comes from this seat's client; it never goes on the wire
+    LOCAL_FIELDS = frozenset({'team', 'secret'})
+
+    def __init__(self, sid, name, secret=None, parent=None):
+        super().__init__(parent)
+        self.sid = sid
+        self.name = name
+        self.team = None
+        self.secret = secret
+
+    def _build_wire(self):
+        return {'sid': self.sid, 'name': self.name}
+
+
+class VoteTally:
+    """Votes per position, kept up to date as votes change so the leaders are known in O(1).
+
+    `buckets` maps a vote count to the positions that have exactly that many
+    votes, and `top` is the highest count. A vote moving from one position
+    to another shifts each of them one bucket, and `top` can only drop when
+    its bucket empties.
+    """
+    __slots__ = ('counts', 'buckets', 'top')
+
+    def __init__(self, votes=()):
+        self.counts = {}  # position -> votes
+        self.buckets = {}  # votes -> set of positions
+        self.top = 0
+        for pos in votes:
+            self.add(pos)
+
+    def _move(self, pos, old, new):
+        if old:
+            bucket = self.buckets[old]
+            bucket.discard(pos)
+            if not bucket:
+                del self.buckets[old]
+                if old == self.top and new < old:
+                    self.top = new
+        if new:
+            self.buckets.setdefault(new, set()).add(pos)
+            self.counts[pos] = new
+            if new > self.top:
+                self.top = new
+        else:
+            del self.counts[pos]
+
+    def add(self, pos):
+        count = self.counts.get(pos, 0)
+        self._move(pos, count, count + 1)
+
+    def remove(self, pos):
+        count = self.counts[pos]
+        self._move(pos, count, count - 1)
+
+    def leaders(self):
+        """Positions that share the highest vote count (empty without votes)."""
+        return self.buckets.get(self.top, set())
+
+
+class Team(Model):
+    __slots__ = ('id', 'name', 'players', 'score', 'tokens', 'timeline', 'oracle', 'votes', 'tally')
+
+    LOCAL_FIELDS = frozenset({'id', 'tally'})
+
+    def __init__(self, team_id, name, parent=None):
+        super().__init__(parent)
+        self.id = team_id
+        self.name = name
+        self.players = {}  # Ordered set: sid -> Player in join order
+        self.score = 0
+        self.tokens = 2
+        self.timeline = Timeline(parent=self)
+        self.oracle = None
+        self.votes = {}  # sid -> position
+        self.tally = VoteTally()
+
+    def reset(self):
+        self.timeline = Timeline(parent=self)
+        self.score = 0
+        self.tokens = 2
+        self.clear_votes()
+
+    def set_timeline(self, songs):
+        self.timeline = Timeline(songs, parent=self)
+
+    def add_player(self, player):
+        self.players[player.sid] = player
+        self.touch()
+
+    def remove_player(self, sid):
+        if self.players.pop(sid, None) is not None:
+            self.touch()
+
+    def set_vote(self, sid, pos):
+        """Record a vote; returns the positions whose count changed."""
+        old = self.votes.get(sid)
+        if old == pos:
+            return ()
+        self.votes[sid] = pos
+        self.tally.add(pos)
+        self.touch()
+        if old is None:
+            return (pos,)
+        self.tally.remove(old)
+        return (old, pos)
+
+    def load_votes(self, votes):
+        self.votes = dict(votes)
+        self.tally = VoteTally(self.votes.values())
+
+    def clear_votes(self):
+        self.votes = {}
+        self.tally = VoteTally()
+
+    def winning_vote(self):
+        """The placement the votes decide, or None without votes.
+
+        A tie goes to the oracle's position if the oracle voted for one of the
+        tied positions. Otherwise it goes to the tied position that got its
+        vote from the earliest voter.
+        """
+        leaders = self.tally.leaders()
+        if len(leaders) <= 1:
+            return next(iter(leaders), None)
+        oracle_vote = self.votes.get(self.oracle) if self.oracle else None
+        if oracle_vote in leaders:
+            return oracle_vote
+        return next(pos for pos in self.votes.values() if pos in leaders)
+
+    def _build_wire(self):
+        return {
+            'name': self.name,
+            'players': [p.to_wire() for p in self.players.values()],
+            'score': self.score,
+            'tokens': self.tokens,
+            'timeline': self.timeline.to_wire(),
+            'oracle': self.oracle,
+            'votes': dict(self.votes)
+        }
+
+
+class Room(Model):
+    __slots__ = (
+        'code', 'host', 'players', 'teams', 'game_state', 'turn_state', 'active_team',
+        'current_song', 'current_placement', 'current_challenge', 'target_score',
+        'token_claimed', 'history', 'played', 'playlist_tracks', 'playlist_hash',
+        'song_deck', 'deck_refilling', 'ready_players', 'version', 'wire_state'
+    )
+
+    LOCAL_FIELDS = frozenset({
+        'current_song', 'token_claimed', 'played', 'playlist_tracks', 'song_deck',
+        'deck_refilling', 'ready_players', 'version', 'wire_state'
+    })
+
+    # Songs kept in history (and on the wire); older ones only live on in `played`
+    HISTORY_LIMIT = 200
+
+    def __init__(self, code, host):
+        super().__init__()
+        self.code = code
+        self.host = host
+        self.players = {}  # sid -> Player
+        self.teams = {
+            'team1': Team('team1', 'Team 1', parent=self),
+            'team2': Team('team2', 'Team 2', parent=self)
+        }
+        self.game_state = 'lobby'
+        self.turn_state = 'playing'
+        self.active_team = 'team1'
+        self.current_song = None
+        self.current_placement = None
+        self.current_challenge = None
+        self.target_score = 10
+        self.token_claimed = False
+        self.history = []
+        self.played = {}  # title -> artists already played, for duplicate checks
+        self.playlist_tracks = ()  # Shared, immutable tuple from the playlist cache
+        self.playlist_hash = None
+        self.song_deck = deque()  # Prefetched Songs ready to be dealt
+        self.deck_refilling = False
+        self.ready_players = set()
+        self.version = 0
+        self.wire_state = None  # Last broadcast room-update state, base for the next patch
+
+    def add_player(self, player):
+        object.__setattr__(player, '_parent', self)
+        self.players[player.sid] = player
+        self.touch()
+
+    def remove_player(self, sid):
+        player = self.players.pop(sid, None)
+        if player is not None:
+            self.touch()
+        return player
+
+    def add_history(self, song):
+        self.history.append(song)
+        # title -> artists, mirrors the duplicate check the client used to do
+        self.played.setdefault(song.title.lower().strip(), []).append(song.artist.lower().strip())
+        if len(self.history) > self.HISTORY_LIMIT + self.HISTORY_LIMIT // 4:
+            # Trim in chunks so room-update deltas are plain appends between trims; played keeps everything
+            self.history = self.history[-self.HISTORY_LIMIT:]
+        self.touch()
+
+    def clear_history(self):
+        self.history = []
+        self.played = {}
+
+    def is_played(self, artist, title):
+        artists = self.played.get(title.lower().strip())
+        if not artists:
+            return False
+        artist = artist.lower().strip()
+        return any(a == artist or a in artist for a in artists)
+
+    def assign_team(self, sid, team_id):
+        """Move a player to team_id (None removes them from their team)."""
+        player = self.players[sid]
+        if player.team:
+            self.teams[player.team].remove_player(sid)
+        player.team = team_id
+        if team_id:
+            self.teams[team_id].add_player(player)
+
+    def replace_sid(self, old, new):
+        """Give a reconnecting player's seat (team, votes, host, oracle) to their new socket id."""
+        if new in self.players:
+            raise ValueError(f"{new} already holds a seat")
+        player = self.players[old]
+        self.players = {new if sid == old else sid: p for sid, p in self.players.items()}
+        player.sid = new
+        if player.team:
+            team = self.teams[player.team]
+            team.players = {new if sid == old else sid: p for sid, p in team.players.items()}
+            if team.oracle == old:
+                team.oracle = new
+            if old in team.votes:
+                team.votes = {new if sid == old else sid: pos for sid, pos in team.votes.items()}
+        if self.host == old:
+            self.host = new
+        if old in self.ready_players:
+            self.ready_players.discard(old)
+            self.ready_players.add(new)
+
+    def other_team(self, team_id):
+        return 'team2' if team_id == 'team1' else 'team1'
+
+    def teams_wire(self):
+        return {team_id: team.to_wire() for team_id, team in self.teams.items()}
+
+    def _build_wire(self):
+        return {
+            'roomCode': self.code,
+            'players': {sid: p.name for sid, p in self.players.items()},
+            'teams': self.teams_wire(),
+            'gameState': self.game_state,
+            'turnState': self.turn_state,
+            'activeTeam': self.active_team,
+            'currentPlacement': self.current_placement,
+            'currentChallenge': self.current_challenge,
+            'targetScore': self.target_score,
+            'playlistHash': self.playlist_hash,
+            'playlistCount': len(self.playlist_tracks),
+            'history': [s.to_wire() for s in self.history],
+            'host': self.host
+        }
+
+    def footprint(self):
+        """Approximate bytes held by this room, excluding the shared playlist tuple."""
+        return deep_sizeof(self, exclude={id(self.playlist_tracks)})
+
+    def to_dict(self):
+        """Full JSON-safe state for stores and snapshots. The playlist is kept by hash only."""
+        return {
+            'code': self.code,
+            'host': self.host,
+            'players': [[p.sid, p.name, p.team, p.secret] for p in self.players.values()],
+            'teams': {
+                team_id: {
+                    'name': team.name,
+                    'players': list(team.players),
+                    'score': team.score,
+                    'tokens': team.tokens,
+                    'timeline': team.timeline.to_wire(),
+                    'oracle': team.oracle,
+                    'votes': list(team.votes.items())
+                }
+                for team_id, team in self.teams.items()
+            },
+            'game_state': self.game_state,
+            'turn_state': self.turn_state,
+            'active_team': self.active_team,
+            'current_song': self.current_song.to_wire() if self.current_song else None,
+            'current_placement': self.current_placement,
+            'current_challenge': self.current_challenge,
+            'target_score': self.target_score,
+            'token_claimed': self.token_claimed,
+            'history': [s.to_wire() for s in self.history],
+            'played': {title: list(artists) for title, artists in self.played.items()},
+            'playlist_hash': self.playlist_hash,
+            'song_deck': [s.to_wire() for s in self.song_deck],
+            'deck_refilling': self.deck_refilling,
+            'ready_players': list(self.ready_players),
+            'version': self.version,
+            'wire_state': self.wire_state
+        }
+
+    @classmethod
+    def from_dict(cls, data, playlist_tracks=()):
+        room = cls(data['code'], data['host'])
+        for sid, name, team_id, *secret in data['players']:
+            # Snapshots from before seat secrets have none; those seats can't be rejoined
+            player = Player(sid, name, secret[0] if secret else None)
+            player.team = team_id
+            room.add_player(player)
+        for team_id, team_data in data['teams'].items():
+            team = room.teams[team_id]
+            team.name = team_data['name']
+            for sid in team_data['players']:
+                team.add_player(room.players[sid])
+            team.score = team_data['score']
+            team.tokens = team_data['tokens']
+            team.set_timeline([Song.from_wire(s) for s in team_data['timeline']])
+            team.oracle = team_data['oracle']
+            # Votes are [sid, pos] pairs so integer positions survive JSON
+            team.load_votes(team_data['votes'])
+        room.game_state = data['game_state']
+        room.turn_state = data['turn_state']
+        room.active_team = data['active_team']
+        room.current_song = Song.from_wire(data['current_song']) if data['current_song'] else None
+        room.current_placement = data['current_placement']
+        room.current_challenge = data['current_challenge']
+        room.target_score = data['target_score']
+        room.token_claimed = data['token_claimed']
+        room.history = [Song.from_wire(s) for s in data['history']]
+        room.played = {title: list(artists) for title, artists in data['played'].items()}
+        room.playlist_tracks = playlist_tracks
+        room.playlist_hash = data['playlist_hash']
+        room.song_deck = deque(Song.from_wire(s) for s in data['song_deck'])
+        room.deck_refilling = data['deck_refilling']
+        room.ready_players = set(data['ready_players'])
+        room.version = data['version']
+        room.wire_state = data['wire_state']
+        return room
+
+
+def deep_sizeof(obj, exclude=None, _seen=None):
+    seen = _seen if _seen is not None else set(exclude or ())
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, None, seen) + deep_sizeof(v, None, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(item, None, seen) for item in obj)
+    elif isinstance(obj, Model):
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if name != '_parent' and hasattr(obj, name):
+                    size += deep_sizeof(getattr(obj, name), None, seen)
+    return size
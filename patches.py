@@ -0,0 +1,80 @@
+"""Minimal JSON patch (RFC 6902) support shared by room-update deltas and the room journal."""
+
+
+def json_pointer_escape(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def json_diff(old, new, path='', ops=None):
+    """JSON-patch (RFC 6902) operations that turn `old` into `new`.
+
+    Only add/remove/replace are produced. Lists that grew by appending get
+    `add` ops on `/-` so history and timelines don't resend their prefix,
+    and a single insertion is one indexed `add`; any other list change
+    replaces the whole list.
+    """
+    if ops is None:
+        ops = []
+    if old == new:
+        return ops
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                ops.append({'op': 'remove', 'path': f"{path}/{json_pointer_escape(key)}"})
+        for key, value in new.items():
+            child = f"{path}/{json_pointer_escape(key)}"
+            if key not in old:
+                ops.append({'op': 'add', 'path': child, 'value': value})
+            else:
+                json_diff(old[key], value, child, ops)
+    elif isinstance(old, list) and isinstance(new, list) and len(new) > len(old) and new[:len(old)] == old:
+        for value in new[len(old):]:
+            ops.append({'op': 'add', 'path': f"{path}/-", 'value': value})
+    elif isinstance(old, list) and isinstance(new, list) and len(new) == len(old) + 1:
+        # One card slotted into a timeline: a single add at its index
+        index = next(i for i, value in enumerate(old) if new[i] != value)
+        if new[index + 1:] == old[index:]:
+            ops.append({'op': 'add', 'path': f"{path}/{index}", 'value': new[index]})
+        else:
+            ops.append({'op': 'replace', 'path': path, 'value': new})
+    else:
+        ops.append({'op': 'replace', 'path': path, 'value': new})
+    return ops
+
+
+def json_pointer_unescape(key):
+    return key.replace('~1', '/').replace('~0', '~')
+
+
+def apply_patch(doc, patch):
+    """Apply json_diff() output to `doc` in place and return the result.
+
+    Mirrors applyJsonPatch() in public/app.js. The return value only differs
+    from `doc` when the patch replaces the root.
+    """
+    for op in patch:
+        if not op['path']:
+            doc = op['value']
+            continue
+        keys = op['path'].split('/')[1:]
+        if '~' in op['path']:
+            keys = [json_pointer_unescape(k) for k in keys]
+        last = keys.pop()
+        parent = doc
+        for key in keys:
+            parent = parent[int(key)] if isinstance(parent, list) else parent[key]
+        if op['op'] == 'remove':
+            if isinstance(parent, list):
+                del parent[int(last)]
+            else:
+                del parent[last]
+        elif isinstance(parent, list):
+            if last == '-':
+                parent.append(op['value'])
+            elif op['op'] == 'add':
+                parent.insert(int(last), op['value'])
+            else:
+                parent[int(last)] = op['value']
+        else:
+            parent[last] = op['value']
+    return doc
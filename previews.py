@@ -0,0 +1,176 @@
+"""Disk cache for the audio previews every player in a room streams at once.
+
+A room of phones used to fetch each clip straight from Apple, all at the
+same moment of new-song. Now the server fetches it once into `directory`
+and serves it from there, with Range support (see /api/preview/<id> in
+app.py). Concurrent requests for a clip that is still downloading wait
+for that one download. warm() starts the download ahead of time, for the
+next song in a room's deck.
+
+Only URLs handed out through register() can be fetched, and only from
+`allowed_hosts`, so the endpoint is not an open proxy. Files are named by
+a hash of their URL and evicted least recently used first once the cache
+holds more than `max_bytes`. After a restart the files already on disk
+are reused, oldest download first in the eviction order.
+"""
+import os
+import re
+import hashlib
+import logging
+import mimetypes
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import runtime
+
+log = logging.getLogger('tunetimeline.previews')
+
+MAX_FILE_BYTES = 8 * 2**20  # Apple's 30 second clips are well under 2 MiB
+_CLIP_NAME = re.compile(r'^[0-9a-f]{24}(\.[a-z0-9]+)?$')
+
+
+def preview_id(url):
+    return hashlib.sha256(url.encode()).hexdigest()[:24]
+
+
+class PreviewCache:
+
+    def __init__(self, directory, max_bytes, fetch, allowed_hosts=(), max_ids=20000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fetch = fetch  # url -> bytes; raises on failure
+        self.allowed_hosts = tuple(host.lower() for host in allowed_hosts)
+        self.max_ids = max_ids
+        self._urls = OrderedDict()  # preview id -> url, for ids handed out to clients
+        self._files = OrderedDict()  # preview id -> (file name, size), least recently used first
+        self._bytes = 0
+        self._inflight = {}  # preview id -> Event for the download in progress
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.warmed = 0
+        self.failures = 0
+        self.evictions = 0
+        self.fetched_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        entries = [entry for entry in os.scandir(directory)
+                   if entry.is_file() and _CLIP_NAME.match(entry.name)]  # Skips .tmp leftovers too
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            self._add(entry.name[:24], entry.name, entry.stat().st_size)
+        self._evict()
+        log.info("Preview cache holds %d clips, %d MB", len(self._files), self._bytes // 2**20)
+
+    def allowed(self, url):
+        parts = urlsplit(url)
+        host = (parts.hostname or '').lower()
+        return parts.scheme in ('http', 'https') and any(
+            host == allowed or host.endswith('.' + allowed) for allowed in self.allowed_hosts
+        )
+
+    def register(self, url):
+        """Preview id clients may request for `url`; None if it can't be proxied."""
+        if not url or not self.allowed(url):
+            return None
+        key = preview_id(url)
+        self._urls[key] = url
+        self._urls.move_to_end(key)
+        while len(self._urls) > self.max_ids:
+            self._urls.popitem(last=False)
+        return key
+
+    def url(self, key):
+        return self._urls.get(key)
+
+    def get(self, key):
+        """(path, mimetype) of a cached clip, downloading it first if needed; None for unknown ids.
+
+        Raises whatever fetch() raised if the download fails.
+        """
+        entry = self._files.get(key)
+        if entry is not None:
+            self._files.move_to_end(key)
+            self.hits += 1
+            return self._located(entry[0])
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return pending.wait()
+        if key not in self._urls:
+            return None
+        self.misses += 1
+        return self._download(key)
+
+    def warm(self, url):
+        """Download `url` in the background unless it is cached or on its way."""
+        key = self.register(url)
+        if key is None or key in self._files or key in self._inflight:
+            return
+        self.warmed += 1
+        runtime.spawn(self._warm, key)
+
+    def _warm(self, key):
+        try:
+            self._download(key)
+        except Exception as e:
+            log.warning("Preview prefetch failed: %s", e)
+
+    def _download(self, key):
+        event = self._inflight[key] = runtime.Event()
+        url = self._urls[key]
+        try:
+            body = self.fetch(url)
+            if len(body) > MAX_FILE_BYTES:
+                raise ValueError(f"preview too large ({len(body)} bytes)")
+            ext = os.path.splitext(urlsplit(url).path)[1].lower()
+            name = key + (ext if mimetypes.guess_type('x' + ext)[0] else '')
+            path = os.path.join(self.directory, name)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(body)
+            os.replace(path + '.tmp', path)  # Readers never see a partial file
+        except Exception as e:
+            self.failures += 1
+            del self._inflight[key]
+            event.send_exception(e)
+            raise
+        self.fetched_bytes += len(body)
+        self._add(key, name, len(body))
+        self._evict()
+        del self._inflight[key]
+        located = self._located(name)
+        event.send(located)
+        return located
+
+    def _add(self, key, name, size):
+        previous = self._files.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous[1]
+        self._files[key] = (name, size)
+        self._bytes += size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._files) > 1:
+            key, (name, size) = self._files.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _located(self, name):
+        return os.path.join(self.directory, name), mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    def stats(self):
+        return {
+            'clips': len(self._files),
+            'bytes': self._bytes,
+            'maxBytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'warmed': self.warmed,
+            'failures': self.failures,
+            'evictions': self.evictions,
+            'fetchedBytes': self.fetched_bytes,
+            'inflight': len(self._inflight)
+        }
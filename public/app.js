@@ -134,11 +134,21 @@ const displayRoomCode = document.getElementById('display-room-code');
 const gameRoomCode = document.getElementById('game-room-code');
 const audioEl = document.getElementById('game-audio');
 
+let audioFallbackUrl = null; // The original preview URL while we play the server's cached copy
+
 // Detailed diagnostics for iPad audio state
 audioEl.addEventListener('error', () => {
     const err = audioEl.error;
     logToOverlay(`audioEl Error: ${err ? err.code : '?'}`);
     if (err && err.code === 4) logToOverlay("-> SRC_NOT_SUPPORTED (Check URL/network)");
+    if (audioFallbackUrl) {
+        // The cached copy failed (e.g. another worker answered 404): stream from Apple instead
+        logToOverlay("-> Falling back to the original URL");
+        audioEl.src = audioFallbackUrl;
+        audioFallbackUrl = null;
+        audioEl.load();
+        audioEl.play().catch(e => console.warn("Fallback play failed:", e));
+    }
 });
 audioEl.addEventListener('stalled', () => logToOverlay("audioEl: Stalled... ⏳"));
 audioEl.addEventListener('waiting', () => logToOverlay("audioEl: Waiting for data... ⏳"));
@@ -182,6 +192,23 @@ const closeAdminBtn = document.getElementById('close-admin-btn');
 const adminTargetScore = document.getElementById('admin-target-score');
 
 let adminTracks = [];
+let adminTracksHash = null;
+
+// Playlists are content-addressed and immutable, so the browser cache can keep them forever
+async function loadPlaylistTracks(hash) {
+    if (!hash || hash === adminTracksHash) return;
+    adminTracksHash = hash;
+    try {
+        // roomCode only steers the shard router; the body is the same for every room
+        const query = myRoomCode ? `?roomCode=${encodeURIComponent(myRoomCode)}` : '';
+        const response = await fetch(`/api/playlists/${hash}${query}`);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        adminTracks = await response.json();
+    } catch (err) {
+        adminTracksHash = null;
+        logToOverlay(`Playlist fetch failed: ${err.message}`);
+    }
+}
 
 // --- Resilient Fetch Helper ---
 async function fetchWithRetry(url, options = {}, retries = 3, backoff = 1000) {
@@ -216,8 +243,87 @@ function updatePlayerList(players) {
         unassignedList.appendChild(li);
     });
 }
+// Room updates and reveals are much smaller (and cheaper for the server) as MessagePack.
+// Add ?wire=json to the page URL to get plain JSON events, e.g. when debugging.
+const WIRE_FORMAT = new URLSearchParams(location.search).get('wire') === 'json' ? 'json' : 'msgpack';
+
+// Minimal MessagePack decoder for what the server sends: nil, bools, numbers, strings, binary, arrays and maps
+function decodeMsgpack(buffer) {
+    const bytes = new Uint8Array(buffer);
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    const text = new TextDecoder();
+    let offset = 0;
+
+    function str(length) {
+        const value = text.decode(bytes.subarray(offset, offset + length));
+        offset += length;
+        return value;
+    }
+    function bin(length) {
+        const value = bytes.slice(offset, offset + length);
+        offset += length;
+        return value;
+    }
+    function array(length) {
+        const value = new Array(length);
+        for (let i = 0; i < length; i++) value[i] = read();
+        return value;
+    }
+    function map(length) {
+        const value = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            value[key] = read();
+        }
+        return value;
+    }
+    function read() {
+        const type = bytes[offset++];
+        if (type <= 0x7f) return type;
+        if (type <= 0x8f) return map(type & 0x0f);
+        if (type <= 0x9f) return array(type & 0x0f);
+        if (type <= 0xbf) return str(type & 0x1f);
+        if (type >= 0xe0) return type - 0x100;
+        let value;
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: value = view.getUint8(offset); offset += 1; return bin(value);
+            case 0xc5: value = view.getUint16(offset); offset += 2; return bin(value);
+            case 0xc6: value = view.getUint32(offset); offset += 4; return bin(value);
+            case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+            case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+            case 0xcc: return view.getUint8(offset++);
+            case 0xcd: value = view.getUint16(offset); offset += 2; return value;
+            case 0xce: value = view.getUint32(offset); offset += 4; return value;
+            case 0xcf: value = Number(view.getBigUint64(offset)); offset += 8; return value;
+            case 0xd0: return view.getInt8(offset++);
+            case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+            case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+            case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+            case 0xd9: value = view.getUint8(offset); offset += 1; return str(value);
+            case 0xda: value = view.getUint16(offset); offset += 2; return str(value);
+            case 0xdb: value = view.getUint32(offset); offset += 4; return str(value);
+            case 0xdc: value = view.getUint16(offset); offset += 2; return array(value);
+            case 0xdd: value = view.getUint32(offset); offset += 4; return array(value);
+            case 0xde: value = view.getUint16(offset); offset += 2; return map(value);
+            case 0xdf: value = view.getUint32(offset); offset += 4; return map(value);
+        }
+        throw new Error(`Unsupported MessagePack type 0x${type.toString(16)}`);
+    }
+    return read();
+}
+
+// Events in BINARY_EVENTS on the server arrive as one binary argument for MessagePack clients
+function wireData(payload) {
+    if (payload instanceof ArrayBuffer || ArrayBuffer.isView(payload)) return decodeMsgpack(payload);
+    return payload;
+}
+
 // Robust Socket.IO initialization with improved mobile settings
 const socket = io({
+    query: { wire: WIRE_FORMAT },
     transports: ['websocket', 'polling'], // Prefer WebSockets, fall back to polling
     upgrade: true,
     reconnection: true,
@@ -242,11 +348,23 @@ socket.on('connect_error', (err) => {
     document.body.insertAdjacentElement('afterbegin', div);
 });
 
+let lastSocketId = null; // Our previous sid, which still owns our seat in the room after a reconnect
+let mySeatSecret = null; // Proves that seat is ours; only this socket is ever sent it
+
+socket.on('seat', ({ sid, seatSecret }) => {
+    if (sid === socket.id) mySeatSecret = seatSecret;
+});
+
 socket.on('connect', () => {
     const errorEl = document.getElementById('conn-error');
     if (errorEl) errorEl.remove();
     console.log("Connected to server!");
     updateConnStatus("Connected", "green");
+    if (myRoomCode && lastSocketId && lastSocketId !== socket.id) {
+        logToOverlay(`Emit: rejoin-room (${myRoomCode})`);
+        socket.emit('rejoin-room', { roomCode: myRoomCode, sid: lastSocketId, userName: myName, seatSecret: mySeatSecret });
+    }
+    lastSocketId = socket.id;
 });
 
 socket.on('reconnecting', (attempt) => {
@@ -261,6 +379,23 @@ socket.on('error-msg', (msg) => {
     showNotification("Fout", msg);
 });
 
+// Sharded deployments route /socket.io by the roomCode query parameter. Pin the
+// connection to a room so (re)connects land on the worker that owns it.
+function routeSocketToRoom(roomCode) {
+    socket.io.opts.query = { roomCode, wire: WIRE_FORMAT };
+}
+
+socket.on('wrong-shard', ({ roomCode }) => {
+    logToOverlay(`Recv: wrong-shard (${roomCode})`);
+    if (socket.io.opts.query && socket.io.opts.query.roomCode === roomCode) {
+        // Already routed for this room and still on the wrong worker: the router is misconfigured
+        return showNotification("Fout", "Deze party is nu niet bereikbaar.");
+    }
+    routeSocketToRoom(roomCode);
+    socket.once('connect', () => socket.emit('join-room', { roomCode, userName: myName }));
+    socket.disconnect().connect();
+});
+
 
 // State
 let myRoomCode = null;
@@ -278,7 +413,8 @@ let roomHistory = [];
 let activeMobileTab = 'team1'; // New: tracks which team timeline is visible on mobile
 
 // Voting State
-let teamVotes = {}; // { sid: pos } - votes from my team
+let teamVoteCounts = {}; // { pos: count } - votes from my team
+let teamVoteTotal = 0; // How many teammates have voted
 let myVote = null; // My current vote position
 let hasVoted = false;
 let isCountingDown = false;
@@ -640,7 +776,8 @@ socket.on('game-reset', () => {
     currentSongData = null;
     currentPlacement = null;
     currentChallenge = null;
-    teamVotes = {};
+    teamVoteCounts = {};
+    teamVoteTotal = 0;
     myVote = null;
     hasVoted = false;
 
@@ -715,7 +852,8 @@ socket.on('challenge-submitted', (data) => {
     renderTimelines();
 });
 
-socket.on('year-revealed', ({ results, teams, nextTeam, winner }) => {
+socket.on('year-revealed', (payload) => {
+    const { results, teams, nextTeam, winner } = wireData(payload);
     teamsData = teams;
     activeTeam = nextTeam;
     turnState = 'playing';
@@ -787,8 +925,8 @@ socket.on('error-msg', (msg) => {
     loadPlaylistBtn.disabled = false;
 });
 
-socket.on('playlist-loaded', ({ count, tracks }) => {
-    adminTracks = tracks;
+socket.on('playlist-loaded', ({ count, hash }) => {
+    loadPlaylistTracks(hash);
     showNotification("Playlist Geladen", `Loaded ${count} tracks from Spotify!`);
     loadPlaylistBtn.innerText = "Load Playlist";
     loadPlaylistBtn.disabled = false;
@@ -847,15 +985,15 @@ joinTeamBtns.forEach(btn => {
 socket.on('room-created', ({ roomCode, userName }) => {
     logToOverlay(`Recv: room-created (${roomCode})`);
     myRoomCode = roomCode;
+    routeSocketToRoom(roomCode);
     displayRoomCode.innerText = roomCode;
     startBtn.classList.remove('hidden');
     showScreen(waitingScreen);
     updatePlayerList([{ name: userName }]);
 });
 
-socket.on('playlist-loaded', ({ count, tracks }) => {
+socket.on('playlist-loaded', ({ count, hash }) => {
     logToOverlay(`Recv: playlist-loaded (${count})`);
-    adminTracks = tracks;
     loadPlaylistBtn.innerText = "Load";
     loadPlaylistBtn.disabled = false;
     showNotification("Success", `Playlist geladen! ${count} nummers toegevoegd aan de wachtrij.`);
@@ -878,8 +1016,67 @@ socket.on('player-joined', (players) => {
     // Legacy support or simplified list
 });
 
-socket.on('room-update', (data) => {
-    const { roomCode, players, teams, gameState, turnState: serverTurnState, activeTeam: serverActiveTeam, currentPlacement: serverPlacement, currentChallenge: serverChallenge, targetScore: serverTargetScore, playlistTracks, history: serverHistory, host: serverHostSid } = data;
+// --- Versioned room state ---
+// The server sends a full snapshot ({ version, state }) once and JSON-patch
+// deltas ({ baseVersion, version, patch }) afterwards. A patch only applies
+// on top of the version it was made against; otherwise we ask for a snapshot.
+let roomState = null;
+let roomVersion = null;
+let awaitingSnapshot = false;
+
+function applyJsonPatch(doc, patch) {
+    patch.forEach(({ op, path, value }) => {
+        const keys = path.split('/').slice(1).map(k => k.replace(/~1/g, '/').replace(/~0/g, '~'));
+        const last = keys.pop();
+        const parent = keys.reduce((obj, key) => obj[key], doc);
+        if (op === 'remove') {
+            if (Array.isArray(parent)) parent.splice(Number(last), 1);
+            else delete parent[last];
+        } else if (Array.isArray(parent) && op === 'add') {
+            if (last === '-') parent.push(value);
+            else parent.splice(Number(last), 0, value);
+        } else {
+            parent[last] = value;
+        }
+    });
+}
+
+// After a (re)join the vote-update deltas so far were missed, so count from the snapshot
+function rebuildVoteCounts(state) {
+    const team = Object.values(state.teams || {}).find(t => t.players.some(p => p.sid === socket.id));
+    const votes = Object.values(team?.votes || {});
+    teamVoteCounts = {};
+    votes.forEach(pos => { teamVoteCounts[pos] = (teamVoteCounts[pos] || 0) + 1; });
+    teamVoteTotal = votes.length;
+}
+
+function requestRoomSnapshot(roomCode) {
+    if (awaitingSnapshot) return;
+    awaitingSnapshot = true;
+    logToOverlay(`Room state out of sync (v${roomVersion}), requesting snapshot`);
+    socket.emit('request-room-state', { roomCode });
+}
+
+socket.on('room-update', (payload) => {
+    const msg = wireData(payload);
+    if (msg.state) {
+        if (roomVersion !== null && msg.version < roomVersion && msg.state.roomCode === roomState?.roomCode) return;
+        roomState = msg.state;
+        roomVersion = msg.version;
+        awaitingSnapshot = false;
+        rebuildVoteCounts(roomState);
+    } else if (roomState && msg.baseVersion === roomVersion) {
+        applyJsonPatch(roomState, msg.patch);
+        roomVersion = msg.version;
+    } else {
+        if (roomVersion === null || msg.version > roomVersion) requestRoomSnapshot(msg.roomCode);
+        return;
+    }
+    renderRoomState(roomState);
+});
+
+function renderRoomState(data) {
+    const { roomCode, players, teams, gameState, turnState: serverTurnState, activeTeam: serverActiveTeam, currentPlacement: serverPlacement, currentChallenge: serverChallenge, targetScore: serverTargetScore, playlistHash, history: serverHistory, host: serverHostSid } = data;
 
     // Sync host status
     if (serverHostSid) {
@@ -906,10 +1103,8 @@ socket.on('room-update', (data) => {
 
         if (document.activeElement !== targetScoreInput) targetScoreInput.value = targetScore;
 
-        // Sync playlist tracks if host refreshes
-        if (playlistTracks && playlistTracks.length > 0) {
-            adminTracks = playlistTracks;
-        }
+        // Sync playlist tracks if host refreshes (only refetched when the hash changes)
+        loadPlaylistTracks(playlistHash);
     } else {
         hostControls.classList.add('hidden'); // Hide for non-hosts
         hostSettings.classList.add('hidden');
@@ -1007,7 +1202,7 @@ socket.on('room-update', (data) => {
         else if (teams.team2.players.some(p => p.sid === socket.id)) myTeam = 'team2';
         else myTeam = null;
     }
-});
+}
 
 function renderChallengeInterface() {
     const interfaceEl = document.getElementById('challenge-interface');
@@ -1166,10 +1361,9 @@ socket.on('game-started', async () => {
     if (isHost) {
         logToOverlay("Host: Game Start detected. Initializing cards...");
         try {
-            const [team1Song, team2Song] = await Promise.all([
-                getTeamStarterSong(),
-                getTeamStarterSong()
-            ]);
+            // One after the other so a catalog pick can't deal both teams the same card
+            const team1Song = await getTeamStarterSong();
+            const team2Song = await getTeamStarterSong(team1Song.id ? [team1Song.id] : []);
             logToOverlay("Host: Starter cards loaded! Emitting init...");
             socket.emit('game-action', {
                 roomCode: myRoomCode,
@@ -1188,7 +1382,25 @@ socket.on('game-started', async () => {
     }
 });
 
-async function getTeamStarterSong() {
+// Random song from the server's local catalog (decades weighted equally); null if it has nothing yet
+async function fetchCatalogSong(exclude = []) {
+    try {
+        const params = exclude.length ? `?exclude=${exclude.join(',')}` : '';
+        const response = await fetch(`/api/songs/random${params}`, { cache: 'no-cache' });
+        if (!response.ok) return null;
+        return await response.json();
+    } catch (e) {
+        logToOverlay(`Catalog FAIL: ${e.message}`);
+        return null;
+    }
+}
+
+async function getTeamStarterSong(exclude = []) {
+    const song = await fetchCatalogSong(exclude);
+    if (song) {
+        logToOverlay(`Host: Catalog ${song.title.substring(0, 15)}`);
+        return song;
+    }
     const genres = ['classic', 'hits', 'pop', 'rock', 'dance'];
     const genre = genres[Math.floor(Math.random() * genres.length)];
     const url = `/api/proxy/itunes?term=${genre}&limit=20`;
@@ -1212,7 +1424,7 @@ async function getTeamStarterSong() {
     }
 }
 
-socket.on('new-song', ({ songData, activeTeam: serverActiveTeam, turnState: serverTurnState }) => {
+socket.on('new-song', ({ songData, activeTeam: serverActiveTeam, turnState: serverTurnState, preview }) => {
     logToOverlay("socket: new-song RECEIVED 📩");
 
     // Auto-recovery: If context is dead, try one more resume (sometimes works if already blessed)
@@ -1227,14 +1439,18 @@ socket.on('new-song', ({ songData, activeTeam: serverActiveTeam, turnState: serv
     currentChallenge = null;
 
     // Reset voting state
-    teamVotes = {};
+    teamVoteCounts = {};
+    teamVoteTotal = 0;
     myVote = null;
     hasVoted = false;
 
     logToOverlay(`Song: ${songData.artist} - ${songData.title}`);
-    logToOverlay(`Source: ${songData.url.substring(0, 40)}...`);
+    // The server's cached copy when it has one: fetched once for the whole room, and seekable
+    const source = preview || songData.url;
+    audioFallbackUrl = preview ? songData.url : null;
+    logToOverlay(`Source: ${source.substring(0, 40)}...`);
 
-    audioEl.src = songData.url;
+    audioEl.src = source;
     audioEl.load(); // Force load on mobile
 
     logToOverlay(`audioEl state: rS=${audioEl.readyState}, nS=${audioEl.networkState}`);
@@ -1452,9 +1668,8 @@ function renderTimelines() {
             zone.style.visibility = 'visible';
 
             // Show vote counts on own team's timeline (opponent can't see)
-            if (teamId === myTeam && myTeam === activeTeam && turnState === 'playing' && Object.keys(teamVotes).length > 0) {
-                // Count votes for this position
-                const votesForPos = Object.values(teamVotes).filter(v => v === pos).length;
+            if (teamId === myTeam && myTeam === activeTeam && turnState === 'playing' && teamVoteTotal > 0) {
+                const votesForPos = teamVoteCounts[pos] || 0;
 
                 // Check if this is my vote
                 if (myVote === pos) {
@@ -1642,12 +1857,15 @@ function handlePlacement(pos) {
     }
 }
 
-// Vote update handler (only received by own team members)
-socket.on('vote-update', ({ teamId, votes, voterCount }) => {
+// Vote update handler (only received by own team members): absolute counts for the positions that changed
+socket.on('vote-update', ({ teamId, counts, voteCount, voterCount }) => {
     if (teamId !== myTeam) return; // Safety check
 
-    teamVotes = votes;
-    const voteCount = Object.keys(votes).length;
+    counts.forEach(([pos, count]) => {
+        if (count > 0) teamVoteCounts[pos] = count;
+        else delete teamVoteCounts[pos];
+    });
+    teamVoteTotal = voteCount;
 
     // Update UI
     renderTimelines();
@@ -1781,8 +1999,20 @@ document.querySelectorAll('.preset-btn').forEach(btn => {
 });
 
 
-// Update fetchNextSong to use adminTracks if available
-async function fetchNextSong() {
+// Ask the server to deal the next song from the room's prefetched deck
+function fetchNextSong() {
+    console.log("Requesting next song from server deck...");
+    socket.emit('game-action', { roomCode: myRoomCode, action: 'next-song' });
+}
+
+// Deck not ready yet (no playlist or still resolving): search iTunes from the browser instead
+socket.on('song-deck-empty', () => {
+    logToOverlay("Server deck empty, searching locally...");
+    fetchNextSongFromItunes();
+});
+
+// Update fetchNextSongFromItunes to use adminTracks if available
+async function fetchNextSongFromItunes() {
     console.log("Fetching next song...");
     let retryCount = 0;
     const maxRetries = 10; // Fewer retries of the whole function, we'll loop inside instead
@@ -2034,7 +2264,8 @@ async function startSoloGame() {
     soloGameState = {
         timeline: [],
         score: 0,
-        lives: 3
+        lives: 3,
+        catalogIds: []  // Catalog songs already dealt, so they don't come back
     };
 
     // Mock teamsData for renderTimelines compatibility
@@ -2144,8 +2375,15 @@ function endSoloGame() {
 async function fetchSoloSong() {
     document.getElementById('song-msg').innerText = "Loading song...";
 
-    // Reuse the host fetch logic but just for one song
     try {
+        const song = await fetchCatalogSong(soloGameState.catalogIds.slice(-100));
+        if (song) {
+            soloGameState.catalogIds.push(song.id);
+            playSoloSong(song);
+            return;
+        }
+
+        // Catalog still empty: fall back to a random iTunes search
         const genres = ['80s hits', '90s hits', '2000s hits', '2010s hits', 'top 40', 'rock classics', 'pop hits'];
         const genre = genres[Math.floor(Math.random() * genres.length)];
 
@@ -2158,23 +2396,12 @@ async function fetchSoloSong() {
         // Simple random pick
         const track = results[Math.floor(Math.random() * results.length)];
 
-        currentSongData = {
+        playSoloSong({
             title: track.trackName,
             artist: track.artistName,
             year: new Date(track.releaseDate).getFullYear(),
             url: track.previewUrl
-        };
-
-        // Play Audio
-        if (audioEl) {
-            audioEl.src = currentSongData.url;
-            audioEl.play().catch(e => console.error("Auto-play failed:", e));
-        }
-
-        document.getElementById('song-msg').innerText = "🎵 Raad het jaar!";
-
-        // Render drag zones active
-        renderTimelines();
+        });
 
     } catch (e) {
         console.error("Solo fetch error:", e);
@@ -2183,6 +2410,21 @@ async function fetchSoloSong() {
     }
 }
 
+function playSoloSong(song) {
+    currentSongData = song;
+
+    // Play Audio
+    if (audioEl) {
+        audioEl.src = currentSongData.url;
+        audioEl.play().catch(e => console.error("Auto-play failed:", e));
+    }
+
+    document.getElementById('song-msg').innerText = "🎵 Raad het jaar!";
+
+    // Render drag zones active
+    renderTimelines();
+}
+
 // Modify global click handler for drop zones to support solo
 document.addEventListener('click', (e) => {
     if (isSoloMode && e.target.classList.contains('drop-zone')) {
@@ -0,0 +1,208 @@
+"""Concurrency primitives for the two server modes, chosen by SERVER_MODE.
+
+eventlet (default): the monkey-patched green runtime the server always
+used. Everything here is a thin alias.
+
+asyncio: a plain asyncio loop under uvicorn (see asgi.py), with no monkey
+patching. The game code stays synchronous and is shared between the
+modes. Every handler, background task and HTTP request runs in its own
+greenlet, and await_() hands an awaitable to the loop from there. For
+that greenlet the call looks blocking, but for the loop it is an ordinary
+await. It is the same bridge SQLAlchemy's asyncio support uses, so
+sleep(), Event.wait() or a Semaphore only park the greenlet that calls
+them.
+
+The API is the subset of eventlet's the server needs: spawn, spawn_after,
+sleep, Event, Semaphore, Pool.imap, plus original() for modules that need
+real OS threads.
+"""
+import os
+import importlib
+
+import greenlet
+
+MODE = os.environ.get('SERVER_MODE', 'eventlet')
+if MODE not in ('eventlet', 'asyncio'):
+    raise ValueError("SERVER_MODE must be 'eventlet' or 'asyncio'")
+ASYNCIO = MODE == 'asyncio'
+
+if not ASYNCIO:
+    import eventlet
+    from eventlet import patcher
+    from eventlet.event import Event  # noqa: F401
+    from eventlet.semaphore import Semaphore  # noqa: F401
+
+    def monkey_patch():
+        eventlet.monkey_patch()
+
+    def original(name):
+        """The unpatched module, for work that must run on a real OS thread."""
+        return patcher.original(name)
+
+    spawn = eventlet.spawn
+    spawn_after = eventlet.spawn_after
+    sleep = eventlet.sleep
+    Pool = eventlet.GreenPool
+    Timeout = eventlet.Timeout
+
+    def start():
+        pass
+
+else:
+    import asyncio
+    import logging
+    from collections import deque
+
+    log = logging.getLogger('tunetimeline.runtime')
+
+    def monkey_patch():
+        pass  # Nothing to patch; blocking calls have to go through await_()
+
+    def original(name):
+        return importlib.import_module(name)
+
+    class _Bridge(greenlet.greenlet):
+        """Greenlet running synchronous code on behalf of a coroutine; await_() switches back to it."""
+
+    async def run_sync(fn, *args):
+        """Run fn(*args) in a bridge greenlet, awaiting whatever it passes to await_()."""
+        child = _Bridge(fn)
+        result = child.switch(*args)
+        while not child.dead:
+            try:
+                value = await result
+            except BaseException as e:
+                result = child.throw(e)
+            else:
+                result = child.switch(value)
+        return result
+
+    def await_(awaitable):
+        """Wait for an awaitable from synchronous code running under run_sync()."""
+        current = greenlet.getcurrent()
+        if not isinstance(current, _Bridge):
+            raise RuntimeError("await_() called outside run_sync(); nothing can wait here")
+        return current.parent.switch(awaitable)
+
+    _tasks = set()  # Strong references, or the loop may drop running tasks
+    _deferred = []  # (delay, fn, args) scheduled before the loop started
+
+    def _done(task):
+        _tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            e = task.exception()
+            log.error("Background task failed", exc_info=(type(e), e, e.__traceback__))
+
+    def _loop():
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+    def spawn(fn, *args):
+        """Run fn(*args) in the background; returns the asyncio Task (None before the loop starts)."""
+        loop = _loop()
+        if loop is None:
+            _deferred.append((0, fn, args))
+            return None
+        task = loop.create_task(run_sync(fn, *args))
+        _tasks.add(task)
+        task.add_done_callback(_done)
+        return task
+
+    def spawn_after(seconds, fn, *args):
+        """Run fn(*args) in the background after `seconds`; the returned handle has cancel()."""
+        loop = _loop()
+        if loop is None:
+            _deferred.append((seconds, fn, args))
+            return None
+        return loop.call_later(seconds, spawn, fn, *args)
+
+    def start():
+        """Schedule what was spawned before the loop ran (startup code at import time)."""
+        deferred = _deferred[:]
+        _deferred.clear()
+        for seconds, fn, args in deferred:
+            if seconds:
+                spawn_after(seconds, fn, *args)
+            else:
+                spawn(fn, *args)
+
+    def sleep(seconds=0):
+        await_(asyncio.sleep(seconds))
+
+    class Event:
+        """One-shot result that any number of greenlets can wait for (eventlet.event.Event)."""
+
+        def __init__(self):
+            self._future = asyncio.get_running_loop().create_future()
+            # Retrieve the exception even if nobody waits, so asyncio doesn't log it as lost
+            self._future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        def send(self, value=None):
+            self._future.set_result(value)
+
+        def send_exception(self, exc):
+            self._future.set_exception(exc)
+
+        def wait(self):
+            return await_(asyncio.shield(self._future))
+
+    class Semaphore:
+        """Counting semaphore with eventlet's acquire(blocking, timeout) signature."""
+
+        def __init__(self, value=1):
+            self.counter = value
+            self._waiters = deque()
+
+        @property
+        def balance(self):
+            return self.counter - len(self._waiters)
+
+        def acquire(self, blocking=True, timeout=None):
+            if self.counter > 0:
+                self.counter -= 1
+                return True
+            if not blocking:
+                return False
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await_(waiter if timeout is None else asyncio.wait_for(waiter, timeout))
+                return True
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+        def release(self):
+            # Hand the slot straight to the next live waiter, so nobody can barge in between
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(True)
+                    return
+            self.counter += 1
+
+        def __enter__(self):
+            self.acquire()
+            return self
+
+        def __exit__(self, *exc):
+            self.release()
+
+    class Pool:
+        """At most `size` calls at a time; imap() returns the results in input order."""
+
+        def __init__(self, size=1000):
+            self._slots = Semaphore(size)
+
+        def _run(self, fn, item):
+            with self._slots:
+                return fn(item)
+
+        def imap(self, fn, iterable):
+            loop = asyncio.get_running_loop()
+            tasks = [loop.create_task(run_sync(self._run, fn, item)) for item in iterable]
+            return iter(await_(asyncio.gather(*tasks)))
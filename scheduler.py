@@ -0,0 +1,153 @@
+"""Per-room deadlines, all run by one scheduler greenlet.
+
+Every timed step of a room (auto-reveal, ready and turn timeouts, the
+vote window, batched sync and vote-update flushes) is a deadline keyed by
+(room code, kind). Setting a kind that is already pending replaces it,
+so a deadline is scheduled once no matter how often it is requested.
+cancel() and cancel_room() drop deadlines that are no longer wanted.
+
+Deadlines sit in a heap ordered by due time. Cancelled ones are skipped
+when they reach the top, and the heap is compacted once they make up most
+of it. run() sleeps until the earliest deadline is due and is woken early
+when an earlier one is added. Due deadlines are spawned as short-lived
+greenlets, so thousands of pending timers cost one greenlet, not one
+each.
+
+A due deadline stays pending until its callback returns. A callback that
+has to wait for the room lock calls take() once it holds it. take() is
+False if the deadline was cancelled or pushed back in the meantime, e.g.
+when the host revealed the year by hand while the auto-reveal waited.
+"""
+import time
+import heapq
+import logging
+import itertools
+
+import runtime
+
+log = logging.getLogger('tunetimeline.scheduler')
+
+FIRE_BATCH = 100  # Deadlines spawned between yields when many are due at once
+
+
+class Deadline:
+    __slots__ = ('when', 'room', 'kind', 'fn', 'args', 'cancelled')
+
+    def __init__(self, when, room, kind, fn, args):
+        self.when = when
+        self.room = room
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+
+class Scheduler:
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []  # (when, seq, Deadline), including cancelled ones until they surface
+        self._seq = itertools.count()  # Tie-breaker, so Deadlines are never compared
+        self._live = {}  # room code -> {kind: Deadline}
+        self._pending = 0
+        self._wakeup = runtime.Semaphore(0)
+        self._sleeping_until = None  # When run() next wakes up on its own; None while it is awake
+        self.fired = 0
+        self.cancelled = 0
+
+    def set(self, room, kind, delay, fn, *args):
+        """Run fn(*args) in `delay` seconds, replacing the room's pending `kind` deadline."""
+        deadline = Deadline(self.clock() + delay, room, kind, fn, args)
+        kinds = self._live.setdefault(room, {})
+        previous = kinds.get(kind)
+        if previous is None:
+            self._pending += 1
+        else:
+            previous.cancelled = True
+        kinds[kind] = deadline
+        heapq.heappush(self._heap, (deadline.when, next(self._seq), deadline))
+        if self._sleeping_until is not None and deadline.when < self._sleeping_until:
+            self._sleeping_until = None
+            self._wakeup.release()
+        self._compact()
+        return deadline
+
+    def pending(self, room, kind):
+        """Seconds until the room's `kind` deadline, or None if there is none."""
+        deadline = self._live.get(room, {}).get(kind)
+        return None if deadline is None else max(0.0, deadline.when - self.clock())
+
+    def cancel(self, room, kind):
+        deadline = self._live.get(room, {}).get(kind)
+        if deadline is not None:
+            self._discard(deadline)
+            self.cancelled += 1
+            self._compact()
+
+    def cancel_room(self, room):
+        for deadline in self._live.pop(room, {}).values():
+            deadline.cancelled = True
+            self._pending -= 1
+            self.cancelled += 1
+        self._compact()
+
+    def take(self, room, kind):
+        """Claim the room's due `kind` deadline for the callback running it; False if it is gone or not due."""
+        deadline = self._live.get(room, {}).get(kind)
+        if deadline is None or deadline.when > self.clock():
+            return False
+        self._discard(deadline)
+        return True
+
+    def _discard(self, deadline):
+        deadline.cancelled = True
+        kinds = self._live.get(deadline.room)
+        if kinds is not None and kinds.get(deadline.kind) is deadline:
+            del kinds[deadline.kind]
+            self._pending -= 1
+            if not kinds:
+                del self._live[deadline.room]
+
+    def _compact(self):
+        """Drop cancelled entries once they are most of the heap; O(n), so amortized O(1) per cancel."""
+        if len(self._heap) > 64 and len(self._heap) > 4 * self._pending:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+
+    def run(self):
+        """Scheduler loop; spawn it once."""
+        while True:
+            now = self.clock()
+            spawned = 0
+            while self._heap and self._heap[0][0] <= now:
+                deadline = heapq.heappop(self._heap)[2]
+                if not deadline.cancelled:
+                    self.fired += 1
+                    runtime.spawn(self._fire, deadline)
+                    spawned += 1
+                    if spawned % FIRE_BATCH == 0:
+                        runtime.sleep(0)  # Let this batch run before spawning the next one
+                        now = self.clock()
+            if self._heap:
+                self._sleeping_until = self._heap[0][0]
+                self._wakeup.acquire(timeout=max(0.0, self._sleeping_until - now))
+            else:
+                self._sleeping_until = float('inf')
+                self._wakeup.acquire()
+            self._sleeping_until = None
+
+    def _fire(self, deadline):
+        try:
+            deadline.fn(*deadline.args)
+        except Exception:
+            log.exception("Deadline %s failed", deadline.kind, extra={'room': deadline.room})
+        finally:
+            self._discard(deadline)
+
+    def stats(self):
+        return {
+            'pending': self._pending,
+            'heap': len(self._heap),
+            'fired': self.fired,
+            'cancelled': self.cancelled
+        }
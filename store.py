@@ -0,0 +1,271 @@
+"""Room state backends.
+
+Handlers never touch rooms directly; they open a transaction on a room
+code, which holds that room's lock, hands out the Room and writes it back
+on exit. MemoryRoomStore (the default) keeps live objects in a dict, so
+the write-back is free. RedisRoomStore keeps serialized rooms in any
+Redis-protocol server so several workers can share games.
+"""
+import json
+import time
+from collections import OrderedDict
+from itertools import islice
+from contextlib import contextmanager
+
+from runtime import Semaphore
+
+from models import Room
+
+
+class RoomStore:
+    """Mapping-style access to rooms plus per-room transactions."""
+
+    def get(self, code):
+        raise NotImplementedError
+
+    def put(self, room):
+        raise NotImplementedError
+
+    def delete(self, code):
+        raise NotImplementedError
+
+    def codes(self):
+        raise NotImplementedError
+
+    def lock(self, code):
+        raise NotImplementedError
+
+    def lru_codes(self, count=None):
+        """Room codes, least recently written first."""
+        raise NotImplementedError
+
+    def idle_codes(self, max_idle):
+        """Codes of rooms not written for more than max_idle seconds."""
+        raise NotImplementedError
+
+    def load_playlist(self, digest):
+        """Tracks stored under a playlist hash by another worker, or None."""
+        return None
+
+    def recover(self):
+        """Rooms restored from durable state at startup (none by default)."""
+        return []
+
+    def playlist_hashes(self):
+        """Hashes that must stay servable from this worker's playlist blobs."""
+        return {room.playlist_hash for room in self.values()}
+
+    @contextmanager
+    def transaction(self, code):
+        """Lock a room, yield it (None if missing) and save it back afterwards."""
+        if not code:
+            yield None
+            return
+        with self.lock(code):
+            room = self.get(code)
+            yield room
+            # The handler may have deleted the room (last player left); don't resurrect it
+            if room is not None and code in self:
+                self.put(room)
+
+    def __contains__(self, code):
+        return self.get(code) is not None
+
+    def __getitem__(self, code):
+        room = self.get(code)
+        if room is None:
+            raise KeyError(code)
+        return room
+
+    def __setitem__(self, code, room):
+        self.put(room)
+
+    def __delitem__(self, code):
+        self.delete(code)
+
+    def __len__(self):
+        return len(self.codes())
+
+    def values(self):
+        for code in self.codes():
+            room = self.get(code)
+            if room is not None:
+                yield room
+
+
+class MemoryRoomStore(RoomStore):
+    """Single-process store: rooms live in a dict, locks are green semaphores.
+
+    With a RoomJournal every write-back is also journaled, so recover() can
+    rebuild the rooms after a restart.
+    """
+
+    def __init__(self, journal=None):
+        self._rooms = {}
+        self._locks = {}
+        self._active = OrderedDict()  # code -> last write (wall clock), oldest first
+        self.journal = journal
+
+    def get(self, code):
+        return self._rooms.get(code)
+
+    def put(self, room):
+        self._rooms[room.code] = room
+        self._active[room.code] = time.time()
+        self._active.move_to_end(room.code)
+        if self.journal:
+            self.journal.record(room)
+
+    def delete(self, code):
+        self._rooms.pop(code, None)
+        self._locks.pop(code, None)
+        self._active.pop(code, None)
+        if self.journal:
+            self.journal.forget(code)
+
+    def lru_codes(self, count=None):
+        return list(islice(self._active, count))
+
+    def idle_codes(self, max_idle):
+        cutoff = time.time() - max_idle
+        idle = []
+        for code, active in self._active.items():
+            if active > cutoff:
+                break
+            idle.append(code)
+        return idle
+
+    def load_playlist(self, digest):
+        return self.journal.load_playlist(digest) if self.journal and digest else None
+
+    def recover(self):
+        """Load journaled rooms; returns the recovered Room objects."""
+        if not self.journal:
+            return []
+        recovered = []
+        for code, data in self.journal.recover().items():
+            room = Room.from_dict(data, self.load_playlist(data.get('playlist_hash')) or ())
+            self._rooms[code] = room
+            self._active[code] = time.time()
+            recovered.append(room)
+        return recovered
+
+    def codes(self):
+        return list(self._rooms)
+
+    @contextmanager
+    def transaction(self, code):
+        # A code with no room gets no lock either, so made-up codes can't grow the lock table
+        if code not in self._rooms:
+            yield None
+            return
+        with super().transaction(code) as room:
+            yield room
+
+    def lock(self, code):
+        lock = self._locks.get(code)
+        if lock is None:
+            lock = self._locks[code] = Semaphore(1)
+        return lock
+
+    def __contains__(self, code):
+        return code in self._rooms
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def values(self):
+        return list(self._rooms.values())
+
+
+class RedisRoomStore(RoomStore):
+    """Rooms as JSON in Redis, with Redis locks so any worker can mutate any room.
+
+    `client` is anything that speaks the redis-py API; tests and local runs
+    can pass a fakeredis.FakeRedis instead of a real server.
+    """
+
+    def __init__(self, client, prefix='tunetimeline:', lock_timeout=10):
+        self.client = client
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self._playlists = {}  # hash -> tuple, so rooms on this worker share one copy
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if url.startswith('fakeredis://'):
+            import fakeredis
+            return cls(fakeredis.FakeRedis(), **kwargs)
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _key(self, kind, name):
+        return f"{self.prefix}{kind}:{name}"
+
+    def get(self, code):
+        raw = self.client.get(self._key('room', code))
+        if raw is None:
+            return None
+        data = json.loads(raw)
+        return Room.from_dict(data, self.load_playlist(data.get('playlist_hash')) or ())
+
+    def put(self, room):
+        if room.playlist_hash and room.playlist_hash not in self._playlists:
+            self.client.set(self._key('playlist', room.playlist_hash), json.dumps(list(room.playlist_tracks)), nx=True)
+            self._playlists[room.playlist_hash] = room.playlist_tracks
+        self.client.set(self._key('room', room.code), json.dumps(room.to_dict()))
+        self.client.sadd(self._key('index', 'rooms'), room.code)
+        # Wall clock, since every worker compares against these scores
+        self.client.zadd(self._key('index', 'active'), {room.code: time.time()})
+
+    def delete(self, code):
+        self.client.delete(self._key('room', code))
+        self.client.srem(self._key('index', 'rooms'), code)
+        self.client.zrem(self._key('index', 'active'), code)
+
+    @staticmethod
+    def _decode(codes):
+        return [c.decode() if isinstance(c, bytes) else c for c in codes]
+
+    def codes(self):
+        return self._decode(self.client.smembers(self._key('index', 'rooms')))
+
+    def lru_codes(self, count=None):
+        return self._decode(self.client.zrange(self._key('index', 'active'), 0, -1 if count is None else count - 1))
+
+    def idle_codes(self, max_idle):
+        return self._decode(self.client.zrangebyscore(self._key('index', 'active'), '-inf', time.time() - max_idle))
+
+    def lock(self, code):
+        return self.client.lock(self._key('lock', code), timeout=self.lock_timeout, blocking_timeout=self.lock_timeout)
+
+    def playlist_hashes(self):
+        # Every worker can reload a playlist from Redis, so local blobs are free to go
+        return set()
+
+    def load_playlist(self, digest):
+        if not digest:
+            return None
+        tracks = self._playlists.get(digest)
+        if tracks is None:
+            raw = self.client.get(self._key('playlist', digest))
+            if raw is None:
+                return None
+            tracks = self._playlists[digest] = tuple(json.loads(raw))
+        return tracks
+
+    def __contains__(self, code):
+        return bool(self.client.exists(self._key('room', code)))
+
+
+def create_room_store(url=None, journal_dir=None):
+    """Store for ROOM_STORE_URL: empty/'memory' for in-process, redis:// or fakeredis:// for shared.
+
+    journal_dir makes the in-process store durable; Redis keeps its own state.
+    """
+    if not url or url == 'memory':
+        if journal_dir:
+            from journal import RoomJournal
+            return MemoryRoomStore(RoomJournal(journal_dir))
+        return MemoryRoomStore()
+    return RedisRoomStore.from_url(url)
@@ -0,0 +1,160 @@
+"""Game-engine tests: client payloads are untrusted, so no game-action may raise or corrupt the room."""
+import random
+
+import pytest
+
+import engine
+from models import Player, Room, Song
+
+JUNK = [None, 'x', '', 0, 1, -1, 1.5, float('inf'), True, [], ['team1'], {}, {'teamId': 'team1'}]
+TEAM_IDS = ['team1', 'team2', 'team3', None, 5, ['team1'], {'a': 1}]
+POSITIONS = [0, 1, 2, 3, -1, 99, '1', None, 1.0, True, [0], float('nan')]
+SIDS = ['p0', 'p1', 'p2', 'p3', 'stranger']
+
+
+def song(i, year=1990):
+    return {'title': f"Song {i}", 'artist': 'Artist', 'year': year, 'url': f"https://audio.example/{i}.m4a"}
+
+
+def playing_room():
+    """Four players in two teams, one starter card each, song playing for team1."""
+    room = Room('TEST', 'p0')
+    for i in range(4):
+        room.add_player(Player(f"p{i}", f"Speler {i}"))
+        room.assign_team(f"p{i}", 'team1' if i % 2 == 0 else 'team2')
+    engine.apply_action(room, 'p0', 'start-game', None)
+    for sid in room.players:
+        engine.apply_action(room, sid, 'player-ready', None)
+    engine.apply_action(room, 'p0', 'init-starter-cards', {'team1Song': song(1, 1980), 'team2Song': song(2, 2000)})
+    engine.apply_action(room, 'p0', 'play-song', song(3))
+    return room
+
+
+def payload(rng):
+    kind = rng.random()
+    if kind < 0.3:
+        return rng.choice(JUNK)
+    if kind < 0.4:
+        return song(rng.randrange(1000), rng.choice([1990, '1990', None, 'x', float('inf'), 10**400]))
+    data = {}
+    for key, values in (('teamId', TEAM_IDS), ('pos', POSITIONS), ('oracleSid', SIDS + JUNK),
+                        ('team1Song', [song(4), None, 'x']), ('team2Song', [song(5), []])):
+        if rng.random() < 0.7:
+            data[key] = rng.choice(values)
+    return data
+
+
+def assert_consistent(room):
+    """What reveal() relies on: a stored placement and challenge are well-formed."""
+    for claim in (room.current_placement, room.current_challenge):
+        if claim is not None:
+            assert isinstance(claim, dict) and claim['teamId'] in room.teams
+            assert claim['pos'] is None or type(claim['pos']) is int
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_fuzzed_actions_never_raise(seed):
+    rng = random.Random(seed)
+    actions = sorted(engine.ACTIONS) + ['no-such-action', None]
+    room = playing_room()
+    for _ in range(4000):
+        if rng.random() < 0.1:
+            engine.expire(room, rng.choice(engine.DEADLINES))
+        else:
+            engine.apply_action(room, rng.choice(SIDS), rng.choice(actions), payload(rng),
+                                is_admin=rng.random() < 0.1, rng=rng)
+        assert_consistent(room)
+        engine.reveal(Room.from_dict(room.to_dict()))  # A reveal from any reachable state works too
+
+
+@pytest.mark.parametrize('action', sorted(engine.TEAM_ACTIONS))
+@pytest.mark.parametrize('action_data', ['x', None, 3, ['team1', 0]])
+def test_non_dict_payloads_are_ignored(action, action_data):
+    room = playing_room()
+    before = room.to_dict()
+    outcome = engine.apply_action(room, 'p0', action, action_data)  # The host, so host-only actions get this far
+    assert outcome.events == [] and outcome.effects == []
+    assert room.to_dict() == before
+
+
+def test_malformed_challenge_is_not_stored():
+    room = playing_room()
+    engine.apply_action(room, 'p0', 'submit-placement', {'teamId': 'team1', 'pos': 0})
+    engine.apply_action(room, 'p1', 'submit-challenge', {'teamId': 'team2'})
+    assert room.current_challenge is None
+    outcome = engine.expire(room, 'turn')  # Nobody challenged in time
+    assert [event for event, _, _ in outcome.events] == ['challenge-skipped', 'year-revealed']
+
+
+def test_valid_challenge_can_steal():
+    room = playing_room()
+    correct = room.teams['team1'].timeline.correct_pos(1990)
+    engine.apply_action(room, 'p0', 'submit-placement', {'teamId': 'team1', 'pos': 1 - correct})
+    outcome = engine.apply_action(room, 'p1', 'submit-challenge', {'teamId': 'team2', 'pos': correct, 'extra': 'x'})
+    assert room.current_challenge == {'teamId': 'team2', 'pos': correct}
+    assert ('deadline', ('reveal', engine.AUTO_REVEAL_DELAY)) in outcome.effects
+    results = engine.expire(room, 'reveal').events[-1][1]['results']
+    assert results['stolen'] and [s.year for s in room.teams['team2'].timeline] == [1990, 2000]
+
+
+def track(rng):
+    """A playlist entry, often malformed."""
+    if rng.random() < 0.2:
+        return rng.choice(JUNK)
+    entry = {'name': 'Song', 'artist': 'Band', 'uri': 'spotify:track:1'}
+    if rng.random() < 0.3:
+        entry[rng.choice(['name', 'artist'])] = rng.choice(JUNK)
+    return entry
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_fuzzed_playlists_are_validated(seed):
+    """app.py stores what playlist_tracks() returns and resolves every track on iTunes."""
+    rng = random.Random(seed)
+    for _ in range(2000):
+        data = rng.choice(JUNK) if rng.random() < 0.2 else [track(rng) for _ in range(rng.randrange(4))]
+        tracks = engine.playlist_tracks(data)
+        if tracks is not None:
+            assert type(tracks) is tuple and tracks
+            assert all(set(t) == {'name', 'artist'} and isinstance(t['name'], str) and isinstance(t['artist'], str)
+                       for t in tracks)
+        assert engine.playlist_url(data) is None or isinstance(data, str)
+
+
+@pytest.mark.parametrize('data', [None, 'x', 3, [], [None], ['Song'], [['Song', 'Band']], [{'name': 'Song'}],
+                                  [{'name': 'Song', 'artist': 'Band'}] * (engine.MAX_PLAYLIST_TRACKS + 1)])
+def test_malformed_playlists_are_rejected(data):
+    assert engine.playlist_tracks(data) is None
+
+
+@pytest.mark.parametrize('action', ['fetch-playlist', 'set-playlist-tracks'])
+def test_playlist_actions_are_admin_only(action):
+    room = playing_room()
+    assert engine.permission_error(room, 'p0', action) is not None  # Even the host
+    assert engine.permission_error(room, 'p0', action, is_admin=True) is None
+
+
+def test_song_from_wire_rejects_unbounded_years():
+    with pytest.raises(OverflowError):
+        Song.from_wire(song(1, float('inf')))
+
+
+@pytest.mark.parametrize('sid, team_id, place_first', [
+    ('p1', 'team2', False),  # Before the placement, while the song plays
+    ('p0', 'team1', True),  # The placing team itself
+])
+def test_challenge_outside_the_window_is_ignored(sid, team_id, place_first):
+    room = playing_room()
+    if place_first:
+        engine.apply_action(room, 'p0', 'submit-placement', {'teamId': 'team1', 'pos': 0})
+    outcome = engine.apply_action(room, sid, 'submit-challenge', {'teamId': team_id, 'pos': 1})
+    assert room.current_challenge is None
+    assert outcome.events == [] and ('deadline', ('turn', None)) not in outcome.effects
+
+
+def test_second_challenge_does_not_push_back_the_reveal():
+    room = playing_room()
+    engine.apply_action(room, 'p0', 'submit-placement', {'teamId': 'team1', 'pos': 0})
+    engine.apply_action(room, 'p1', 'submit-challenge', {'teamId': 'team2', 'pos': 1})
+    outcome = engine.apply_action(room, 'p3', 'submit-challenge', {'teamId': 'team2', 'pos': 0})
+    assert outcome.effects == [] and room.current_challenge == {'teamId': 'team2', 'pos': 1}
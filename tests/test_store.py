@@ -0,0 +1,106 @@
+"""Room store tests, run against the in-process store and against RedisRoomStore on fakeredis."""
+import pytest
+
+import store
+from models import Player, Room, Song
+
+
+class Clock:
+    """Stands in for the time module, so idle and LRU order don't depend on the real clock."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(store, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'fakeredis://'])
+def rooms(request, clock):
+    rooms = store.create_room_store(request.param)
+    if isinstance(rooms, store.RedisRoomStore):
+        rooms.client.flushall()  # FakeRedis instances may share one server
+    return rooms
+
+
+def make_room(code):
+    room = Room(code, 'h')
+    room.add_player(Player('h', 'Host', 'secret'))
+    room.add_player(Player('p', 'Speler'))
+    room.assign_team('h', 'team1')
+    room.assign_team('p', 'team2')
+    room.teams['team1'].set_timeline([Song('Title', 'Artist', 1984, 'https://audio.example/1.m4a')])
+    room.teams['team2'].score = 3
+    room.playlist_tracks = ({'name': 'Title', 'artist': 'Artist'},)
+    room.playlist_hash = 'abc'
+    return room
+
+
+def test_put_get_round_trip(rooms):
+    room = make_room('AAAAA')
+    rooms['AAAAA'] = room
+    loaded = rooms.get('AAAAA')
+    assert loaded.to_dict() == room.to_dict()
+    assert loaded.playlist_tracks == room.playlist_tracks
+    assert loaded.players['h'].secret == 'secret' and loaded.players['h'].team == 'team1'
+    assert 'AAAAA' in rooms and len(rooms) == 1 and rooms.codes() == ['AAAAA']
+
+
+def test_transaction_writes_back(rooms):
+    rooms['AAAAA'] = make_room('AAAAA')
+    with rooms.transaction('AAAAA') as room:
+        room.target_score = 7
+        room.teams['team2'].score += 1
+    loaded = rooms.get('AAAAA')
+    assert loaded.target_score == 7 and loaded.teams['team2'].score == 4
+
+
+def test_room_deleted_in_transaction_stays_deleted(rooms):
+    rooms['AAAAA'] = make_room('AAAAA')
+    with rooms.transaction('AAAAA') as room:
+        del rooms[room.code]
+    assert rooms.get('AAAAA') is None and 'AAAAA' not in rooms
+
+
+def test_missing_room(rooms):
+    assert rooms.get('NOPE1') is None and 'NOPE1' not in rooms
+    with pytest.raises(KeyError):
+        rooms['NOPE1']
+    for code in ('NOPE1', '', None):
+        with rooms.transaction(code) as room:
+            assert room is None
+    assert len(rooms) == 0  # A transaction on a missing room doesn't create it
+
+
+def test_lru_and_idle_codes(rooms, clock):
+    for code in ('AAAAA', 'BBBBB', 'CCCCC'):
+        rooms[code] = make_room(code)
+        clock.now += 10
+    with rooms.transaction('AAAAA') as room:
+        room.target_score = 5  # A write makes it the most recently active
+    assert rooms.lru_codes() == ['BBBBB', 'CCCCC', 'AAAAA']
+    assert rooms.lru_codes(1) == ['BBBBB']
+    assert sorted(rooms.idle_codes(15)) == ['BBBBB']  # Written 20s ago; CCCCC 10s, AAAAA just now
+    assert sorted(rooms.idle_codes(5)) == ['BBBBB', 'CCCCC']
+    del rooms['BBBBB']
+    assert rooms.lru_codes() == ['CCCCC', 'AAAAA'] and rooms.idle_codes(15) == []
+
+
+def test_memory_store_keeps_no_locks_for_missing_rooms():
+    rooms = store.MemoryRoomStore()
+    rooms['AAAAA'] = make_room('AAAAA')
+    for i in range(100):
+        with rooms.transaction(f"X{i}"):
+            pass
+    with rooms.transaction('AAAAA'):
+        pass
+    assert list(rooms._locks) == ['AAAAA']
+    del rooms['AAAAA']
+    assert rooms._locks == {}
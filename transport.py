@@ -0,0 +1,222 @@
+"""Socket.IO server for the current runtime mode, behind one small interface.
+
+app.py registers its handlers with on() and talks to sockets only through
+sid(), reply(), emit(), the room helpers, connected() and disconnect(),
+so the handlers are the same code in both modes:
+
+    FlaskSocketTransport  Flask-SocketIO on eventlet (the default)
+    AsyncSocketTransport  python-socketio's AsyncServer on an ASGI app, run
+                          by uvicorn. Handlers run in runtime bridge
+                          greenlets. Flask still serves the HTTP routes,
+                          through a small ASGI-to-WSGI bridge that runs each
+                          request the same way.
+"""
+import sys
+import io
+from contextvars import ContextVar
+from urllib.parse import parse_qs
+
+import runtime
+
+
+class FlaskSocketTransport:
+
+    def __init__(self, app, **options):
+        from flask_socketio import SocketIO
+        self.app = app
+        self.socketio = SocketIO(app, async_mode='eventlet', **options)
+
+    def on(self, event):
+        return self.socketio.on(event)
+
+    def sid(self):
+        from flask import request
+        return request.sid
+
+    def query(self, name):
+        from flask import request
+        return request.args.get(name)
+
+    def emit(self, event, data=None, to=None, skip_sid=None):
+        self.socketio.emit(event, data, to=to, skip_sid=skip_sid)
+
+    def reply(self, event, data=None):
+        """Emit to the socket whose event is being handled."""
+        self.emit(event, data, to=self.sid())
+
+    def enter_room(self, sid, room):
+        self.socketio.server.enter_room(sid, room)
+
+    def leave_room(self, sid, room):
+        self.socketio.server.leave_room(sid, room)
+
+    def close_room(self, room):
+        self.socketio.close_room(room)
+
+    def connected(self, sid):
+        return self.socketio.server.manager.is_connected(sid, '/')
+
+    def disconnect(self, sid):
+        self.socketio.server.disconnect(sid)
+
+    def participants(self, room):
+        return [sid for sid, _ in self.socketio.server.manager.get_participants('/', room)]
+
+    def socket_count(self):
+        return len(self.socketio.server.eio.sockets)
+
+    def run(self, host, port, debug=False):
+        self.socketio.run(self.app, host=host, port=port, debug=debug)
+
+
+class AsyncSocketTransport:
+
+    def __init__(self, app, message_queue=None, manage_session=None, **options):
+        import socketio
+        self.app = app
+        manager = socketio.AsyncRedisManager(message_queue) if message_queue else None
+        self.sio = socketio.AsyncServer(async_mode='asgi', client_manager=manager, **options)
+        self._sid = ContextVar('sid')
+        self._environ = ContextVar('environ')
+
+    def on(self, event):
+        def register(handler):
+            async def call(sid, *args):
+                environ = None
+                if event == 'connect':
+                    environ, args = args[0], ()  # (environ, auth); app handlers only need the query
+                return await runtime.run_sync(self._call, handler, sid, environ, args)
+            self.sio.on(event, call)
+            return handler
+        return register
+
+    def _call(self, handler, sid, environ, args):
+        self._sid.set(sid)
+        if environ is not None:
+            self._environ.set(environ)
+        return handler(*args)
+
+    def sid(self):
+        return self._sid.get()
+
+    def query(self, name):
+        values = parse_qs(self._environ.get().get('QUERY_STRING', '')).get(name)
+        return values[0] if values else None
+
+    def emit(self, event, data=None, to=None, skip_sid=None):
+        runtime.await_(self.sio.emit(event, data, to=to, skip_sid=skip_sid))
+
+    def reply(self, event, data=None):
+        self.emit(event, data, to=self.sid())
+
+    def enter_room(self, sid, room):
+        runtime.await_(self.sio.enter_room(sid, room))
+
+    def leave_room(self, sid, room):
+        runtime.await_(self.sio.leave_room(sid, room))
+
+    def close_room(self, room):
+        runtime.await_(self.sio.close_room(room))
+
+    def connected(self, sid):
+        return self.sio.manager.is_connected(sid, '/')
+
+    def disconnect(self, sid):
+        runtime.await_(self.sio.disconnect(sid))
+
+    def participants(self, room):
+        return [sid for sid, _ in self.sio.manager.get_participants('/', room)]
+
+    def socket_count(self):
+        return len(self.sio.eio.sockets)
+
+    def asgi_app(self):
+        import socketio
+        return socketio.ASGIApp(self.sio, other_asgi_app=WSGIBridge(self.app), on_startup=runtime.start)
+
+    def run(self, host, port, debug=False):
+        try:
+            import uvicorn
+        except ImportError as e:
+            raise ImportError("SERVER_MODE=asyncio needs uvicorn: pip install -r requirements-optional.txt") from e
+        # log_config=None keeps the handlers logs.setup_logging() installed; like
+        # Flask-SocketIO, only log requests and connections in debug mode
+        uvicorn.run(self.asgi_app(), host=host, port=port, log_config=None,
+                    log_level='info' if debug else 'warning', access_log=debug)
+
+
+class WSGIBridge:
+    """ASGI app that serves HTTP requests with a WSGI app, each in a runtime bridge greenlet.
+
+    Bodies are buffered both ways, which suits this app's small JSON and
+    static responses.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        body = []
+        while True:
+            message = await receive()
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        status, headers, chunks = await runtime.run_sync(self._call, self._environ(scope, b''.join(body)))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+    def _call(self, environ):
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [int(status.split(' ', 1)[0]),
+                           [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks = list(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response[0], response[1], chunks
+
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+                continue
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+
+def create(app, **options):
+    """The Socket.IO transport for runtime.MODE."""
+    if runtime.ASYNCIO:
+        return AsyncSocketTransport(app, **options)
+    return FlaskSocketTransport(app, **options)
@@ -0,0 +1,158 @@
+"""Pooled, bounded HTTP client for the iTunes and Spotify upstreams.
+
+Each Upstream keeps one connection pool, so connections (and their TCP
+and TLS handshakes) are reused across requests. Under eventlet the pool is
+a requests.Session. Under SERVER_MODE=asyncio it is an httpx.AsyncClient,
+awaited through the runtime bridge. A green semaphore per host caps the
+requests in flight. A caller that can't get a slot within `queue_timeout`
+fails fast instead of queueing behind a slow upstream. On top of the
+socket timeouts, every request has an overall deadline (eventlet.Timeout
+or asyncio.wait_for). It is cooperative, so a stalled upstream only parks
+the greenlet that is waiting on it.
+
+The circuit breaker opens after `failure_threshold` consecutive failures
+(exceptions, 5xx, 429). While it is open, get() raises Unavailable without
+touching the network, and callers fall back to cached data. After
+`cooldown` seconds one trial request is let through. Its result either
+closes the circuit or opens it for another cooldown.
+"""
+import time
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import runtime
+from runtime import Semaphore
+
+if runtime.ASYNCIO:
+    import asyncio
+    try:
+        import httpx
+    except ImportError as e:
+        raise ImportError("SERVER_MODE=asyncio needs httpx: pip install -r requirements-optional.txt") from e
+    _TRANSPORT_ERRORS = (requests.RequestException, httpx.HTTPError)
+    logging.getLogger('httpx').setLevel(logging.WARNING)  # It logs every request at INFO
+else:
+    _TRANSPORT_ERRORS = (requests.RequestException,)
+
+log = logging.getLogger('tunetimeline.upstream')
+
+
+class Unavailable(Exception):
+    """The upstream can't answer right now (circuit open, no free slot, timeout or connection error)."""
+
+
+class Upstream:
+
+    def __init__(self, name, max_in_flight=8, queue_timeout=2, connect_timeout=3, read_timeout=5, deadline=8,
+                 failure_threshold=5, cooldown=30):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        if runtime.ASYNCIO:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=max_in_flight * 4, max_keepalive_connections=max_in_flight)
+            )
+        else:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_in_flight)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        self._slots = {}  # host -> Semaphore(max_in_flight)
+        self._failures = 0  # consecutive
+        self._open_until = None  # monotonic deadline while the circuit is open
+        self._trial = False  # a half-open trial request is in flight
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def circuit_open(self):
+        return self._open_until is not None
+
+    def get(self, url, **kwargs):
+        """requests.get through the pool; raises Unavailable instead of waiting on a bad upstream."""
+        trial = self._admit()
+        host = urlsplit(url).netloc
+        slots = self._slots.get(host)
+        if slots is None:
+            slots = self._slots[host] = Semaphore(self.max_in_flight)
+        if not slots.acquire(timeout=self.queue_timeout):
+            if trial:
+                self._trial = False
+            self.rejected += 1
+            raise Unavailable(f"{self.name}: {self.max_in_flight} requests already in flight")
+        self.requests += 1
+        try:
+            with metrics.timed(metrics.upstream_seconds, (self.name,)):
+                response = self._send(url, kwargs)
+        except Unavailable:
+            self._record(False)
+            raise
+        except _TRANSPORT_ERRORS as e:
+            self._record(False)
+            raise Unavailable(f"{self.name}: {e or type(e).__name__}") from e  # httpx timeouts have no message
+        finally:
+            slots.release()
+        self._record(response.status_code < 500 and response.status_code != 429)
+        return response
+
+    def _send(self, url, kwargs):
+        timed_out = Unavailable(f"{self.name}: no response within {self.deadline}s")
+        if runtime.ASYNCIO:
+            try:
+                # httpx reads the whole body before get() returns, so the deadline covers it
+                return runtime.await_(asyncio.wait_for(self.client.get(url, **kwargs), self.deadline))
+            except asyncio.TimeoutError:
+                raise timed_out from None
+        with runtime.Timeout(self.deadline, timed_out):
+            response = self.session.get(url, timeout=self.timeout, **kwargs)
+            response.content  # Read the body inside the deadline too
+        return response
+
+    def _admit(self):
+        """Check the breaker; returns True if this request is the half-open trial."""
+        if self._open_until is None:
+            return False
+        if time.monotonic() < self._open_until or self._trial:
+            self.rejected += 1
+            raise Unavailable(f"{self.name}: circuit open")
+        self._trial = True
+        return True
+
+    def _record(self, ok):
+        self._trial = False
+        if ok:
+            if self._open_until is not None:
+                log.info("Circuit closed", extra={'upstream': self.name})
+            self._failures = 0
+            self._open_until = None
+            return
+        metrics.upstream_errors.inc((self.name,))
+        self.failures += 1
+        self._failures += 1
+        was_open = self._open_until is not None  # A failed trial, or a request that started before the trip
+        if was_open or self._failures >= self.failure_threshold:
+            self._open_until = time.monotonic() + self.cooldown
+            if not was_open:
+                self.trips += 1
+                log.warning("Circuit open for %ds after %d failures", self.cooldown, self._failures, extra={'upstream': self.name})
+
+    def stats(self):
+        return {
+            'circuitOpen': self.circuit_open,
+            'requests': self.requests,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'trips': self.trips,
+            'inFlight': sum(self.max_in_flight - slots.balance for slots in self._slots.values())
+        }